@@ -1,5 +1,12 @@
 from django.db import models
+from django.db.models.functions import Lower
 from django.contrib.auth.models import AbstractUser
 
 class User(AbstractUser):
-    email = models.EmailField(unique=True)
\ No newline at end of file
+    email = models.EmailField(unique=True)
+
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            # Case-insensitive lookups by username, e.g. ?user__username__iexact= on recipes
+            models.Index(Lower('username'), name='user_username_lower_idx'),
+        ]
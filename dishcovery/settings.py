@@ -12,7 +12,7 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 
 from datetime import timedelta
 from pathlib import Path
-from decouple import config
+from decouple import Csv, config
 import os
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -48,6 +48,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, to time the whole request
+    "recipes.metrics.metrics_middleware",
+    "recipes.profiling.profiling_middleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -55,6 +58,7 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "recipes.replicas.read_your_writes_middleware",
 ]
 
 ROOT_URLCONF = "dishcovery.urls"
@@ -83,16 +87,55 @@ WSGI_APPLICATION = "dishcovery.wsgi.application"
 
 DATABASES = {
     "default": {
-        # use postgresql
-        "ENGINE": "django.db.backends.postgresql",
-        "NAME": "dishcovery",
+        # use postgresql (DB_ENGINE/DB_NAME can point at sqlite3 for local tests)
+        "ENGINE": config("DB_ENGINE", default="django.db.backends.postgresql"),
+        "NAME": config("DB_NAME", default="dishcovery"),
         "USER": "postgres",
         "PASSWORD": config("DB_PASSWORD"),
         "HOST": "localhost",
         "PORT": "5432",
+        # Keep each thread's connection for this many seconds, checking it before reuse
+        "CONN_MAX_AGE": config("DB_CONN_MAX_AGE", default=60, cast=int),
+        "CONN_HEALTH_CHECKS": True,
     }
 }
 
+# Default time limit (milliseconds) of each statement run by the API viewsets (see recipes/db.py)
+DB_STATEMENT_TIMEOUT = config("DB_STATEMENT_TIMEOUT", default=5000, cast=int)
+
+# Read replicas of "default" (see recipes/replicas.py): comma-separated hosts, or database files
+# with sqlite3. API reads go to the replicas; users are pinned to the primary after writing.
+DATABASE_REPLICAS = []
+for index, replica in enumerate(config("DB_REPLICAS", default="", cast=Csv())):
+    alias = f"replica{index + 1}"
+    location = "NAME" if DATABASES["default"]["ENGINE"].endswith("sqlite3") else "HOST"
+    # Tests read the primary's test database through the replica's connection
+    DATABASES[alias] = {**DATABASES["default"], location: replica, "TEST": {"MIRROR": "default"}}
+    DATABASE_REPLICAS.append(alias)
+
+DATABASE_ROUTERS = ["recipes.replicas.ReplicaRouter"]
+# Seconds a user's reads stay on the primary after they write
+REPLICA_PIN_SECONDS = 5
+# Replicas lagging further behind are skipped; the lag is checked every interval (seconds)
+REPLICA_MAX_LAG_SECONDS = 5
+REPLICA_LAG_CHECK_INTERVAL = 10
+
+
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+CACHES = {
+    "default": {
+        # local-memory by default; point CACHE_BACKEND/CACHE_LOCATION at a shared cache in production
+        "BACKEND": config("CACHE_BACKEND", default="django.core.cache.backends.locmem.LocMemCache"),
+        "LOCATION": config("CACHE_LOCATION", default="dishcovery"),
+    }
+}
+
+# Cache alias and timeout (seconds) for serialized recipe fragments (see recipes/cache.py)
+RECIPE_FRAGMENT_CACHE = "default"
+RECIPE_FRAGMENT_CACHE_TIMEOUT = 60 * 60
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -141,6 +184,15 @@ AUTH_USER_MODEL = "core.User"
 MEDIA_URL = "/media/"
 MEDIA_ROOT = os.path.join(BASE_DIR, "media")
 
+# Resized image variants (see recipes/images.py): name -> longest side in pixels
+IMAGE_DERIVATIVE_SIZES = {"thumbnail": 200, "small": 480, "medium": 960}
+IMAGE_DERIVATIVE_QUALITY = 80
+# Generate derivatives in a process pool of this size, off the request thread
+IMAGE_DERIVATIVES_ASYNC = True
+IMAGE_DERIVATIVE_WORKERS = 2
+# Store uploaded images once per SHA-256 digest (see recipes/storage.py)
+CONTENT_ADDRESSED_MEDIA = True
+
 # Rest Framework
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": (
@@ -148,6 +200,46 @@ REST_FRAMEWORK = {
     ),
 }
 
+# Serialize recipe reads with recipes.fast_serializers instead of DRF's serializers
+FAST_READ_SERIALIZERS = True
+
+# Serve list/retrieve reads with the native async views of recipes.async_views (ASGI only).
+# Off by default: they are slower than the sync views in the benchmarks, under ASGI too.
+ASYNC_READ_VIEWS = config("ASYNC_READ_VIEWS", default=False, cast=bool)
+
+# Request metrics (served at /metrics). Under a pre-forking server, point METRICS_DIR at a
+# directory the workers share and empty it on every (re)start: each worker writes its metrics
+# there every METRICS_FLUSH_INTERVAL seconds and /metrics adds them up.
+METRICS_DIR = config("METRICS_DIR", default="")
+METRICS_FLUSH_INTERVAL = 5
+# Bearer token that lets a Prometheus scraper read /metrics without a staff account
+METRICS_TOKEN = config("METRICS_TOKEN", default="")
+
+# Lines of profiler output kept per request profile (see recipes.profiling)
+PROFILE_STATS_LIMIT = 60
+
+# Seconds after which the in-memory pantry, similar-recipes and autocomplete indexes of a worker
+# pick up the changes made by other workers (see recipes.refresh); 0 checks on every lookup.
+INDEX_REFRESH_INTERVAL = config("INDEX_REFRESH_INTERVAL", default=30, cast=int)
+
+# Seconds the tombstones of deleted recipes and ingredients are kept for the refreshes of the
+# indexes of other workers; prune_tombstones deletes older ones.
+INDEX_TOMBSTONE_RETENTION = config("INDEX_TOMBSTONE_RETENTION", default=7 * 24 * 60 * 60, cast=int)
+
+# File the MinHash signatures of recipes are saved to and memory-mapped from by every worker
+# (see recipes.similar); rewrite it with `manage.py build_similar_recipes`. Without it, each
+# worker computes them from the database.
+SIMILAR_RECIPES_INDEX = config("SIMILAR_RECIPES_INDEX", default="")
+
+# Home feeds (see recipes.feed): the entries kept per timeline, and the number of followers from
+# which an author's recipes are merged into feeds when read instead of pushed to timelines
+FEED_TIMELINE_LENGTH = 500
+FEED_FANOUT_MAX_FOLLOWERS = config("FEED_FANOUT_MAX_FOLLOWERS", default=10000, cast=int)
+FEED_FANOUT_BATCH_SIZE = 1000
+# Push new recipes to timelines in a thread pool of this size, off the request thread
+FEED_FANOUT_ASYNC = True
+FEED_FANOUT_WORKERS = 2
+
 SIMPLE_JWT = {
     "AUTH_HEADER_TYPES": ("JWT",),
 }
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'dishcovery.settings')
 
 application = get_wsgi_application()
+
+# Build the in-memory indexes before the worker serves its first request
+from recipes.refresh import build_indexes  # noqa: E402
+
+build_indexes()
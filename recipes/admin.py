@@ -1,6 +1,25 @@
 from django.contrib import admin
+from django.core.exceptions import PermissionDenied
+from django.http import HttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import path, reverse
 from django.utils.html import format_html
 from . import models
+from .images import derivative_name, derivative_storage
+
+
+def thumbnail_html(image):
+    """
+    Returns an <img> tag showing the thumbnail derivative of an image.
+    Falls back to the original image while the derivative hasn't been generated yet.
+    """
+    thumbnail_url = derivative_storage(image.storage).url(derivative_name(image.name, "thumbnail", "jpg"))
+    return format_html(
+        '<img src="{}" onerror="this.onerror=null;this.src=\'{}\'" '
+        'style="max-width: 200px; max-height: 200px; object-fit: cover;" />',
+        thumbnail_url,
+        image.url,
+    )
 
 
 class RecipeIngredientInline(admin.StackedInline):
@@ -33,12 +52,8 @@ class RecipeIngredientInline(admin.StackedInline):
         If a custom image is provided, it will be used, otherwise the ingredient's image will be used.
         """
         if obj.custom_image.name != "":
-            return format_html(
-                f'<img src="{obj.custom_image.url}" style="max-width: 200px; max-height: 200px; object-fit: cover;" />'
-            ) 
-        return format_html(
-            f'<img src="{obj.ingredient.image.url}" style="max-width: 200px; max-height: 200px; object-fit: cover;" />'
-        )
+            return thumbnail_html(obj.custom_image)
+        return thumbnail_html(obj.ingredient.image)
 
 
 @admin.register(models.Recipe)
@@ -70,9 +85,7 @@ class IngredientAdmin(admin.ModelAdmin):
             The HTML code for the thumbnail image.
         """
         if obj.image.name != "":
-            return format_html(
-                f'<img src="{obj.image.url}" style="max-width: 200px; max-height: 200px; object-fit: cover;" />'
-            )
+            return thumbnail_html(obj.image)
         return "No image"
 
 
@@ -98,8 +111,8 @@ class ProfileAdmin(admin.ModelAdmin):
         autocomplete_fields (list): List of fields to autocomplete.
     """
     list_select_related = ["user"]
-    list_display = ["first_name", "last_name", "phone_number", "created_at", "modified_at"]
-    readonly_fields = ["thumbnail", "created_at", "modified_at"]
+    list_display = ["first_name", "last_name", "phone_number", "follower_count", "created_at", "modified_at"]
+    readonly_fields = ["thumbnail", "follower_count", "created_at", "modified_at"]
     search_fields = ["user__username"]
     list_filter = ["created_at", "modified_at"]
     ordering = ["user__first_name", "user__last_name"]
@@ -107,7 +120,65 @@ class ProfileAdmin(admin.ModelAdmin):
     
     def thumbnail(self, obj):
         if obj.image.name != "":
-            return format_html(
-                f'<img src="{obj.image.url}" style="max-width: 200px; max-height: 200px; object-fit: cover;" />'
-            )
-        return "No image"
\ No newline at end of file
+            return thumbnail_html(obj.image)
+        return "No image"
+
+@admin.register(models.RequestProfile)
+class RequestProfileAdmin(admin.ModelAdmin):
+    """
+    Admin class for the RequestProfile model; profiles are taken by requests, not added here.
+    """
+    list_display = ["created_at", "method", "path", "status_code", "duration_ms", "query_count", "query_ms", "user"]
+    list_filter = ["method", "status_code", "route"]
+    search_fields = ["path", "route"]
+    list_select_related = ["user"]
+    date_hierarchy = "created_at"
+    fields = [
+        "created_at", "user", "method", "path", "route", "status_code", "duration_ms",
+        "query_count", "query_ms", "download", "sql", "report",
+    ]
+    readonly_fields = fields
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def get_urls(self):
+        return [
+            path(
+                "<int:pk>/download/",
+                self.admin_site.admin_view(self.download_view),
+                name="recipes_requestprofile_download",
+            ),
+            *super().get_urls(),
+        ]
+
+    def download_view(self, request, pk):
+        """
+        Returns the profile as a .prof file, for snakeviz or pstats.
+        """
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        profile = get_object_or_404(models.RequestProfile, pk=pk)
+        response = HttpResponse(bytes(profile.data), content_type="application/octet-stream")
+        response["Content-Disposition"] = f'attachment; filename="request-profile-{profile.pk}.prof"'
+        return response
+
+    @admin.display(description="Profile")
+    def download(self, obj):
+        return format_html(
+            '<a href="{}">Download .prof</a>', reverse("admin:recipes_requestprofile_download", args=[obj.pk])
+        )
+
+    @admin.display(description="SQL queries")
+    def sql(self, obj):
+        return format_html(
+            '<pre style="white-space: pre-wrap;">{}</pre>',
+            "\n".join(f"{query['ms']:9.3f} ms  [{query['alias']}] {query['sql']}" for query in obj.queries),
+        )
+
+    @admin.display(description="Profiler report")
+    def report(self, obj):
+        return format_html("<pre>{}</pre>", obj.stats)
@@ -8,3 +8,5 @@ class RecipesConfig(AppConfig):
     # This method is used to import signals
     def ready(self):
         import recipes.signals
+        import recipes.db
+        import recipes.metrics
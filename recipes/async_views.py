@@ -0,0 +1,179 @@
+"""
+Natively async list and retrieve actions for the API viewsets.
+
+Under ASGI, Django runs a sync view in a worker thread for the whole request, so the number of
+concurrent requests is capped by the thread pool. AsyncReadMixin gives a viewset async versions
+of its list and retrieve actions that run on the event loop. Their queries use the async ORM
+(``acount``, ``aget`` and ``async for``), and recipe ingredients are prefetched with one async
+query. Everything else is the viewset's own code: content negotiation,
+authentication, permissions, filtering, pagination, conditional GET and serialization. The
+responses are therefore the same as the sync ones.
+
+Two steps still run in a worker thread:
+* resolving the user of a request that carries credentials, because authentication classes are
+  sync (anonymous requests never touch the database);
+* preparing a filter backend whose ``aprepare(request, view)`` asks for it, e.g. the first build
+  of the in-process search index.
+
+All other methods and actions are handed to the sync viewset with ``sync_to_async``.
+async_read_urlpatterns swaps a router's views for async ones. recipes.urls applies it when
+ASYNC_READ_VIEWS is True. It is off by default, also under ASGI: in the benchmarks the async
+views serve fewer requests per second than the sync ones run in worker threads.
+"""
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.http import Http404, HttpResponse
+from django.urls import URLPattern
+from rest_framework.response import Response
+
+READ_ACTIONS = ("list", "retrieve")
+
+
+class AsyncReadMixin:
+    """
+    Adds async list and retrieve actions (``alist`` and ``aretrieve``) to a viewset.
+
+    Views override ``aserialize`` when serializing needs the database, and must not query the
+    database from ``get_queryset`` or their filter backends (see ``aprepare``).
+    """
+
+    async def adispatch(self, request, *args, **kwargs):
+        """
+        Async counterpart of APIView.dispatch() for the list and retrieve actions.
+        """
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+
+        try:
+            await self.aauthenticate(request)
+            self.initial(request, *args, **kwargs)
+            for backend in self.filter_backends:
+                prepare = getattr(backend(), "aprepare", None)
+                if prepare is not None:
+                    await prepare(request, self)
+            handler = self.alist if self.action == "list" else self.aretrieve
+            response = await handler(request, *args, **kwargs)
+        except Exception as exc:
+            response = self.handle_exception(exc)
+
+        self.response = self.finalize_response(request, response, *args, **kwargs)
+        return self.render(self.response)
+
+    async def aauthenticate(self, request):
+        # Without credentials the authentication classes return early, without a query.
+        if "Authorization" in request.headers or settings.SESSION_COOKIE_NAME in request.COOKIES:
+            await sync_to_async(lambda: request.user)()
+
+    @staticmethod
+    def render(response):
+        """
+        Renders a DRF response into a plain HttpResponse.
+
+        Django renders deferred responses in a worker thread; rendering here keeps it on the loop.
+        """
+        if not isinstance(response, Response):
+            return response
+        response.render()
+        rendered = HttpResponse(response.content, status=response.status_code)
+        for header, value in response.items():
+            rendered[header] = value
+        rendered.cookies = response.cookies
+        return rendered
+
+    async def alist(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        self.page = await self.apaginate_queryset(queryset)
+        objects = self.page if self.page is not None else [obj async for obj in queryset]
+        return await self.aconditional(objects, self.alist_response, objects, detail=False)
+
+    async def alist_response(self, objects):
+        if self.page is not None:
+            return self.get_paginated_response(await self.aserialize(objects))
+        return Response(await self.aserialize(objects))
+
+    async def aretrieve(self, request, *args, **kwargs):
+        instance = await self.aget_object()
+        return await self.aconditional([instance], self.aretrieve_response, instance)
+
+    async def aretrieve_response(self, instance):
+        return Response((await self.aserialize([instance]))[0])
+
+    async def apaginate_queryset(self, queryset):
+        if self.paginator is None:
+            return None
+        return await self.paginator.apaginate_queryset(queryset, self.request, view=self)
+
+    async def aget_object(self):
+        """
+        Async version of GenericAPIView.get_object().
+        """
+        queryset = self.filter_queryset(self.get_queryset())
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        try:
+            obj = await queryset.aget(**{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+        except (queryset.model.DoesNotExist, TypeError, ValueError, ValidationError):
+            raise Http404
+        self.check_object_permissions(self.request, obj)
+        return obj
+
+    async def aserialize(self, objects):
+        """
+        Serializes a list of objects, like ``get_serializer(objects, many=True).data``.
+        """
+        return self.get_serializer(objects, many=True).data
+
+
+def async_read_view(view):
+    """
+    Wraps a viewset's view function so that its list and retrieve actions run natively async.
+
+    Args:
+        view (function): The view returned by ``ViewSet.as_view(actions)``.
+
+    Returns:
+        function: An async view; other methods are run by the sync view in a worker thread.
+    """
+    actions = view.actions
+    sync_view = sync_to_async(view)
+
+    async def async_view(request, *args, **kwargs):
+        method = request.method.lower()
+        action = actions.get(method) or (actions.get("get") if method == "head" else None)
+        if action not in READ_ACTIONS:
+            return await sync_view(request, *args, **kwargs)
+
+        # The same set up as the view function of ViewSetMixin.as_view()
+        self = view.cls(**view.initkwargs)
+        self.action_map = actions
+        for http_method, name in actions.items():
+            setattr(self, http_method, getattr(self, name))
+        if hasattr(self, "get") and not hasattr(self, "head"):
+            self.head = self.get
+        self.action = action
+        self.request = request
+        return await self.adispatch(request, *args, **kwargs)
+
+    async_view.__name__ = view.__name__
+    async_view.__doc__ = view.__doc__
+    async_view.cls = view.cls
+    async_view.initkwargs = view.initkwargs
+    async_view.actions = actions
+    async_view.csrf_exempt = True
+    return async_view
+
+
+def async_read_urlpatterns(urlpatterns):
+    """
+    Returns the URL patterns with the views of AsyncReadMixin viewsets replaced by async views.
+    """
+    return [
+        URLPattern(pattern.pattern, async_read_view(pattern.callback), pattern.default_args, pattern.name)
+        if issubclass(getattr(pattern.callback, "cls", object), AsyncReadMixin)
+        and set(getattr(pattern.callback, "actions", {}).values()) & set(READ_ACTIONS)
+        else pattern
+        for pattern in urlpatterns
+    ]
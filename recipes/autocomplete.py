@@ -0,0 +1,281 @@
+"""
+In-memory ingredient name index for autocompletion as the user types.
+
+Names are normalized (lowercase, without accents, single spaces) and indexed twice:
+
+- in a prefix trie, under the whole name and under each of its word suffixes, so that "oli"
+  finds "olive oil" and "extra virgin olive oil";
+- in a trigram index (``pg_trgm``'s padded word trigrams), for typo tolerance: "tomatoe" or
+  "chery" still find "tomato" and "cherry".
+
+Matches of the whole name's prefix rank first, then matches of a later word's prefix, then
+trigram matches by similarity; ties are broken by popularity, the number of recipes using the
+ingredient (from the pantry index), then by the shortest name. Each trie node keeps its best
+prefix matches once ranked, until its ingredients or their recipe counts change, so that short
+prefixes don't rank every ingredient under them on each keystroke.
+
+The index is built from Ingredient when a worker process starts. It lives in process memory, so
+every worker process holds its own copy: the signal handlers in recipes.signals apply the changes committed by this
+process, and the changes of other processes are picked up by refresh() (see recipes.refresh).
+"""
+import heapq
+import threading
+import unicodedata
+from collections import Counter, defaultdict
+
+from .models import Ingredient
+from .pantry import pantry_index
+from .refresh import RefreshClock, deleted_since
+from .search import tokenize
+
+# Share of the query's trigrams a name must contain to be a typo-tolerant match
+MIN_SHARED_TRIGRAMS = 0.5
+# Queries shorter than this only match prefixes; their trigrams match almost anything
+MIN_FUZZY_LENGTH = 3
+# Prefix matches kept ranked per trie node; the autocomplete endpoint returns at most this many
+TOP_MATCHES = 50
+
+NAME_PREFIX, WORD_PREFIX = range(2)
+
+
+def normalize(text):
+    """
+    Returns text in lowercase without accents, its words separated by single spaces.
+    """
+    decomposed = unicodedata.normalize("NFKD", text)
+    return " ".join(tokenize("".join(c for c in decomposed if not unicodedata.combining(c))))
+
+
+def trigrams(text):
+    """
+    Returns the set of trigrams of a normalized text, each word padded like pg_trgm does.
+    """
+    result = set()
+    for word in text.split():
+        padded = f"  {word} "
+        result.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return result
+
+
+class TrieNode:
+    __slots__ = ("children", "ids", "top")
+
+    def __init__(self):
+        self.children = {}
+        # Ids of the ingredients with a key passing through this node, i.e. starting with its prefix
+        self.ids = set()
+        # (pantry index version, best (ingredient_id, recipe_count) matches), or None
+        self.top = None
+
+
+class AutocompleteIndex:
+    """
+    Prefix trie and trigram index over ingredient names.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._clock = RefreshClock()
+        self.reset()
+
+    def reset(self):
+        """
+        Drops the index; it will be rebuilt on the next lookup.
+        """
+        with self._lock:
+            self._built = False
+            self._clock.reset()
+            self._root = TrieNode()
+            self._trigrams = defaultdict(set)
+            self._names = {}
+            self._keys = {}
+            self._trigram_counts = {}
+            self._last_id = 0
+
+    def build(self):
+        """
+        (Re)builds the index from the database in one query.
+        """
+        with self._lock:
+            self.reset()
+            self._clock.start()
+            self._load(Ingredient.objects.all())
+            self._built = True
+
+    def refresh(self):
+        """
+        Reloads the ingredients other processes have changed since the last refresh, once
+        INDEX_REFRESH_INTERVAL has passed, and drops the deleted ones.
+        """
+        with self._lock:
+            since = self._clock.due() if self._built else None
+            if since is None:
+                return
+            deleted = deleted_since(Ingredient, since)
+            if deleted is None:
+                deleted = self._names.keys() - set(Ingredient.objects.values_list("pk", flat=True))
+            for ingredient_id in deleted:
+                self._remove(ingredient_id)
+            self._load(Ingredient.objects.filter(modified_at__gte=since))
+
+    def _ensure_built(self):
+        if self._built:
+            self.refresh()
+        else:
+            self.build()
+
+    def warm_up(self):
+        """
+        Builds the index ahead of its first lookup.
+        """
+        with self._lock:
+            self._ensure_built()
+
+    def _load(self, queryset):
+        for ingredient_id, name in queryset.values_list("pk", "name").iterator(chunk_size=10000):
+            self._set(ingredient_id, name)
+
+    @staticmethod
+    def _keys_of(normalized):
+        words = normalized.split()
+        return [" ".join(words[i:]) for i in range(len(words))]
+
+    def _set(self, ingredient_id, name):
+        self._remove(ingredient_id)
+        normalized = normalize(name)
+        self._names[ingredient_id] = (name, normalized)
+        self._keys[ingredient_id] = self._keys_of(normalized)
+        self._last_id = max(self._last_id, ingredient_id)
+        for key in self._keys[ingredient_id]:
+            node = self._root
+            for char in key:
+                node = node.children.setdefault(char, TrieNode())
+                node.ids.add(ingredient_id)
+                node.top = None
+        name_trigrams = trigrams(normalized)
+        self._trigram_counts[ingredient_id] = len(name_trigrams)
+        for trigram in name_trigrams:
+            self._trigrams[trigram].add(ingredient_id)
+
+    def _remove(self, ingredient_id):
+        if ingredient_id not in self._names:
+            return
+        _, normalized = self._names.pop(ingredient_id)
+        del self._trigram_counts[ingredient_id]
+        for key in self._keys.pop(ingredient_id):
+            path = [self._root]
+            for char in key:
+                node = path[-1].children.get(char)
+                if node is None:
+                    break
+                node.ids.discard(ingredient_id)
+                node.top = None
+                path.append(node)
+            # Prune the nodes no other key passes through
+            for parent, char, node in reversed(list(zip(path, key, path[1:]))):
+                if node.ids:
+                    break
+                del parent.children[char]
+        for trigram in trigrams(normalized):
+            ids = self._trigrams.get(trigram)
+            if ids is not None:
+                ids.discard(ingredient_id)
+                if not ids:
+                    del self._trigrams[trigram]
+
+    def update_ingredient(self, ingredient_id, name):
+        with self._lock:
+            if self._built:
+                self._set(ingredient_id, name)
+
+    def remove_ingredient(self, ingredient_id):
+        with self._lock:
+            if self._built:
+                self._remove(ingredient_id)
+
+    def add_new_ingredients(self):
+        """
+        Loads the ingredients created since the last one indexed, e.g. by bulk_create.
+        """
+        with self._lock:
+            if self._built:
+                self._load(Ingredient.objects.filter(pk__gt=self._last_id))
+
+    def _node(self, prefix):
+        node = self._root
+        for char in prefix:
+            node = node.children.get(char)
+            if node is None:
+                return None
+        return node
+
+    def _top(self, node, prefix, limit):
+        """
+        Returns the best (ingredient_id, recipe_count) matches of the prefix of a trie node.
+        """
+        version = pantry_index.version()
+        if node.top is None or node.top[0] != version:
+            counts = pantry_index.recipe_counts(node.ids)
+
+            def rank(ingredient_id):
+                name, normalized = self._names[ingredient_id]
+                tier = NAME_PREFIX if normalized.startswith(prefix) else WORD_PREFIX
+                return tier, -counts.get(ingredient_id, 0), len(normalized), name
+
+            best = heapq.nsmallest(max(limit, TOP_MATCHES), node.ids, key=rank)
+            node.top = version, [(ingredient_id, counts.get(ingredient_id, 0)) for ingredient_id in best]
+        return node.top[1][:limit]
+
+    def _similar(self, query):
+        """
+        Returns the ids of the names containing enough of the query's trigrams, with their similarity.
+        """
+        query_trigrams = trigrams(query)
+        shared = Counter()
+        for trigram in query_trigrams:
+            shared.update(self._trigrams.get(trigram, ()))
+        total = len(query_trigrams)
+        return {
+            # Jaccard similarity, like pg_trgm's similarity(): extra words count against a name
+            ingredient_id: count / (total + self._trigram_counts[ingredient_id] - count)
+            for ingredient_id, count in shared.items()
+            if count >= MIN_SHARED_TRIGRAMS * total
+        }
+
+    def complete(self, query, limit=10):
+        """
+        Returns the best matches of a partially typed ingredient name.
+
+        Args:
+            query (str): What the user has typed so far.
+            limit (int): The maximum number of matches.
+
+        Returns:
+            list: (ingredient_id, name, recipe_count) tuples, best first.
+        """
+        query = normalize(query)
+        if not query:
+            return []
+        with self._lock:
+            self._ensure_built()
+            node = self._node(query)
+            matches = self._top(node, query, limit) if node is not None else []
+            # Similar names rank below prefix matches, so they're only needed to fill the results
+            if len(query) >= MIN_FUZZY_LENGTH and len(matches) < limit:
+                matched = {ingredient_id for ingredient_id, _ in matches}
+                similar = {
+                    ingredient_id: similarity
+                    for ingredient_id, similarity in self._similar(query).items()
+                    if ingredient_id not in matched
+                }
+                counts = pantry_index.recipe_counts(similar)
+
+                def rank(ingredient_id):
+                    name, normalized = self._names[ingredient_id]
+                    return -similar[ingredient_id], -counts.get(ingredient_id, 0), len(normalized), name
+
+                best = heapq.nsmallest(limit - len(matches), similar, key=rank)
+                matches += [(ingredient_id, counts.get(ingredient_id, 0)) for ingredient_id in best]
+            return [(ingredient_id, self._names[ingredient_id][0], count) for ingredient_id, count in matches]
+
+autocomplete_index = AutocompleteIndex()
@@ -0,0 +1,14 @@
+"""
+Reproducible benchmarks of the API.
+
+* ``data`` seeds the database with synthetic users, ingredients, recipes and comments, from a
+  random seed and at a given scale (``manage.py seed_benchmark_data``).
+* ``scenarios`` describes one request per API endpoint, the router's and djoser's.
+* ``runner`` runs scenarios in process (through Django's test client, counting queries) or over
+  HTTP against a running server, and reports latency percentiles, queries per request and
+  throughput (``manage.py run_benchmarks``). Results are saved as JSON and can be compared with
+  an earlier run.
+
+Run the benchmarks against a database of their own: the generated rows and the scenarios'
+writes stay in it.
+"""
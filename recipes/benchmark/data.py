@@ -0,0 +1,233 @@
+"""
+Seeded generator of synthetic benchmark data.
+
+The same seed and scale always produce the same rows. Ingredient popularity follows a Zipf
+distribution (a few staples like salt are in most recipes, most ingredients in a few) and the
+number of ingredients per recipe a log-normal one around eight; comments are skewed likewise,
+most recipes having none or a few, and so are followers: every user follows about twenty others,
+a few popular users most often. Recipes are written by RecipeImporter, with COPY on
+PostgreSQL, so a generation that is interrupted resumes where it stopped.
+"""
+import math
+import random
+from decimal import Decimal
+from itertools import accumulate
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from recipes.counters import counter_expressions
+from recipes.management.commands.import_recipes import RecipeImporter
+from recipes.feed import rebuild_timeline
+from recipes.models import Comment, Follow, ImportProgress, Ingredient, Profile, Recipe
+
+PREFIX = "bench"
+PASSWORD = "benchmark-pass-123"
+STAFF_USERNAME = f"{PREFIX}-staff"
+UNITS = ["g", "kg", "ml", "l", "tsp", "tbsp", "cup", "pc", None]
+WORDS = [
+    "roasted", "spicy", "creamy", "crispy", "slow-cooked", "grilled", "lemon", "garlic", "smoky",
+    "herbed", "classic", "quick", "rustic", "sweet", "tangy", "baked", "braised", "fresh",
+]
+DISHES = ["soup", "stew", "salad", "pasta", "curry", "tart", "pie", "bowl", "roast", "risotto", "cake"]
+
+
+class DataGenerator:
+    """
+    Generates and writes the benchmark data set for a number of recipes.
+
+    Args:
+        recipes (int): The number of recipes; users, ingredients and comments scale with it.
+        seed (int): The random seed.
+        batch_size (int): Rows written per transaction.
+    """
+
+    def __init__(self, recipes, seed=0, batch_size=1000, stdout=None, stderr=None):
+        self.recipes = recipes
+        self.seed = seed
+        self.batch_size = batch_size
+        self.stdout = stdout
+        self.stderr = stderr
+        self.users = max(recipes // 20, 10)
+        self.ingredients = min(max(recipes // 10, 200), 20000)
+        self.ingredient_names = [f"{PREFIX} ingredient {i}" for i in range(self.ingredients)]
+        # Zipf weights with s = 1.1, by ingredient rank
+        self.ingredient_weights = list(accumulate(1 / (rank ** 1.1) for rank in range(1, self.ingredients + 1)))
+
+    @property
+    def progress_key(self):
+        return f"{PREFIX}:{self.seed}:{self.recipes}"
+
+    def usernames(self):
+        return [f"{PREFIX}-user-{i}" for i in range(self.users)]
+
+    def run(self):
+        """
+        Writes the data set and returns the number of rows written per model.
+        """
+        users = self.create_users()
+        ingredients = self.create_ingredients()
+        importer = GeneratedRecipeImporter(
+            self, path=self.progress_key, fmt="jsonl", batch_size=self.batch_size,
+            stdout=self.stdout, stderr=self.stderr,
+        )
+        recipes, recipe_ingredients, _ = importer.run()
+        comments = self.create_comments()
+        follows = self.create_follows()
+        return {
+            "users": users,
+            "ingredients": ingredients,
+            "recipes": recipes,
+            "recipe_ingredients": recipe_ingredients,
+            "comments": comments,
+            "follows": follows,
+        }
+
+    def create_users(self):
+        User = get_user_model()
+        # Hashing once keeps seeding fast; every generated user has the same password
+        password = make_password(PASSWORD)
+        usernames = [STAFF_USERNAME, *self.usernames()]
+        existing = set(User.objects.filter(username__in=usernames).values_list("username", flat=True))
+        users = [
+            User(
+                username=username, email=f"{username}@example.com", password=password,
+                is_staff=username == STAFF_USERNAME,
+            )
+            for username in usernames
+            if username not in existing
+        ]
+        with transaction.atomic():
+            # bulk_create skips the post_save signal that creates profiles
+            users = User.objects.bulk_create(users, batch_size=self.batch_size)
+            Profile.objects.bulk_create([Profile(user_id=user.pk) for user in users], batch_size=self.batch_size)
+        return len(users)
+
+    def create_ingredients(self):
+        created = Ingredient.objects.bulk_create(
+            [Ingredient(name=name) for name in self.ingredient_names],
+            ignore_conflicts=True, batch_size=self.batch_size,
+        )
+        return len(created)
+
+    def records(self):
+        """
+        Yields the recipes in the format of ``import_recipes``.
+        """
+        rng = random.Random(self.seed)
+        usernames = self.usernames()
+        for i in range(self.recipes):
+            count = min(max(round(rng.lognormvariate(math.log(8), 0.5)), 1), 40)
+            names = set(rng.choices(self.ingredient_names, cum_weights=self.ingredient_weights, k=count))
+            yield {
+                "title": f"{rng.choice(WORDS).title()} {rng.choice(WORDS)} {rng.choice(DISHES)} {i}",
+                "time_minutes": rng.choice([5, 10, 15, 20, 30, 45, 60, 90, 120, 240]),
+                "description": " ".join(rng.choices(WORDS + DISHES, k=rng.randint(10, 60))),
+                # A few prolific authors write most of the recipes
+                "user": usernames[min(int(rng.paretovariate(1.2)) - 1, len(usernames) - 1)],
+                "ingredients": [
+                    {
+                        "name": name,
+                        "amount": Decimal(rng.randint(1, 1000)) / 4,
+                        "unit": rng.choice(UNITS),
+                        "custom_name": None,
+                    }
+                    for name in sorted(names)
+                ],
+            }
+
+    def create_comments(self):
+        """
+        Adds comments to the generated recipes and sets their counters.
+        """
+        rng = random.Random(f"{self.seed}:comments")
+        User = get_user_model()
+        user_ids = list(User.objects.filter(username__in=self.usernames()).order_by("pk").values_list("pk", flat=True))
+        if Comment.objects.filter(user_id__in=user_ids).exists():
+            # Already commented by an earlier run
+            return 0
+        recipe_ids = Recipe.objects.filter(user_id__in=user_ids).order_by("pk").values_list("pk", flat=True)
+        written = 0
+        batch = []
+        for recipe_id in recipe_ids.iterator(chunk_size=self.batch_size):
+            batch.append(recipe_id)
+            if len(batch) >= self.batch_size:
+                written += self.write_comments(rng, batch, user_ids)
+                batch = []
+        return written + self.write_comments(rng, batch, user_ids)
+
+    def write_comments(self, rng, recipe_ids, user_ids):
+        comments = [
+            Comment(recipe_id=recipe_id, user_id=rng.choice(user_ids), comment=" ".join(rng.choices(WORDS, k=8)))
+            for recipe_id in recipe_ids
+            # Many recipes get no comment, a few get dozens
+            for _ in range(min(int(rng.expovariate(0.5) ** 1.5), 50))
+        ]
+        with transaction.atomic():
+            Comment.objects.bulk_create(comments, batch_size=self.batch_size)
+            Recipe.objects.filter(pk__in=recipe_ids).update(**counter_expressions())
+        return len(comments)
+
+    def create_follows(self):
+        """
+        Makes the generated users follow each other, sets their follower counts and builds their
+        feed timelines.
+        """
+        rng = random.Random(f"{self.seed}:follows")
+        User = get_user_model()
+        user_ids = list(User.objects.filter(username__in=self.usernames()).order_by("pk").values_list("pk", flat=True))
+        if Follow.objects.filter(follower_id__in=user_ids).exists():
+            # Already followed by an earlier run
+            return 0
+        # Zipf weights with s = 1, by user rank
+        weights = list(accumulate(1 / rank for rank in range(1, len(user_ids) + 1)))
+        follows = [
+            Follow(follower_id=follower_id, followee_id=followee_id)
+            for follower_id in user_ids
+            for followee_id in set(rng.choices(user_ids, cum_weights=weights, k=20)) - {follower_id}
+        ]
+        followers = Follow.objects.filter(followee_id=OuterRef("user_id")).values("followee_id").annotate(
+            count=Count("pk")
+        )
+        with transaction.atomic():
+            Follow.objects.bulk_create(follows, batch_size=self.batch_size)
+            # bulk_create skips the signals that count followers
+            Profile.objects.filter(user_id__in=user_ids).update(
+                follower_count=Coalesce(Subquery(followers.values("count")), 0)
+            )
+        for user_id in user_ids:
+            rebuild_timeline(user_id)
+        return len(follows)
+
+    def clear(self):
+        """
+        Deletes all generated data, whatever its seed and scale.
+        """
+        User = get_user_model()
+        deleted, _ = User.objects.filter(username__startswith=f"{PREFIX}-").delete()
+        deleted += Ingredient.objects.filter(name__startswith=f"{PREFIX} ingredient ").delete()[0]
+        ImportProgress.objects.filter(key__startswith=f"{PREFIX}:").delete()
+        return deleted
+
+
+class GeneratedRecipeImporter(RecipeImporter):
+    """
+    RecipeImporter that reads the generator's records instead of a file.
+    """
+
+    def __init__(self, generator, **kwargs):
+        super().__init__(**kwargs)
+        self.generator = generator
+        self.key = generator.progress_key
+
+    def records(self, start):
+        # Records before start are still generated, to keep the random sequence
+        for position, record in enumerate(self.generator.records()):
+            if position >= start:
+                yield position, record
+
+    def load(self, raw):
+        return raw
@@ -0,0 +1,259 @@
+"""
+Runs benchmark scenarios and summarizes them.
+
+InProcessClient sends requests through Django's test client, in this process and against the
+configured database, and counts the queries of each request. HTTPClient sends them to a
+running server over one keep-alive connection per worker; query counts aren't known there.
+"""
+import http.client
+import json
+import math
+import platform
+import subprocess
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from urllib.parse import urlencode, urlsplit
+
+import django
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connections
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+PERCENTILES = (50, 95, 99)
+
+
+class BenchmarkResponse:
+    def __init__(self, status, content, queries=None):
+        self.status = status
+        self.content = content
+        self.queries = queries
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class InProcessClient:
+    mode = "in-process"
+    target = None
+
+    def __init__(self):
+        self.client = APIClient()
+
+    def request(self, request):
+        kwargs = {}
+        if request.token:
+            kwargs["HTTP_AUTHORIZATION"] = f"JWT {request.token}"
+        if request.method == "GET":
+            kwargs["data"] = request.data
+        elif request.files:
+            kwargs.update(data={**(request.data or {}), **self.files(request.files)}, format="multipart")
+        elif request.data is not None:
+            kwargs.update(data=request.data, format="json")
+
+        with ExitStack() as stack:
+            captures = [stack.enter_context(CaptureQueriesContext(connection)) for connection in connections.all()]
+            response = getattr(self.client, request.method.lower())(request.path, **kwargs)
+            content = b"".join(response.streaming_content) if response.streaming else response.content
+        return BenchmarkResponse(response.status_code, content, sum(len(capture) for capture in captures))
+
+    @staticmethod
+    def files(files):
+        return {
+            field: SimpleUploadedFile(name, content, content_type=content_type)
+            for field, (name, content, content_type) in files.items()
+        }
+
+    def close(self):
+        connections.close_all()
+
+
+class HTTPClient:
+    mode = "http"
+
+    def __init__(self, base_url):
+        self.target = base_url
+        url = urlsplit(base_url)
+        connection_class = http.client.HTTPSConnection if url.scheme == "https" else http.client.HTTPConnection
+        self.connection = connection_class(url.netloc, timeout=60)
+        self.prefix = url.path.rstrip("/")
+
+    def request(self, request):
+        path = self.prefix + request.path
+        headers = {"Accept": "application/json"}
+        body = None
+        if request.token:
+            headers["Authorization"] = f"JWT {request.token}"
+        if request.method == "GET":
+            if request.data:
+                path += "?" + urlencode(request.data, doseq=True)
+        elif request.files:
+            body, headers["Content-Type"] = self.multipart(request.data or {}, request.files)
+        elif request.data is not None:
+            body = json.dumps(request.data).encode()
+            headers["Content-Type"] = "application/json"
+
+        try:
+            self.connection.request(request.method, path, body, headers)
+            response = self.connection.getresponse()
+        except (http.client.HTTPException, ConnectionError):
+            # The server closed the keep-alive connection; retry once on a new one
+            self.connection.close()
+            self.connection.request(request.method, path, body, headers)
+            response = self.connection.getresponse()
+        return BenchmarkResponse(response.status, response.read())
+
+    @staticmethod
+    def multipart(data, files):
+        boundary = uuid.uuid4().hex
+        parts = []
+        for name, value in data.items():
+            parts.append(
+                f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+            )
+        for name, (filename, content, content_type) in files.items():
+            parts.append(
+                f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                f"Content-Type: {content_type}\r\n\r\n".encode() + content + b"\r\n"
+            )
+        parts.append(f"--{boundary}--\r\n".encode())
+        return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+    def close(self):
+        self.connection.close()
+
+
+def percentile(values, percent):
+    """
+    Returns the nearest-rank percentile of sorted values.
+    """
+    return values[min(max(math.ceil(percent / 100 * len(values)) - 1, 0), len(values) - 1)]
+
+
+def summarize(scenario, timings, wall_seconds):
+    """
+    Summarizes (milliseconds, status, queries) timings into the result of a scenario.
+    """
+    latencies = sorted(milliseconds for milliseconds, _, _ in timings)
+    queries = [count for _, _, count in timings if count is not None]
+    return {
+        "requests": len(timings),
+        "errors": sum(status not in scenario.expect for _, status, _ in timings),
+        "status_codes": {str(status): count for status, count in sorted(Counter(s for _, s, _ in timings).items())},
+        "latency_ms": {
+            "mean": sum(latencies) / len(latencies),
+            **{f"p{percent}": percentile(latencies, percent) for percent in PERCENTILES},
+            "max": latencies[-1],
+        },
+        "queries_per_request": {"mean": sum(queries) / len(queries), "max": max(queries)} if queries else None,
+        "throughput_rps": len(timings) / wall_seconds if wall_seconds else None,
+    }
+
+
+class BenchmarkRunner:
+    """
+    Runs scenarios one after another, each with a number of concurrent workers.
+
+    Args:
+        make_client (callable): Returns a new client; each worker gets its own.
+        context (BenchmarkContext): The shared scenario state, loaded by run().
+        requests (int): Timed requests per scenario.
+        concurrency (int): Worker threads per scenario.
+        warmup (int): Untimed requests per scenario before the timed ones.
+    """
+
+    def __init__(self, make_client, context, requests=100, concurrency=1, warmup=5):
+        self.make_client = make_client
+        self.context = context
+        self.requests = requests
+        self.concurrency = max(concurrency, 1)
+        self.warmup = warmup
+
+    def run(self, scenarios, progress=None):
+        client = self.make_client()
+        self.context.load(client)
+        for _ in range(self.warmup):
+            for scenario in scenarios:
+                client.request(scenario.build(self.context, client))
+
+        results = {}
+        for scenario in scenarios:
+            results[scenario.name] = self.run_scenario(scenario, client)
+            if progress is not None:
+                progress(scenario.name, results[scenario.name])
+        return {**self.metadata(client), "scenarios": results}
+
+    def run_scenario(self, scenario, client):
+        def worker(count, client):
+            timings = []
+            for _ in range(count):
+                request = scenario.build(self.context, client)
+                started = time.perf_counter()
+                response = client.request(request)
+                timings.append(((time.perf_counter() - started) * 1000, response.status, response.queries))
+            return timings
+
+        def pooled_worker(count):
+            client = self.make_client()
+            try:
+                return worker(count, client)
+            finally:
+                client.close()
+
+        started = time.perf_counter()
+        if self.concurrency == 1:
+            # In the calling thread, which may be inside a test's transaction
+            timings = worker(self.requests, client)
+        else:
+            counts = [self.requests // self.concurrency + (i < self.requests % self.concurrency)
+                      for i in range(self.concurrency)]
+            with ThreadPoolExecutor(self.concurrency) as pool:
+                timings = [timing for part in pool.map(pooled_worker, counts) for timing in part]
+        return summarize(scenario, timings, time.perf_counter() - started)
+
+    def metadata(self, client):
+        return {
+            "created_at": timezone.now().isoformat(),
+            "mode": client.mode,
+            "target": client.target,
+            "requests": self.requests,
+            "concurrency": self.concurrency,
+            "seed": self.context.seed,
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            # The server's database is unknown over HTTP
+            "database": connections["default"].vendor if client.target is None else None,
+        }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """
+    Yields (scenario, metric, baseline value, value) for the scenarios in both runs.
+    """
+    for name, result in results["scenarios"].items():
+        before = baseline.get("scenarios", {}).get(name)
+        if before is None:
+            continue
+        for metric in ("p50", "p95", "p99"):
+            yield name, metric, before["latency_ms"][metric], result["latency_ms"][metric]
+        yield name, "throughput_rps", before["throughput_rps"], result["throughput_rps"]
+
+
+def change(before, after):
+    if not before or after is None:
+        return None
+    return (after - before) / before * 100
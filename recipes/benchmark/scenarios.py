@@ -0,0 +1,297 @@
+"""
+One benchmark scenario per API endpoint.
+
+A scenario builds the request it times from a BenchmarkContext, which holds ids sampled from
+the API, JWTs of a generated user and of the generated staff user, and a seeded random
+generator. Scenarios that need something to exist first, like a recipe to delete, create it
+with an untimed request.
+"""
+import io
+import itertools
+import random
+import threading
+import uuid
+from datetime import timedelta
+
+from django.utils import timezone
+from PIL import Image
+
+from .data import DISHES, PASSWORD, PREFIX, STAFF_USERNAME, WORDS
+
+USERNAME = f"{PREFIX}-user-0"
+
+
+class BenchmarkRequest:
+    """
+    A request to time: ``files`` are sent as multipart/form-data together with ``data``,
+    otherwise ``data`` is sent as JSON (or as the query string of a GET).
+    """
+
+    def __init__(self, method, path, data=None, token=None, files=None):
+        self.method = method
+        self.path = path
+        self.data = data
+        self.token = token
+        self.files = files
+
+
+class Scenario:
+    """
+    Args:
+        name (str): Unique name, e.g. "recipes-list".
+        build (callable): Takes the BenchmarkContext and a client, returns a BenchmarkRequest.
+        expect (tuple): The status codes of a successful response.
+        heavy (bool): Whether the scenario only runs when asked for by name.
+    """
+
+    def __init__(self, name, build, expect=(200,), heavy=False):
+        self.name = name
+        self.build = build
+        self.expect = expect
+        self.heavy = heavy
+
+
+class BenchmarkContext:
+    """
+    Shared state of the scenarios of a run; safe to use from several worker threads.
+    """
+
+    def __init__(self, seed=0):
+        self.seed = seed
+        self._lock = threading.Lock()
+        self._counter = itertools.count()
+        # Keeps the names of created rows unique across runs
+        self._run = uuid.uuid4().hex[:8]
+        self.rng = random.Random(seed)
+        self.recipe_ids = []
+        self.ingredient_ids = []
+        self.comments = []
+        self.user_token = self.staff_token = self.refresh_token = None
+        self.own_recipe_id = self.own_comment = None
+        self.image = self.make_image()
+
+    def load(self, client):
+        """
+        Samples ids and logs in through the API with the given client.
+        """
+        self.recipe_ids = [row["id"] for row in self.results(client, "/recipes/", {"page_size": 100})]
+        if not self.recipe_ids:
+            raise ValueError("There are no recipes; seed the database with seed_benchmark_data first")
+        self.ingredient_ids = [row["id"] for row in self.results(client, "/ingredients/", {"page_size": 100})]
+        commented = [row["id"] for row in self.results(client, "/recipes/", {"ordering": "-comment_count"})]
+        for recipe_id in commented[:5]:
+            self.comments += [
+                (recipe_id, row["id"])
+                for row in self.results(client, f"/recipes/{recipe_id}/comments/", {"pagination": "cursor"})
+            ]
+
+        tokens = self.login(client, USERNAME)
+        self.user_token, self.refresh_token = tokens["access"], tokens["refresh"]
+        self.staff_token = self.login(client, STAFF_USERNAME)["access"]
+        self.own_recipe_id = self.create_recipe(client)
+        self.own_comment = (self.recipe_ids[0], self.create_comment(client, self.recipe_ids[0]))
+
+    @staticmethod
+    def results(client, path, params=None):
+        response = client.request(BenchmarkRequest("GET", path, params))
+        if response.status != 200:
+            raise ValueError(f"GET {path} returned {response.status}")
+        return response.json()["results"]
+
+    @staticmethod
+    def login(client, username):
+        response = client.request(
+            BenchmarkRequest("POST", "/auth/jwt/create/", {"username": username, "password": PASSWORD})
+        )
+        if response.status != 200:
+            raise ValueError(f"Can't log in as {username}; seed the database with seed_benchmark_data first")
+        return response.json()
+
+    def create_recipe(self, client):
+        response = client.request(BenchmarkRequest("POST", "/recipes/", self.recipe_data(), self.user_token))
+        return response.json()["id"]
+
+    def create_comment(self, client, recipe_id):
+        response = client.request(BenchmarkRequest(
+            "POST", f"/recipes/{recipe_id}/comments/", {"comment": self.words(8)}, self.user_token
+        ))
+        return response.json()["id"]
+
+    def unique(self, prefix):
+        return f"{prefix}-{self._run}-{next(self._counter)}"
+
+    def choice(self, values):
+        with self._lock:
+            return self.rng.choice(values)
+
+    def sample(self, values, count):
+        with self._lock:
+            return self.rng.sample(values, min(count, len(values)))
+
+    def words(self, count):
+        with self._lock:
+            return " ".join(self.rng.choices(WORDS + DISHES, k=count))
+
+    def recipe_data(self):
+        return {
+            "title": self.unique("Benchmark recipe"),
+            "time_minutes": 30,
+            "description": self.words(20),
+            "ingredients": [
+                {"ingredient": ingredient_id, "amount": "1.50", "unit": "g"}
+                for ingredient_id in self.sample(self.ingredient_ids, 8)
+            ],
+        }
+
+    @staticmethod
+    def make_image():
+        buffer = io.BytesIO()
+        Image.new("RGB", (64, 64), (200, 120, 40)).save(buffer, "PNG")
+        return buffer.getvalue()
+
+
+def get(path, params=None, token=None):
+    return lambda context, client: BenchmarkRequest("GET", path, params, token and getattr(context, token))
+
+
+def pantry(context):
+    return ",".join(map(str, context.sample(context.ingredient_ids, 6)))
+
+
+def recipe_to_delete(context, client):
+    return BenchmarkRequest("DELETE", f"/recipes/{context.create_recipe(client)}/", token=context.user_token)
+
+
+def comment_to_delete(context, client):
+    recipe_id = context.own_comment[0]
+    comment_id = context.create_comment(client, recipe_id)
+    return BenchmarkRequest("DELETE", f"/recipes/{recipe_id}/comments/{comment_id}/", token=context.user_token)
+
+
+def any_comment(context):
+    return context.choice(context.comments or [context.own_comment])
+
+
+SCENARIOS = [
+    # Recipes
+    Scenario("recipes-list", get("/recipes/")),
+    Scenario("recipes-list-cursor", get("/recipes/", {"pagination": "cursor", "page_size": 50})),
+    Scenario("recipes-filter", lambda context, client: BenchmarkRequest(
+        "GET", "/recipes/", {"time_minutes__lte": 30, "ordering": "-comment_count"}
+    )),
+    Scenario("recipes-filter-ingredients", lambda context, client: BenchmarkRequest(
+        "GET", "/recipes/", {
+            "ingredients_all": ",".join(map(str, context.sample(context.ingredient_ids[:10], 2))),
+            "ingredients_none": f"{PREFIX} ingredient 2",
+        }
+    )),
+    Scenario("recipes-filter-ingredient-name", lambda context, client: BenchmarkRequest(
+        "GET", "/recipes/", {"ingredients__ingredient__name__iexact": f"{PREFIX} ingredient {context.choice(range(20))}"}
+    )),
+    Scenario("recipes-search", lambda context, client: BenchmarkRequest(
+        "GET", "/recipes/", {"q": context.words(2)}
+    )),
+    Scenario("recipes-retrieve", lambda context, client: BenchmarkRequest(
+        "GET", f"/recipes/{context.choice(context.recipe_ids)}/"
+    )),
+    Scenario("recipes-pantry-match", lambda context, client: BenchmarkRequest(
+        "GET", "/recipes/pantry-match/", {"ingredients": pantry(context), "max_missing": 2}
+    )),
+    Scenario("recipes-pantry-match-post", lambda context, client: BenchmarkRequest(
+        "POST", "/recipes/pantry-match/", {"ingredients": context.sample(context.ingredient_ids, 6)}
+    )),
+    Scenario("recipes-similar", lambda context, client: BenchmarkRequest(
+        "GET", f"/recipes/{context.choice(context.recipe_ids)}/similar/"
+    )),
+    Scenario("recipes-create", lambda context, client: BenchmarkRequest(
+        "POST", "/recipes/", context.recipe_data(), context.user_token
+    ), expect=(201,)),
+    Scenario("recipes-update", lambda context, client: BenchmarkRequest(
+        "PATCH", f"/recipes/{context.own_recipe_id}/", {"time_minutes": context.choice([10, 20, 30])},
+        context.user_token,
+    )),
+    Scenario("recipes-destroy", recipe_to_delete, expect=(204,)),
+    Scenario("recipes-bulk", lambda context, client: BenchmarkRequest(
+        "POST", "/recipes/bulk/", [context.recipe_data() for _ in range(10)], context.user_token
+    ), expect=(201,)),
+    Scenario("recipes-export", lambda context, client: BenchmarkRequest(
+        "GET", "/recipes/export/", {"modified_since": (timezone.now() - timedelta(hours=1)).isoformat()},
+        context.staff_token,
+    ), heavy=True),
+    Scenario("shopping-list", lambda context, client: BenchmarkRequest(
+        "POST", "/shopping-list/", {
+            "recipes": [{"id": recipe_id, "multiplier": context.choice(["0.5", "1", "2"])}
+                        for recipe_id in context.sample(context.recipe_ids, 100)]
+        }
+    )),
+    # Ingredients
+    Scenario("ingredients-list", get("/ingredients/")),
+    Scenario("ingredients-retrieve", lambda context, client: BenchmarkRequest(
+        "GET", f"/ingredients/{context.choice(context.ingredient_ids)}/"
+    )),
+    Scenario("ingredients-autocomplete", lambda context, client: BenchmarkRequest(
+        "GET", "/ingredients/autocomplete/", {"q": f"{PREFIX} ingredient {context.choice(range(1, 100))}"}
+    )),
+    Scenario("ingredients-create", lambda context, client: BenchmarkRequest(
+        "POST", "/ingredients/", {"name": context.unique(f"{PREFIX} new ingredient")}, context.user_token,
+        files={"image": ("ingredient.png", context.image, "image/png")},
+    ), expect=(201,)),
+    # Comments
+    Scenario("comments-list", lambda context, client: BenchmarkRequest(
+        "GET", f"/recipes/{any_comment(context)[0]}/comments/"
+    )),
+    Scenario("comments-retrieve", lambda context, client: BenchmarkRequest(
+        "GET", "/recipes/{}/comments/{}/".format(*any_comment(context))
+    )),
+    Scenario("comments-create", lambda context, client: BenchmarkRequest(
+        "POST", f"/recipes/{context.choice(context.recipe_ids)}/comments/", {"comment": context.words(8)},
+        context.user_token,
+    ), expect=(201,)),
+    Scenario("comments-update", lambda context, client: BenchmarkRequest(
+        "PATCH", "/recipes/{}/comments/{}/".format(*context.own_comment), {"comment": context.words(8)},
+        context.user_token,
+    )),
+    Scenario("comments-destroy", comment_to_delete, expect=(204,)),
+    # Profiles
+    Scenario("profiles-me", get("/profiles/me/", token="user_token")),
+    Scenario("profiles-me-update", lambda context, client: BenchmarkRequest(
+        "PUT", "/profiles/me/", {"bio": context.words(12)}, context.user_token
+    )),
+    Scenario("profiles-list", get("/profiles/", token="staff_token")),
+    # Feeds
+    Scenario("feed", get("/feed/", token="user_token")),
+    Scenario("following-list", get("/following/", token="user_token")),
+    Scenario("database-stats", get("/stats/database/", token="staff_token")),
+    Scenario("metrics", get("/metrics", token="staff_token")),
+    # djoser
+    Scenario("auth-register", lambda context, client: BenchmarkRequest(
+        "POST", "/auth/users/", {
+            "username": context.unique(f"{PREFIX}-signup"),
+            "email": f"{context.unique('signup')}@example.com",
+            "password": PASSWORD,
+        }
+    ), expect=(201,)),
+    Scenario("auth-me", get("/auth/users/me/", token="user_token")),
+    Scenario("auth-jwt-create", lambda context, client: BenchmarkRequest(
+        "POST", "/auth/jwt/create/", {"username": USERNAME, "password": PASSWORD}
+    )),
+    Scenario("auth-jwt-refresh", lambda context, client: BenchmarkRequest(
+        "POST", "/auth/jwt/refresh/", {"refresh": context.refresh_token}
+    )),
+    Scenario("auth-jwt-verify", lambda context, client: BenchmarkRequest(
+        "POST", "/auth/jwt/verify/", {"token": context.user_token}
+    )),
+]
+
+
+def get_scenarios(names=None):
+    """
+    Returns the scenarios with the given names, or all but the heavy ones.
+    """
+    if not names:
+        return [scenario for scenario in SCENARIOS if not scenario.heavy]
+    by_name = {scenario.name: scenario for scenario in SCENARIOS}
+    unknown = [name for name in names if name not in by_name]
+    if unknown:
+        raise KeyError(", ".join(unknown))
+    return [by_name[name] for name in names]
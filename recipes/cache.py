@@ -0,0 +1,121 @@
+"""
+Per-recipe cache of serialized representations.
+
+Each recipe's serialized dict is stored under its id together with the recipe's ``modified_at``
+and the absolute base URL used for its image links; an entry is only used when both still
+match. List pages are assembled with a single ``get_many`` and only the misses are serialized.
+
+Entries are dropped by the signal handlers in recipes.signals whenever a recipe, one of its
+ingredient rows or an ingredient it uses changes.
+
+The backend is any Django cache alias, set with the RECIPE_FRAGMENT_CACHE setting: the
+local-memory cache works for tests and development, a shared cache (memcached, Redis) in
+production.
+"""
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+class RecipeFragmentCache:
+    """
+    Cache of serialized recipes with hit/miss counters.
+    """
+    key_prefix = "recipes:fragment"
+
+    def __init__(self, alias=None, timeout=None):
+        self.alias = alias
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def cache(self):
+        return caches[self.alias or getattr(settings, "RECIPE_FRAGMENT_CACHE", "default")]
+
+    def get_timeout(self):
+        if self.timeout is not None:
+            return self.timeout
+        return getattr(settings, "RECIPE_FRAGMENT_CACHE_TIMEOUT", 60 * 60)
+
+    def key(self, recipe_id):
+        return f"{self.key_prefix}:{recipe_id}"
+
+    def get_or_build(self, recipes, build, base_uri):
+        """
+        Returns the serialized recipes, in order, serializing only the ones not cached.
+
+        Args:
+            recipes (list): The Recipe instances to serialize.
+            build (callable): Serializes a list of recipes, returning a list of dicts.
+            base_uri (str): The absolute base URL the representation's links are built from.
+
+        Returns:
+            list: The serialized recipes.
+        """
+        keys = {recipe.pk: self.key(recipe.pk) for recipe in recipes}
+        cached = self.cache.get_many(keys.values()) if keys else {}
+        fragments, misses = self.split(recipes, keys, cached, base_uri)
+        if misses:
+            built = build(misses)
+            self.cache.set_many(self.store(fragments, misses, built, keys, base_uri), self.get_timeout())
+        return self.collect(recipes, fragments, misses)
+
+    async def aget_or_build(self, recipes, build, base_uri):
+        """
+        Async version of get_or_build(), where build is a coroutine function.
+        """
+        keys = {recipe.pk: self.key(recipe.pk) for recipe in recipes}
+        cached = await self.cache.aget_many(keys.values()) if keys else {}
+        fragments, misses = self.split(recipes, keys, cached, base_uri)
+        if misses:
+            built = await build(misses)
+            await self.cache.aset_many(self.store(fragments, misses, built, keys, base_uri), self.get_timeout())
+        return self.collect(recipes, fragments, misses)
+
+    def split(self, recipes, keys, cached, base_uri):
+        """
+        Returns the usable cached fragments by recipe id, and the recipes that must be serialized.
+        """
+        fragments = {}
+        misses = []
+        for recipe in recipes:
+            entry = cached.get(keys[recipe.pk])
+            if entry is not None and entry[0] == recipe.modified_at and entry[1] == base_uri:
+                fragments[recipe.pk] = entry[2]
+            else:
+                misses.append(recipe)
+        return fragments, misses
+
+    def store(self, fragments, misses, built, keys, base_uri):
+        """
+        Adds freshly serialized recipes to fragments and returns the cache entries to write.
+        """
+        for recipe, data in zip(misses, built):
+            fragments[recipe.pk] = data
+        return {keys[recipe.pk]: (recipe.modified_at, base_uri, data) for recipe, data in zip(misses, built)}
+
+    def collect(self, recipes, fragments, misses):
+        with self._lock:
+            self.hits += len(recipes) - len(misses)
+            self.misses += len(misses)
+        return [fragments[recipe.pk] for recipe in recipes]
+
+    def invalidate(self, recipe_ids):
+        keys = [self.key(recipe_id) for recipe_id in recipe_ids]
+        if keys:
+            self.cache.delete_many(keys)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+
+recipe_cache = RecipeFragmentCache()
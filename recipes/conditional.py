@@ -0,0 +1,106 @@
+"""
+Conditional GET (ETag / Last-Modified) support for the API viewsets.
+
+Validators are computed from the rows a response is built from, after they are fetched and before
+anything is serialized: the (id, modified_at) of every row of the page, in order, and the
+pagination envelope (count, next and previous links). When the client's ``If-None-Match`` /
+``If-Modified-Since`` still match, a 304 is returned without serializing. Computing them takes no
+query of its own, so keyset pages stay range scans, and objects go through ``get_object()``, with
+its permission checks, before a 304 can be returned.
+
+List responses only carry an ETag: deleting a row doesn't change the latest ``modified_at``, so a
+Last-Modified date alone can't tell that a list changed.
+"""
+import hashlib
+import json
+
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from rest_framework.response import Response
+
+
+class ConditionalGetMixin:
+    """
+    Adds conditional GET handling to a viewset's list and retrieve actions.
+
+    Views serialize their objects in ``serialize``. Views with custom read actions can call
+    ``conditional`` directly.
+    """
+
+    def get_validators(self, objects, detail=True):
+        """
+        Returns (etag, last_modified) for a response built from the given objects.
+
+        Args:
+            objects (list): The objects the response is built from, in order.
+            detail (bool): Whether the response is a single object; only those get a
+                Last-Modified date.
+
+        Returns:
+            tuple: The weak ETag and the last modification datetime (either may be None).
+        """
+        request = self.request
+        renderer = getattr(request, "accepted_renderer", None)
+        parts = [request.build_absolute_uri(), getattr(renderer, "format", ""), str(request.user.pk)]
+        if not detail and getattr(self, "page", None) is not None:
+            # The count and links of the page, without its results
+            parts.append(json.dumps(self.paginator.get_paginated_response([]).data, default=str))
+        parts.extend(f"{obj.pk}:{obj.modified_at.isoformat()}" for obj in objects)
+        etag = 'W/"%s"' % hashlib.md5("|".join(parts).encode(), usedforsecurity=False).hexdigest()
+        last_modified = max((obj.modified_at for obj in objects), default=None) if detail else None
+        return etag, last_modified
+
+    def get_not_modified_response(self, etag, last_modified):
+        if self.request.method not in ("GET", "HEAD") or etag is None:
+            return None
+        timestamp = int(last_modified.timestamp()) if last_modified else None
+        return get_conditional_response(self.request, etag=etag, last_modified=timestamp)
+
+    def set_validators(self, response, etag, last_modified):
+        if etag is not None and response.status_code == 200:
+            response["ETag"] = etag
+            if last_modified is not None:
+                response["Last-Modified"] = http_date(last_modified.timestamp())
+        return response
+
+    def conditional(self, objects, handler, *args, detail=True, **kwargs):
+        """
+        Runs the handler unless the client's cached copy of the response built from the objects is
+        still current.
+        """
+        etag, modified = self.get_validators(objects, detail=detail)
+        not_modified = self.get_not_modified_response(etag, modified)
+        if not_modified is not None:
+            return not_modified
+        return self.set_validators(handler(*args, **kwargs), etag, modified)
+
+    async def aconditional(self, objects, handler, *args, detail=True, **kwargs):
+        """
+        Async version of conditional(), for a coroutine handler.
+        """
+        etag, modified = self.get_validators(objects, detail=detail)
+        not_modified = self.get_not_modified_response(etag, modified)
+        if not_modified is not None:
+            return not_modified
+        return self.set_validators(await handler(*args, **kwargs), etag, modified)
+
+    def serialize(self, objects):
+        """
+        Serializes a list of objects, like ``get_serializer(objects, many=True).data``.
+        """
+        return self.get_serializer(objects, many=True).data
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        self.page = self.paginate_queryset(queryset)
+        objects = self.page if self.page is not None else list(queryset)
+        return self.conditional(objects, self.list_response, objects, detail=False)
+
+    def list_response(self, objects):
+        if self.page is not None:
+            return self.get_paginated_response(self.serialize(objects))
+        return Response(self.serialize(objects))
+
+    def retrieve(self, request, *args, **kwargs):
+        instance = self.get_object()
+        return self.conditional([instance], lambda: Response(self.serialize([instance])[0]))
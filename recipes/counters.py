@@ -0,0 +1,33 @@
+"""
+Expressions computing the denormalized counters of Recipe from the rows they count.
+
+The signal handlers in recipes.signals keep the counters current one change at a time; these
+expressions recompute them from scratch and are used to repair drift (reconcile_recipe_counters).
+"""
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from .models import Comment, RecipeIngredient
+
+COUNTER_FIELDS = ["ingredient_count", "comment_count", "latest_comment_at"]
+
+
+def count_subquery(queryset):
+    counts = queryset.order_by().values("recipe_id").annotate(count=Count("pk")).values("count")
+    return Coalesce(Subquery(counts, output_field=IntegerField()), 0)
+
+
+def latest_comment_subquery():
+    latest = Comment.objects.filter(recipe_id=OuterRef("pk")).order_by("-created_at").values("created_at")[:1]
+    return Subquery(latest)
+
+
+def counter_expressions():
+    """
+    Returns {counter field: expression} for use in ``Recipe.objects.update()`` or ``annotate()``.
+    """
+    return {
+        "ingredient_count": count_subquery(RecipeIngredient.objects.filter(recipe_id=OuterRef("pk"))),
+        "comment_count": count_subquery(Comment.objects.filter(recipe_id=OuterRef("pk"))),
+        "latest_comment_at": latest_comment_subquery(),
+    }
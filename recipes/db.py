@@ -0,0 +1,274 @@
+"""
+Database connection reuse and per-view statement time budgets.
+
+Connections are persistent (CONN_MAX_AGE) and health-checked (CONN_HEALTH_CHECKS): each worker
+thread keeps its connection between requests, so the thread pool is the connection pool. Put
+PgBouncer in front of PostgreSQL when several processes must share a bounded pool. The first
+query of a request checks the default connection out, which reuses, re-checks or opens it;
+DatabaseStats records how long that took, how many connections were opened and how many are in
+use. Requests that run no query don't touch the connection.
+
+StatementBudgetMixin gives every statement a viewset runs a time limit, set per viewset and per
+action. On PostgreSQL the limit is a transaction-local ``statement_timeout`` (SET LOCAL), so it
+never outlives the transaction, also when PgBouncer hands the server connection to another client
+after it; a budgeted statement outside a transaction gets one of its own. On SQLite a progress
+handler interrupts statements past their deadline. A statement that runs out of time fails the
+request with a 503 (StatementTimeout) and is counted per view action.
+"""
+import threading
+import time
+from collections import defaultdict
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.signals import request_finished, request_started
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, OperationalError, connections, transaction
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+# SQLSTATE of a statement cancelled by statement_timeout
+QUERY_CANCELED = "57014"
+# SQLite VM instructions between two deadline checks
+PROGRESS_INTERVAL = 1000
+# Transaction status of a connection outside a transaction, in psycopg2 and psycopg 3 alike
+TRANSACTION_IDLE = 0
+
+_statement_budget = ContextVar("statement_budget", default=None)
+
+
+class StatementTimeout(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "The request took too long to process. Narrow it down or try again later."
+    default_code = "statement_timeout"
+
+
+class DatabaseStats:
+    """
+    Counters of connection checkouts and statement timeouts, per database alias.
+
+    ``in_use`` counts the requests that have checked a connection out and not finished yet.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.opened = defaultdict(int)
+            self.checkouts = defaultdict(int)
+            self.reused = defaultdict(int)
+            self.failed = defaultdict(int)
+            self.in_use = defaultdict(int)
+            self.wait_seconds = defaultdict(float)
+            self.max_wait_seconds = defaultdict(float)
+            self.statement_timeouts = defaultdict(int)
+
+    def connection_opened(self, alias):
+        with self._lock:
+            self.opened[alias] += 1
+
+    def checked_out(self, alias, seconds, reused, failed=False):
+        with self._lock:
+            self.checkouts[alias] += 1
+            self.reused[alias] += reused
+            self.failed[alias] += failed
+            self.in_use[alias] += 1
+            self.wait_seconds[alias] += seconds
+            self.max_wait_seconds[alias] = max(self.max_wait_seconds[alias], seconds)
+
+    def released(self, alias):
+        with self._lock:
+            self.in_use[alias] = max(self.in_use[alias] - 1, 0)
+
+    def statement_timed_out(self, label):
+        with self._lock:
+            self.statement_timeouts[label] += 1
+
+    def snapshot(self):
+        """
+        Returns the counters as plain dicts: ``{"connections": {alias: {...}}, "statement_timeouts": {...}}``.
+        """
+        with self._lock:
+            aliases = sorted({*self.opened, *self.checkouts})
+            return {
+                "connections": {
+                    alias: {
+                        "opened": self.opened[alias],
+                        "checkouts": self.checkouts[alias],
+                        "reused": self.reused[alias],
+                        "failed": self.failed[alias],
+                        "in_use": self.in_use[alias],
+                        "wait_seconds": self.wait_seconds[alias],
+                        "max_wait_seconds": self.max_wait_seconds[alias],
+                    }
+                    for alias in aliases
+                },
+                "statement_timeouts": dict(self.statement_timeouts),
+            }
+
+
+db_stats = DatabaseStats()
+
+
+@receiver(connection_created)
+def prepare_connection(sender, connection, **kwargs):
+    db_stats.connection_opened(connection.alias)
+    connection.budget_statement_timeout = None
+    if statement_guard not in connection.execute_wrappers:
+        connection.execute_wrappers.append(statement_guard)
+
+
+@receiver(request_started)
+def check_out_connection(sender, **kwargs):
+    # Runs in the thread that runs the request's queries, under WSGI and ASGI alike. Nothing is
+    # opened here: the checkout is measured when the first query ensures the connection.
+    connection = connections[DEFAULT_DB_ALIAS]
+    if "ensure_connection" not in vars(connection):
+        ensure_connection = connection.ensure_connection
+        connection.ensure_connection = lambda: timed_ensure_connection(connection, ensure_connection)
+    connection.checkout_pending = True
+    connection.checked_out = False
+
+
+def timed_ensure_connection(connection, ensure_connection):
+    if not getattr(connection, "checkout_pending", False):
+        return ensure_connection()
+    connection.checkout_pending = False
+    connection.checked_out = True
+    # The health check, if due, has already closed a broken connection
+    reused = connection.connection is not None
+    started = time.monotonic()
+    try:
+        ensure_connection()
+    except DatabaseError:
+        db_stats.checked_out(connection.alias, time.monotonic() - started, reused=False, failed=True)
+        raise
+    db_stats.checked_out(connection.alias, time.monotonic() - started, reused)
+
+
+@receiver(request_finished)
+def release_connection(sender, **kwargs):
+    connection = connections[DEFAULT_DB_ALIAS]
+    connection.checkout_pending = False
+    if getattr(connection, "checked_out", False):
+        connection.checked_out = False
+        db_stats.released(DEFAULT_DB_ALIAS)
+
+
+class StatementBudget:
+    """
+    The time limit of each statement run while a view handles a request.
+    """
+
+    def __init__(self, milliseconds, label):
+        self.milliseconds = milliseconds
+        self.label = label
+
+
+def statement_guard(execute, sql, params, many, context):
+    """
+    Execute wrapper that enforces the current statement budget (see StatementBudgetMixin).
+    """
+    connection = context["connection"]
+    budget = _statement_budget.get()
+    milliseconds = budget.milliseconds if budget is not None else None
+    if connection.vendor == "postgresql":
+        if milliseconds is not None and connection.get_autocommit():
+            # The timeout is local to a transaction: give the statement one
+            with transaction.atomic(using=connection.alias):
+                return statement_guard(execute, sql, params, many, context)
+        set_local_statement_timeout(connection, context["cursor"].cursor, milliseconds)
+    if milliseconds is None:
+        return execute(sql, params, many, context)
+
+    sqlite = connection.vendor == "sqlite"
+    if sqlite:
+        deadline = time.monotonic() + milliseconds / 1000
+        connection.connection.set_progress_handler(lambda: time.monotonic() > deadline, PROGRESS_INTERVAL)
+    try:
+        return execute(sql, params, many, context)
+    except OperationalError as exc:
+        if not is_timeout(connection, exc):
+            raise
+        db_stats.statement_timed_out(budget.label)
+        raise StatementTimeout from exc
+    finally:
+        if sqlite:
+            connection.connection.set_progress_handler(None, 0)
+
+
+def set_local_statement_timeout(connection, cursor, milliseconds):
+    """
+    Sets statement_timeout for the rest of the current transaction, once per transaction and budget.
+    """
+    if connection.connection.info.transaction_status == TRANSACTION_IDLE:
+        # The statement starts a new transaction, which has the server's default timeout
+        connection.budget_statement_timeout = None
+    if connection.budget_statement_timeout == milliseconds:
+        return
+    connection.budget_statement_timeout = milliseconds
+    if milliseconds is None:
+        cursor.execute("SET LOCAL statement_timeout TO DEFAULT")
+    else:
+        cursor.execute("SELECT set_config('statement_timeout', %s, true)", [str(milliseconds)])
+
+
+def is_timeout(connection, exc):
+    cause = exc.__cause__
+    if connection.vendor == "postgresql":
+        # psycopg2 names the code pgcode, psycopg 3 sqlstate
+        return QUERY_CANCELED in (getattr(cause, "pgcode", None), getattr(cause, "sqlstate", None))
+    if connection.vendor == "sqlite":
+        return str(cause) == "interrupted"
+    return False
+
+
+class StatementBudgetMixin:
+    """
+    Limits how long each statement of a viewset's actions may run.
+
+    ``statement_timeout`` is the limit in milliseconds for the viewset (DB_STATEMENT_TIMEOUT by
+    default) and ``statement_timeouts`` maps actions to their own limits; None means no limit.
+    """
+    statement_timeout = None
+    statement_timeouts = {}
+
+    def get_statement_timeout(self):
+        if self.action in self.statement_timeouts:
+            return self.statement_timeouts[self.action]
+        if self.statement_timeout is not None:
+            return self.statement_timeout
+        return getattr(settings, "DB_STATEMENT_TIMEOUT", None)
+
+    def get_statement_budget(self):
+        milliseconds = self.get_statement_timeout()
+        if milliseconds is None:
+            return None
+        return StatementBudget(milliseconds, f"{self.__class__.__name__}.{self.action}")
+
+    def initialize_request(self, request, *args, **kwargs):
+        request = super().initialize_request(request, *args, **kwargs)
+        # The viewset's action is known from here on
+        self._statement_budget_token = _statement_budget.set(self.get_statement_budget())
+        return request
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            self.end_statement_budget()
+
+    async def adispatch(self, request, *args, **kwargs):
+        try:
+            return await super().adispatch(request, *args, **kwargs)
+        finally:
+            self.end_statement_budget()
+
+    def end_statement_budget(self):
+        token = getattr(self, "_statement_budget_token", None)
+        if token is not None:
+            _statement_budget.reset(token)
+            self._statement_budget_token = None
@@ -0,0 +1,63 @@
+"""
+Query plans: which tables a query reads in full, without an index.
+
+- On PostgreSQL, the "Seq Scan" nodes of ``EXPLAIN (FORMAT JSON)``. Sequential scans are turned
+  off for the EXPLAIN, so that the small tables of a test database still show whether an index
+  could serve the query, as it would on large tables.
+- On SQLite, the ``SCAN`` steps of ``EXPLAIN QUERY PLAN`` that use no index. Without ANALYZE
+  statistics SQLite plans for large tables anyway.
+
+A scan in the order of an index counts as using it: with a LIMIT, as when paginating, it stops
+early.
+"""
+import json
+import re
+
+from django.db import DEFAULT_DB_ALIAS, NotSupportedError, connections
+
+# Table aliases of Django's subqueries and joins, e.g. "recipes_recipeingredient" U0
+ALIAS_RE = re.compile(r'"(\w+)" (?:AS )?"?([A-Z]\d+)\b')
+SCAN_RE = re.compile(r"^SCAN (?:TABLE )?(\w+)(?: AS (\w+))?(.*)$")
+
+
+def sequential_scans(sql, params=(), using=DEFAULT_DB_ALIAS):
+    """
+    Returns the names of the tables a query scans without an index.
+
+    Args:
+        sql (str): A SELECT statement.
+        params (sequence): Its parameters.
+        using (str): The database alias to explain the query on.
+
+    Returns:
+        set: Table names.
+    """
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            cursor.execute("SET enable_seqscan = off")
+            try:
+                cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+                plan = cursor.fetchone()[0]
+            finally:
+                cursor.execute("RESET enable_seqscan")
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            return set(postgres_seq_scans(plan[0]["Plan"]))
+        if connection.vendor == "sqlite":
+            cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+            aliases = {alias: table for table, alias in ALIAS_RE.findall(sql)}
+            tables = set()
+            for *_, detail in cursor.fetchall():
+                match = SCAN_RE.match(detail)
+                if match and "USING" not in match.group(3):
+                    tables.add(aliases.get(match.group(1), match.group(1)))
+            return tables
+    raise NotSupportedError(f"Query plans aren't read on {connection.vendor}")
+
+
+def postgres_seq_scans(node):
+    if node["Node Type"] == "Seq Scan":
+        yield node["Relation Name"]
+    for child in node.get("Plans", ()):
+        yield from postgres_seq_scans(child)
@@ -0,0 +1,113 @@
+"""
+Streaming NDJSON export of the recipe catalog.
+
+Recipes are walked in primary key order with ``QuerySet.iterator()`` (a server-side cursor on
+PostgreSQL) and their ingredients are fetched with one query per chunk of recipes, so memory
+use stays constant whatever the catalog size. Each recipe is written as one JSON line in the
+format read by the import_recipes command.
+
+The body of a streaming response is iterated after the view has returned, once the view has
+reset the context variables it set: its statement budget (recipes.db) and replica routing
+(recipes.replicas). The export view wraps the stream in iter_in_context so that its queries still
+run under them.
+"""
+import contextvars
+import json
+import zlib
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .models import Recipe, RecipeIngredient
+
+RECIPE_FIELDS = ["id", "user_id", "user__username", "title", "time_minutes", "description", "image",
+                 "created_at", "modified_at"]
+INGREDIENT_FIELDS = ["recipe_id", "ingredient_id", "ingredient__name", "amount", "unit", "custom_name",
+                     "custom_image"]
+
+
+def media_url(model, field, name):
+    """
+    Returns the URL of a file stored in a model field, through the field's storage.
+    """
+    return model._meta.get_field(field).storage.url(name) if name else None
+
+
+def iter_recipes(modified_since=None, chunk_size=1000):
+    """
+    Yields recipes as dicts, with their ingredients, in primary key order.
+
+    Args:
+        modified_since (datetime): Only export recipes modified at or after this time (optional).
+        chunk_size (int): The number of recipes fetched per round trip.
+    """
+    recipes = Recipe.objects.order_by("pk")
+    if modified_since is not None:
+        recipes = recipes.filter(modified_at__gte=modified_since)
+
+    chunk = []
+    for recipe in recipes.values(*RECIPE_FIELDS).iterator(chunk_size=chunk_size):
+        chunk.append(recipe)
+        if len(chunk) >= chunk_size:
+            yield from with_ingredients(chunk)
+            chunk = []
+    yield from with_ingredients(chunk)
+
+
+def with_ingredients(chunk):
+    if not chunk:
+        return
+    ingredients = {recipe["id"]: [] for recipe in chunk}
+    rows = RecipeIngredient.objects.filter(recipe_id__in=ingredients).order_by("pk").values(*INGREDIENT_FIELDS)
+    for row in rows:
+        ingredients[row["recipe_id"]].append({
+            "ingredient_id": row["ingredient_id"],
+            "name": row["ingredient__name"],
+            "amount": row["amount"],
+            "unit": row["unit"],
+            "custom_name": row["custom_name"],
+            "custom_image": media_url(RecipeIngredient, "custom_image", row["custom_image"]),
+        })
+    for recipe in chunk:
+        yield {
+            "id": recipe["id"],
+            "user_id": recipe["user_id"],
+            "user": recipe["user__username"],
+            "title": recipe["title"],
+            "time_minutes": recipe["time_minutes"],
+            "description": recipe["description"],
+            "image": media_url(Recipe, "image", recipe["image"]),
+            "created_at": recipe["created_at"],
+            "modified_at": recipe["modified_at"],
+            "ingredients": ingredients[recipe["id"]],
+        }
+
+
+def iter_ndjson(modified_since=None, chunk_size=1000):
+    """
+    Yields the export as encoded NDJSON lines.
+    """
+    encoder = DjangoJSONEncoder(separators=(",", ":"))
+    for recipe in iter_recipes(modified_since, chunk_size):
+        yield (encoder.encode(recipe) + "\n").encode()
+
+
+def iter_gzip(chunks, level=6):
+    """
+    Compresses a stream of byte chunks into a gzip stream.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def iter_in_context(chunks):
+    """
+    Returns an iterator over chunks that runs each step in a copy of the current context.
+    """
+    context = contextvars.copy_context()
+    chunks = iter(chunks)
+    done = object()
+    return iter(lambda: context.run(next, chunks, done), done)
@@ -0,0 +1,289 @@
+"""
+Read-only fast path for RecipeSerializer.
+
+DRF serializers copy their fields for every serializer instance, dispatch every value through a
+field object and, for file fields, call ``request.build_absolute_uri`` once per file. On the
+recipe list that dominates the CPU time of a request. The serializers here produce exactly the
+same output (the JSON is byte-identical) from plain ``.values()`` rows:
+
+* the field plan of each class (which column feeds which key, and how it is converted) is
+  compiled once from the DRF serializer it mirrors and cached on the class;
+* media URLs are built by a MediaURLs helper that resolves each storage's absolute base URL
+  once per request;
+* the ingredients of all recipes are read with one ``.values()`` query.
+
+Fields of the mirrored serializer that can't be derived from a column (SerializerMethodField,
+nested serializers) are read from a ``get_<field name>(row)`` method of the fast serializer,
+like DRF's SerializerMethodField. The views use the fast path unless FAST_READ_SERIALIZERS is
+False; it is never used for writes.
+"""
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.storage import FileSystemStorage
+from django.utils.encoding import filepath_to_uri
+from rest_framework import fields, relations, serializers
+
+from .images import FORMATS, derivative_name, derivative_storage, get_sizes, ready_field
+from .models import Recipe, RecipeIngredient
+from .serializers import ImageVariantsField, RecipeIngredientSimpleSerializer, RecipeSerializer
+
+# Fields whose representation of a database value is the value itself
+PASSTHROUGH_FIELDS = (fields.IntegerField, fields.CharField, fields.BooleanField)
+
+
+def fast_serializers_enabled():
+    return getattr(settings, "FAST_READ_SERIALIZERS", True)
+
+
+class MediaURLs:
+    """
+    Builds the (absolute, when there is a request) URLs of stored files for one request.
+
+    For file system storages the URL is the storage's base URL followed by the quoted name, which
+    is what ``request.build_absolute_uri(storage.url(name))`` returns; the absolute base URL is
+    computed once per storage. Other storages fall back to that call.
+    """
+
+    def __init__(self, request=None):
+        self.request = request
+        self._bases = {}
+
+    def base(self, storage):
+        key = id(storage)
+        if key not in self._bases:
+            base = None
+            if isinstance(storage, FileSystemStorage):
+                base = storage.base_url
+                if self.request is not None:
+                    base = self.request.build_absolute_uri(base)
+            self._bases[key] = base
+        return self._bases[key]
+
+    def url(self, storage, name):
+        if not name:
+            return None
+        base = self.base(storage)
+        if base is not None:
+            return base + filepath_to_uri(name).lstrip("/")
+        url = storage.url(name)
+        return self.request.build_absolute_uri(url) if self.request is not None else url
+
+    def variants(self, storage, name, ready):
+        """
+        Returns the same {size: {format: url}} as serializers.image_variant_urls, for an image kept
+        in the given storage whose derivatives_ready flag is ready.
+        """
+        if not name or not ready:
+            return None
+        storage = derivative_storage(storage)
+        if self.base(storage) is None:
+            return {
+                size: {extension: self.url(storage, derivative_name(name, size, extension))
+                       for extension in FORMATS}
+                for size in get_sizes()
+            }
+        # derivative_name() only appends URL-safe characters to the original name
+        prefix = self.url(storage, derivative_name(name, "", ""))[:-1]
+        return {
+            size: {extension: f"{prefix}{size}.{extension}" for extension in FORMATS}
+            for size in get_sizes()
+        }
+
+
+class FastSerializer:
+    """
+    Base class of the read-only fast serializers.
+
+    Attributes:
+        serializer_class (type): The DRF serializer whose output is reproduced.
+        model (type): The model the rows are read from.
+    """
+    serializer_class = None
+    model = None
+
+    def __init__(self, context=None, media=None):
+        self.context = context or {}
+        self.media = media or MediaURLs(self.context.get("request"))
+        self.fields = [(key, column, convert(self)) for key, column, convert in self.get_plan()]
+
+    @classmethod
+    def get_plan(cls):
+        """
+        Returns the cached field plan of the class: a list of (key, column, converter factory).
+        """
+        plan = cls.__dict__.get("_plan")
+        if plan is None:
+            plan = cls._plan = cls.compile_plan()
+        return plan
+
+    @classmethod
+    def compile_plan(cls):
+        plan = []
+        # Columns read by the converters that get the whole row
+        cls._row_columns = []
+        for key, field in cls.serializer_class().fields.items():
+            if field.write_only:
+                continue
+            if hasattr(cls, f"get_{key}"):
+                plan.append((key, None, lambda self, key=key: getattr(self, f"get_{key}")))
+            elif isinstance(field, ImageVariantsField):
+                storage = cls.model._meta.get_field(field.source).storage
+                columns = (field.source, ready_field(field.source))
+                cls._row_columns.extend(columns)
+                plan.append((
+                    key, None, lambda self, storage=storage, columns=columns: self.image_variants(storage, *columns)
+                ))
+            elif isinstance(field, fields.FileField):
+                storage = cls.model._meta.get_field(field.source).storage
+                plan.append((key, field.source, lambda self, storage=storage: self.file_url(storage)))
+            elif isinstance(field, relations.PrimaryKeyRelatedField):
+                plan.append((key, cls.model._meta.get_field(field.source).attname, lambda self: None))
+            elif isinstance(field, PASSTHROUGH_FIELDS):
+                plan.append((key, field.source, lambda self: None))
+            elif isinstance(field, fields.Field) and not isinstance(
+                field, (serializers.BaseSerializer, fields.SerializerMethodField, relations.RelatedField)
+            ):
+                plan.append((key, field.source, lambda self, field=field: field.to_representation))
+            else:
+                raise ImproperlyConfigured(
+                    f"{cls.__name__} can't serialize {cls.serializer_class.__name__}.{key}; "
+                    f"add a get_{key}(row) method."
+                )
+        return plan
+
+    @classmethod
+    def get_columns(cls):
+        columns = [column for _, column, _ in cls.get_plan() if column is not None]
+        return columns + [column for column in cls._row_columns if column not in columns]
+
+    # Instance rows hold FieldFiles, .values() rows the file names
+    def file_url(self, storage):
+        media = self.media
+        return lambda value: media.url(storage, getattr(value, "name", value))
+
+    def image_variants(self, storage, name_column, ready_column):
+        media = self.media
+        return lambda row: media.variants(
+            storage, getattr(row[name_column], "name", row[name_column]), row[ready_column]
+        )
+
+    def to_representation(self, row):
+        data = {}
+        for key, column, convert in self.fields:
+            if column is None:
+                data[key] = convert(row)
+                continue
+            value = row[column]
+            if value is None:
+                data[key] = None
+            elif convert is None:
+                data[key] = value
+            else:
+                data[key] = convert(value)
+        return data
+
+    @classmethod
+    def instance_row(cls, instance, columns):
+        """
+        Returns the given columns of a model instance as a dict, like a ``.values()`` row.
+        """
+        loaded = instance.__dict__
+        return {column: loaded[column] if column in loaded else getattr(instance, column) for column in columns}
+
+
+class FastRecipeIngredientSerializer(FastSerializer):
+    """
+    Fast equivalent of RecipeIngredientSimpleSerializer.
+    """
+    serializer_class = RecipeIngredientSimpleSerializer
+    model = RecipeIngredient
+    columns = ["id", "recipe_id", "amount", "unit", "custom_name", "custom_image",
+               "custom_image_derivatives_ready", "ingredient__name", "ingredient__image",
+               "ingredient__image_derivatives_ready"]
+
+    def __init__(self, context=None, media=None):
+        super().__init__(context, media)
+        self.storage = RecipeIngredient._meta.get_field("custom_image").storage
+
+    @staticmethod
+    def image_name(row):
+        return row["custom_image"] or row["ingredient__image"]
+
+    def get_name(self, row):
+        return row["custom_name"] if row["custom_name"] is not None else row["ingredient__name"]
+
+    def get_image(self, row):
+        return self.media.url(self.storage, self.image_name(row))
+
+    def get_image_variants(self, row):
+        if row["custom_image"]:
+            return self.media.variants(self.storage, row["custom_image"], row["custom_image_derivatives_ready"])
+        return self.media.variants(self.storage, row["ingredient__image"], row["ingredient__image_derivatives_ready"])
+
+
+class FastRecipeSerializer(FastSerializer):
+    """
+    Fast equivalent of RecipeSerializer for reading many recipes.
+
+    Example:
+        data = FastRecipeSerializer(context={"request": request}).serialize(recipes)
+    """
+    serializer_class = RecipeSerializer
+    model = Recipe
+
+    def __init__(self, context=None, media=None):
+        super().__init__(context, media)
+        self.ingredient_serializer = FastRecipeIngredientSerializer(self.context, self.media)
+        self.ingredients = {}
+
+    def get_ingredients(self, row):
+        return self.ingredients.get(row["id"], [])
+
+    def get_ingredient_rows(self, recipe_ids):
+        self.ingredients = {recipe_id: [] for recipe_id in recipe_ids}
+        return (
+            RecipeIngredient.objects.filter(recipe_id__in=recipe_ids)
+            .order_by("pk")
+            .values(*FastRecipeIngredientSerializer.columns)
+        )
+
+    def add_ingredient(self, row):
+        self.ingredients[row["recipe_id"]].append(self.ingredient_serializer.to_representation(row))
+
+    def get_recipe_rows(self, recipes):
+        columns = self.get_columns()
+        return [
+            recipe if isinstance(recipe, dict) else self.instance_row(recipe, columns)
+            for recipe in recipes
+        ]
+
+    def serialize(self, recipes):
+        """
+        Serializes recipes, given as model instances or ``.values()`` rows, in order.
+
+        Args:
+            recipes (iterable): Recipe instances, or dicts with the columns of get_columns().
+
+        Returns:
+            list: The same dicts as ``RecipeSerializer(recipes, many=True).data``.
+        """
+        rows = self.get_recipe_rows(recipes)
+        if not rows:
+            return []
+        for row in self.get_ingredient_rows([row["id"] for row in rows]):
+            self.add_ingredient(row)
+        return [self.to_representation(row) for row in rows]
+
+    async def aserialize(self, recipes):
+        """
+        Async version of serialize(); the ingredients are fetched with the async ORM.
+        """
+        rows = self.get_recipe_rows(recipes)
+        if not rows:
+            return []
+        async for row in self.get_ingredient_rows([row["id"] for row in rows]):
+            self.add_ingredient(row)
+        return [self.to_representation(row) for row in rows]
+
+    def serialize_queryset(self, queryset):
+        return self.serialize(queryset.values(*self.get_columns()))
@@ -0,0 +1,257 @@
+"""
+Home feeds: the recipes of the cooks a user follows, newest first.
+
+Feeds are precomputed timelines (fan-out on write). When a recipe is created, a background job
+adds a TimelineEntry for it to the timeline of every follower of its author, FEED_FANOUT_BATCH_SIZE
+followers per query, and trims those timelines to about their FEED_TIMELINE_LENGTH newest entries.
+Reading a feed is then a range scan of one timeline's index, instead of a query over the recipes
+of everyone the user follows.
+
+Pushing a recipe of an author with FEED_FANOUT_MAX_FOLLOWERS followers or more would write as
+many rows. Once an author reaches that many followers their profile is switched to
+``fan_out_on_read``, for good, and their recipes are no longer pushed: they are merged into the
+feeds of their followers when these are read, from the (user, created_at) index of Recipe.
+
+Following someone copies their latest recipes into the follower's timeline, and unfollowing
+removes them, both in the background. Since a push can still land after an unfollow, feeds only
+show the timeline entries of authors the user follows. The rebuild_timelines command recomputes timelines from the follow
+graph, e.g. after a job failed.
+
+Jobs run in a thread pool once the transaction that created the recipe or the follow has
+committed (or inline when FEED_FANOUT_ASYNC is False, e.g. in tests).
+"""
+import heapq
+import logging
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import close_old_connections
+from django.db.models import Exists, OuterRef, Q, Subquery
+
+from .models import Follow, Profile, Recipe, TimelineEntry
+
+logger = logging.getLogger(__name__)
+
+
+def timeline_length():
+    return getattr(settings, "FEED_TIMELINE_LENGTH", 500)
+
+
+def batch_size():
+    return getattr(settings, "FEED_FANOUT_BATCH_SIZE", 1000)
+
+
+def push(user_ids, recipes):
+    """
+    Adds recipes to the timelines of users, then trims these timelines.
+
+    Args:
+        user_ids (list): The ids of the users.
+        recipes (list): (recipe_id, created_at) pairs.
+    """
+    entries = [
+        TimelineEntry(user_id=user_id, recipe_id=recipe_id, created_at=created_at)
+        for user_id in user_ids
+        for recipe_id, created_at in recipes
+    ]
+    TimelineEntry.objects.bulk_create(entries, batch_size=batch_size(), ignore_conflicts=True)
+    trim(user_ids)
+
+
+def trim(user_ids):
+    """
+    Trims the timelines of users that have grown past FEED_TIMELINE_LENGTH by a tenth or more back
+    to their FEED_TIMELINE_LENGTH newest entries.
+
+    Finding these timelines is one index seek per user; the slack means a full timeline is trimmed
+    once every so many pushes, not on every push.
+    """
+    length = timeline_length()
+    entries = TimelineEntry.objects.filter(user_id=OuterRef("pk")).order_by("-created_at", "-recipe_id")
+    # The newest entry past the cap, the first to delete
+    over = (
+        get_user_model().objects.filter(pk__in=user_ids)
+        .annotate(
+            overflowing=Exists(entries[length + length // 10:length + length // 10 + 1]),
+            cut_at=Subquery(entries.values("created_at")[length:length + 1]),
+            cut_recipe=Subquery(entries.values("recipe_id")[length:length + 1]),
+        )
+        .filter(overflowing=True)
+        .values_list("pk", "cut_at", "cut_recipe")
+    )
+    condition = Q()
+    for user_id, created_at, recipe_id in over:
+        condition |= Q(user_id=user_id) & (
+            Q(created_at__lt=created_at) | Q(created_at=created_at, recipe_id__lte=recipe_id)
+        )
+    if condition:
+        TimelineEntry.objects.filter(condition).delete()
+
+
+def followers(user_id):
+    """
+    Yields the ids of the followers of a user in lists of FEED_FANOUT_BATCH_SIZE, walking the
+    (followee, follower) index.
+    """
+    last = 0
+    while True:
+        batch = list(
+            Follow.objects.filter(followee_id=user_id, follower_id__gt=last)
+            .order_by("follower_id")
+            .values_list("follower_id", flat=True)[:batch_size()]
+        )
+        if not batch:
+            return
+        yield batch
+        last = batch[-1]
+
+
+def pushes_to_followers(user_id):
+    """
+    Returns whether the recipes of a user are pushed to their followers' timelines, switching the
+    user to fan-out on read when they have reached FEED_FANOUT_MAX_FOLLOWERS followers.
+    """
+    profile = Profile.objects.filter(user_id=user_id).values("follower_count", "fan_out_on_read").first()
+    if profile is None:
+        return True
+    if profile["fan_out_on_read"]:
+        return False
+    if profile["follower_count"] < getattr(settings, "FEED_FANOUT_MAX_FOLLOWERS", 10000):
+        return True
+    Profile.objects.filter(user_id=user_id).update(fan_out_on_read=True)
+    return False
+
+
+def fan_out(recipe_ids):
+    """
+    Pushes new recipes to the timelines of their authors' followers.
+    """
+    by_author = defaultdict(list)
+    for recipe_id, author_id, created_at in Recipe.objects.filter(pk__in=recipe_ids).values_list(
+        "pk", "user_id", "created_at"
+    ):
+        by_author[author_id].append((recipe_id, created_at))
+    for author_id, recipes in by_author.items():
+        if pushes_to_followers(author_id):
+            for batch in followers(author_id):
+                push(batch, recipes)
+
+
+def backfill(follower_id, followee_id):
+    """
+    Copies the latest recipes of a user into the timeline of a new follower.
+    """
+    # The follow may have been deleted again since the job was scheduled
+    following = Follow.objects.filter(follower_id=follower_id, followee_id=followee_id).exists()
+    if following and pushes_to_followers(followee_id):
+        recipes = Recipe.objects.filter(user_id=followee_id).order_by("-created_at", "-pk")
+        push([follower_id], list(recipes.values_list("pk", "created_at")[:timeline_length()]))
+
+
+def unfollow(follower_id, followee_id):
+    """
+    Removes the recipes of a user from the timeline of a former follower.
+    """
+    # Unless they have followed them again since the job was scheduled
+    if not Follow.objects.filter(follower_id=follower_id, followee_id=followee_id).exists():
+        TimelineEntry.objects.filter(user_id=follower_id, recipe__user_id=followee_id).delete()
+
+
+def rebuild_timeline(user_id):
+    """
+    Recomputes the timeline of a user from the recipes of the users they follow.
+    """
+    TimelineEntry.objects.filter(user_id=user_id).delete()
+    pushed = Follow.objects.filter(follower_id=user_id, followee__profile__fan_out_on_read=False)
+    recipes = Recipe.objects.filter(user_id__in=pushed.values("followee_id")).order_by("-created_at", "-pk")
+    push([user_id], list(recipes.values_list("pk", "created_at")[:timeline_length()]))
+
+
+def home_timeline(user, cursor=None, limit=10):
+    """
+    Returns a page of the feed of a user: their timeline merged with the recipes of the users they
+    follow who are fanned out on read.
+
+    Args:
+        user (User): The user.
+        cursor (tuple): The (created_at, recipe_id) of the last recipe of the previous page (optional).
+        limit (int): The maximum number of recipes.
+
+    Returns:
+        list: (created_at, recipe_id) pairs, newest first.
+    """
+    pulled_authors = list(
+        Follow.objects.filter(follower=user, followee__profile__fan_out_on_read=True).values_list("followee_id", flat=True)
+    )
+    # Only entries of authors the user still follows and whose recipes are pushed: a job that read
+    # the follow before an unfollow can write entries after unfollow() has deleted them, and
+    # recipes pushed before their author was switched to fan-out on read are pulled instead.
+    pushed = TimelineEntry.objects.filter(user=user).filter(Exists(
+        Follow.objects.filter(
+            follower=user, followee_id=OuterRef("recipe__user_id"), followee__profile__fan_out_on_read=False
+        )
+    ))
+    pulled = Recipe.objects.filter(user_id__in=pulled_authors)
+    if cursor is not None:
+        created_at, recipe_id = cursor
+        pushed = pushed.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, recipe_id__lt=recipe_id))
+        pulled = pulled.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, pk__lt=recipe_id))
+
+    streams = [list(pushed.order_by("-created_at", "-recipe_id").values_list("created_at", "recipe_id")[:limit])]
+    if pulled_authors:
+        streams.append(list(pulled.order_by("-created_at", "-pk").values_list("created_at", "pk")[:limit]))
+    return list(heapq.merge(*streams, reverse=True))[:limit]
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, "FEED_FANOUT_WORKERS", 2), thread_name_prefix="feed"
+            )
+        return _executor
+
+
+def run_job(job, *args):
+    # Pool threads keep their connections between jobs, like request threads between requests
+    close_old_connections()
+    try:
+        job(*args)
+    finally:
+        close_old_connections()
+
+
+def schedule(job, *args):
+    """
+    Runs a feed job in the thread pool (or inline when FEED_FANOUT_ASYNC is False).
+    """
+    if not getattr(settings, "FEED_FANOUT_ASYNC", True):
+        return job(*args)
+    future = get_executor().submit(run_job, job, *args)
+    future.add_done_callback(lambda done: _log_failure(job, args, done))
+    return future
+
+
+def wait():
+    """
+    Waits for the scheduled jobs to finish, e.g. before a worker process exits; a later job
+    starts a new pool.
+    """
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=True)
+
+
+def _log_failure(job, args, future):
+    if future.exception() is not None:
+        logger.error("Feed job %s%r failed", job.__name__, args, exc_info=future.exception())
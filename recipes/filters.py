@@ -1,19 +1,150 @@
+from asgiref.sync import sync_to_async
+from django.db.backends.base.operations import BaseDatabaseOperations
+from django.db.models import Exists, OuterRef, Q
+from django.db.models.functions import Lower
 from django_filters import rest_framework as filters
-from .models import Recipe
+from rest_framework.exceptions import ValidationError
+from rest_framework.filters import BaseFilterBackend
+from .models import Ingredient, Recipe, RecipeIngredient
+from .search import get_backend as get_search_backend
+
+
+def pk_range(model):
+    """
+    Returns the (lowest, highest) primary key value the database column of a model can hold.
+    """
+    return BaseDatabaseOperations.integer_field_ranges[model._meta.pk.get_internal_type()]
+
+
+def uses_ingredients(values):
+    """
+    Returns an EXISTS expression, true for recipes using any of the given ingredients.
+
+    Values are ingredient ids (ints, see parse_ingredients), or names compared case-insensitively
+    through the index on LOWER(name). The subquery follows the RecipeIngredient (ingredient, recipe)
+    index, and unlike a join it can't return a recipe more than once.
+    """
+    condition = Q()
+    ids = [value for value in values if isinstance(value, int)]
+    if ids:
+        condition |= Q(ingredient__in=ids)
+    names = [value.lower() for value in values if not isinstance(value, int)]
+    if names:
+        named = Ingredient.objects.annotate(lower_name=Lower("name")).filter(lower_name__in=names)
+        condition |= Q(ingredient__in=named.values("pk"))
+    return Exists(RecipeIngredient.objects.filter(condition, recipe=OuterRef("pk")))
+
+
+def parse_ingredients(values, field_name):
+    """
+    Returns the ids (ints) and names among comma-separated filter values: values of ASCII digits
+    are ids, anything else is a name.
+
+    Raises:
+        ValidationError: An id is out of the range of the primary key, so no query could take it.
+    """
+    low, high = pk_range(Ingredient)
+    parsed = []
+    for value in values:
+        if value.isascii() and value.isdigit():
+            value = int(value)
+            if not low <= value <= high:
+                raise ValidationError({field_name: [f"Ingredient ids must be at most {high}."]})
+        parsed.append(value)
+    return parsed
+
+
+class IngredientsFilter(filters.BaseCSVFilter, filters.CharFilter):
+    """
+    Filters recipes by a comma-separated list of ingredient ids or names.
+
+    Args:
+        match (str): "all" keeps recipes using every ingredient, "any" those using at least one,
+            "none" those using none of them.
+    """
+
+    def __init__(self, *args, match="any", **kwargs):
+        super().__init__(*args, **kwargs)
+        self.match = match
+
+    def filter(self, qs, value):
+        values = [item.strip() for item in value or () if item.strip()]
+        if not values:
+            return qs
+        values = parse_ingredients(values, self.field_name)
+        match self.match:
+            case "all":
+                # One EXISTS per ingredient: each is an index lookup
+                return qs.filter(*[uses_ingredients([item]) for item in dict.fromkeys(values)])
+            case "any":
+                return qs.filter(uses_ingredients(values))
+            case "none":
+                return qs.exclude(uses_ingredients(values))
+
 
 class RecipeFilter(filters.FilterSet):
     """
     A filter set for Recipe model.
 
     Available filters:
-    - ingredients__ingredient__name: exact match for ingredient name
+    - ingredients_all, ingredients_any, ingredients_none: comma-separated ingredient ids or names
+      that recipes must all use, use at least one of, or not use,
+      e.g. ?ingredients_all=chicken,garlic&ingredients_none=peanuts
+    - ingredients__ingredient__name__iexact: a single ingredient name (the same as ingredients_any)
     - time_minutes: exact match, less than or equal, greater than or equal
-    - user__username: exact match for username
+    - user__username__iexact: case-insensitive match for username
+    - ingredient_count, comment_count: exact match, less than or equal, greater than or equal
+    - latest_comment_at: before or after a date and time, or whether there are comments at all
     """
+    ingredients_all = IngredientsFilter(match="all")
+    ingredients_any = IngredientsFilter(match="any")
+    ingredients_none = IngredientsFilter(match="none")
+    ingredients__ingredient__name__iexact = filters.CharFilter(method="filter_ingredient_name")
+    user__username__iexact = filters.CharFilter(method="filter_username")
+
     class Meta:
         model = Recipe
         fields = {
-            "ingredients__ingredient__name": ["iexact"],
             "time_minutes": ["exact", "lte", "gte"],
-            "user__username": ["iexact"],
-        }
\ No newline at end of file
+            "ingredient_count": ["exact", "lte", "gte"],
+            "comment_count": ["exact", "lte", "gte"],
+            "latest_comment_at": ["lte", "gte", "isnull"],
+        }
+
+    def filter_ingredient_name(self, queryset, name, value):
+        # Kept for older clients; through EXISTS rather than a join that repeats recipes
+        return queryset.filter(uses_ingredients(parse_ingredients([value], name)))
+
+    def filter_username(self, queryset, name, value):
+        # LOWER() on both sides uses the index on LOWER(username); iexact would be LIKE on SQLite
+        return queryset.alias(username_lower=Lower("user__username")).filter(username_lower=value.lower())
+
+
+class RecipeSearchFilter(BaseFilterBackend):
+    """
+    Ranked full-text search over recipe titles, descriptions and ingredient names.
+
+    The query is read from ``?q=`` (``?search=`` is still accepted for older clients). Results are
+    ordered by relevance unless an explicit ``?ordering=`` is given.
+    """
+    search_params = ["q", "search"]
+
+    def get_search_terms(self, request):
+        for param in self.search_params:
+            terms = request.query_params.get(param, "").strip()
+            if terms:
+                return terms
+        return ""
+
+    async def aprepare(self, request, view):
+        """
+        Called by the async views before filter_queryset(), which must not query the database there.
+        """
+        if self.get_search_terms(request):
+            await sync_to_async(get_search_backend().prepare)()
+
+    def filter_queryset(self, request, queryset, view):
+        terms = self.get_search_terms(request)
+        if not terms:
+            return queryset
+        return get_search_backend().search(queryset, terms)
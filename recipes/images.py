@@ -0,0 +1,226 @@
+"""
+Fixed-size derivatives (WebP and JPEG) of uploaded images.
+
+Every image stored in one of IMAGE_FIELDS gets a resized copy per size in IMAGE_DERIVATIVE_SIZES
+and per format, stored next to the other media under a name derived from the original:
+
+    images/recipes/soup.png -> derivatives/images/recipes/soup.png/thumbnail.webp
+
+Because the names are derived, serializers and the admin build variant URLs straight from the
+original file name. Originals are read through the storage of their model field; derivatives are
+written next to them (see derivative_storage). Derivatives are generated after an upload is
+committed, in a process pool so the request thread isn't blocked (or inline when
+IMAGE_DERIVATIVES_ASYNC is False, e.g. in tests). The generate_image_derivatives command backfills
+existing media.
+
+Until they have been generated, serializers return no variant URLs. Each image field has a
+``<field>_derivatives_ready`` flag, set by mark_derivatives_ready once the files are written, which
+also bumps the ``modified_at`` of the rows and recipes showing the image, so the validators and
+cached fragments built without the variants are dropped. Saving a new image clears the flag.
+"""
+import io
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import django
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.utils import timezone
+from PIL import Image, ImageOps
+
+from .cache import recipe_cache
+from .models import Ingredient, Profile, Recipe, RecipeIngredient
+from .storage import ContentAddressedStorage
+
+# The image fields that get derivatives, as (model, field name)
+IMAGE_FIELDS = [
+    (Ingredient, "image"),
+    (Recipe, "image"),
+    (RecipeIngredient, "custom_image"),
+    (Profile, "image"),
+]
+
+# Model -> lookup of the ids of the recipes showing its images
+RECIPE_LOOKUPS = {
+    Ingredient: "recipes__recipe_id",
+    Recipe: "pk",
+    RecipeIngredient: "recipe_id",
+}
+
+# Derivative name -> longest side in pixels
+DEFAULT_SIZES = {"thumbnail": 200, "small": 480, "medium": 960}
+
+# File extension -> Pillow format
+FORMATS = {"webp": "WEBP", "jpg": "JPEG"}
+
+DERIVATIVES_PREFIX = "derivatives"
+
+logger = logging.getLogger(__name__)
+
+
+def get_sizes():
+    return getattr(settings, "IMAGE_DERIVATIVE_SIZES", DEFAULT_SIZES)
+
+
+def derivative_name(name, size, extension):
+    """
+    Returns the storage name of one derivative of an image.
+
+    Args:
+        name (str): The storage name of the original image.
+        size (str): The derivative size, a key of IMAGE_DERIVATIVE_SIZES.
+        extension (str): The derivative format, a key of FORMATS.
+    """
+    return f"{DERIVATIVES_PREFIX}/{name}/{size}.{extension}"
+
+
+def field_storage(model, field):
+    """
+    Returns the storage the images of one of IMAGE_FIELDS are kept in.
+    """
+    return model._meta.get_field(field).storage
+
+
+def derivative_storage(storage):
+    """
+    Returns the storage the derivatives of images kept in the given storage are written to.
+
+    ContentAddressedStorage names files after their content, so the derivatives of its blobs go
+    through a plain file system storage over the same directory.
+    """
+    if isinstance(storage, ContentAddressedStorage):
+        return storage.named
+    return storage
+
+
+def ready_field(field):
+    """
+    Returns the name of the flag recording that the derivatives of an image field's image exist.
+    """
+    return f"{field}_derivatives_ready"
+
+
+def derivative_urls(name, storage, ready):
+    """
+    Returns {size: {format: url}} for an image, or None when there is no image or its derivatives
+    haven't been generated yet.
+
+    Args:
+        name (str): The storage name of the original image.
+        storage (Storage): The storage the original is kept in.
+        ready (bool): The ``<field>_derivatives_ready`` flag of the row holding the image.
+    """
+    if not name or not ready:
+        return None
+    storage = derivative_storage(storage)
+    return {
+        size: {extension: storage.url(derivative_name(name, size, extension)) for extension in FORMATS}
+        for size in get_sizes()
+    }
+
+
+def generate_derivatives(name, storage, force=False):
+    """
+    Generates the missing derivatives of an image, then marks them ready on the rows holding it.
+
+    Args:
+        name (str): The storage name of the original image.
+        storage (Storage): The storage the original is kept in.
+        force (bool): Regenerate derivatives that already exist.
+
+    Returns:
+        int: The number of files written.
+    """
+    originals, storage = storage, derivative_storage(storage)
+    wanted = [
+        (size, pixels, extension)
+        for size, pixels in get_sizes().items()
+        for extension in FORMATS
+        if force or not storage.exists(derivative_name(name, size, extension))
+    ]
+    if not originals.exists(name):
+        return 0
+    if not wanted:
+        mark_derivatives_ready(name)
+        return 0
+
+    with originals.open(name, "rb") as original:
+        image = ImageOps.exif_transpose(Image.open(original))
+        image.load()
+
+    written = 0
+    for size, pixels, extension in wanted:
+        resized = image.copy()
+        resized.thumbnail((pixels, pixels), Image.LANCZOS)
+        if FORMATS[extension] == "JPEG" and resized.mode not in ("RGB", "L"):
+            resized = resized.convert("RGB")
+        buffer = io.BytesIO()
+        resized.save(buffer, FORMATS[extension], quality=getattr(settings, "IMAGE_DERIVATIVE_QUALITY", 80))
+        target = derivative_name(name, size, extension)
+        if storage.exists(target):
+            storage.delete(target)
+        storage.save(target, ContentFile(buffer.getvalue()))
+        written += 1
+    mark_derivatives_ready(name)
+    return written
+
+
+def mark_derivatives_ready(name):
+    """
+    Sets the derivatives_ready flag of the rows holding an image, and bumps the modified_at of
+    those rows and of the recipes showing them.
+    """
+    now = timezone.now()
+    recipe_ids = set()
+    with transaction.atomic():
+        for model, field in IMAGE_FIELDS:
+            pending = model.objects.filter(**{field: name, ready_field(field): False})
+            if model in RECIPE_LOOKUPS:
+                recipe_ids.update(pending.values_list(RECIPE_LOOKUPS[model], flat=True))
+            changes = {ready_field(field): True}
+            if any(f.name == "modified_at" for f in model._meta.concrete_fields):
+                changes["modified_at"] = now
+            pending.update(**changes)
+        recipe_ids.discard(None)
+        Recipe.objects.filter(pk__in=recipe_ids).update(modified_at=now)
+    recipe_cache.invalidate(recipe_ids)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # Forking a threaded server would copy the locks other threads hold; spawned workers
+            # start a fresh interpreter and set Django up
+            _executor = ProcessPoolExecutor(
+                max_workers=getattr(settings, "IMAGE_DERIVATIVE_WORKERS", 2),
+                mp_context=get_context("spawn"),
+                initializer=django.setup,
+            )
+        return _executor
+
+
+def schedule_derivatives(name, storage, force=False):
+    """
+    Generates the derivatives of an image kept in the given storage in the process pool (or
+    inline when IMAGE_DERIVATIVES_ASYNC is False).
+    """
+    if not name:
+        return None
+    if not getattr(settings, "IMAGE_DERIVATIVES_ASYNC", True):
+        return generate_derivatives(name, storage, force)
+    future = get_executor().submit(generate_derivatives, name, storage, force)
+    future.add_done_callback(lambda done: _log_failure(name, done))
+    return future
+
+
+def _log_failure(name, future):
+    if future.exception() is not None:
+        logger.error("Generating derivatives of %s failed", name, exc_info=future.exception())
@@ -0,0 +1,110 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import ModuleType
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import AsyncClient, Client, override_settings
+
+from recipes.async_views import async_read_urlpatterns
+from recipes.models import Ingredient, Recipe, RecipeIngredient
+from recipes.urls import api_urlpatterns
+
+
+def urlconf(name, urlpatterns):
+    module = ModuleType(name)
+    module.urlpatterns = urlpatterns
+    return module
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares the throughput of the sync views, run by a thread pool like a threaded WSGI "
+        "server, with the native async views, run concurrently on one event loop like an ASGI "
+        "server. Requests go through the full middleware stack in process."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--path", default="/recipes/", help="The URL to request.")
+        parser.add_argument("--requests", type=int, default=200, help="Requests per concurrency level.")
+        parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+        parser.add_argument("--seed", type=int, default=0,
+                            help="Create this many synthetic recipes first and delete them afterwards.")
+
+    def handle(self, *args, **options):
+        seeded = self.seed(options["seed"]) if options["seed"] else None
+        try:
+            if not Recipe.objects.exists():
+                raise CommandError("There are no recipes to read; use --seed")
+            self.run(options)
+        finally:
+            if seeded is not None:
+                Recipe.objects.filter(user=seeded).delete()
+                Ingredient.objects.filter(name__startswith="benchmark async ").delete()
+                seeded.delete()
+
+    def run(self, options):
+        path, total = options["path"], options["requests"]
+        sync_urls = urlconf("benchmark_sync_urls", api_urlpatterns)
+        async_urls = urlconf("benchmark_async_urls", async_read_urlpatterns(api_urlpatterns))
+
+        self.stdout.write(f"{'concurrency':>12} {'sync req/s':>12} {'async req/s':>12}")
+        for concurrency in options["concurrency"]:
+            with override_settings(ROOT_URLCONF=sync_urls):
+                sync_rate = self.run_sync(path, total, concurrency)
+            with override_settings(ROOT_URLCONF=async_urls):
+                async_rate = asyncio.run(self.run_async(path, total, concurrency))
+            self.stdout.write(f"{concurrency:>12} {sync_rate:>12.0f} {async_rate:>12.0f}")
+
+    def run_sync(self, path, total, concurrency):
+        def worker(count):
+            client = Client()
+            try:
+                for _ in range(count):
+                    self.check_response(client.get(path))
+            finally:
+                connections.close_all()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            list(pool.map(worker, self.split(total, concurrency)))
+        return total / (time.perf_counter() - started)
+
+    async def run_async(self, path, total, concurrency):
+        async def worker(count):
+            client = AsyncClient()
+            for _ in range(count):
+                self.check_response(await client.get(path))
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(count) for count in self.split(total, concurrency)))
+        return total / (time.perf_counter() - started)
+
+    @staticmethod
+    def split(total, parts):
+        return [total // parts + (1 if i < total % parts else 0) for i in range(parts)]
+
+    @staticmethod
+    def check_response(response):
+        if response.status_code != 200:
+            raise CommandError(f"Got HTTP {response.status_code}")
+
+    def seed(self, count):
+        user = get_user_model().objects.create(username="benchmark-async-views")
+        ingredients = Ingredient.objects.bulk_create([
+            Ingredient(name=f"benchmark async {i}", image=f"images/ingredients/benchmark-{i}.jpg")
+            for i in range(20)
+        ])
+        recipes = Recipe.objects.bulk_create([
+            Recipe(user=user, title=f"Benchmark recipe {i}", time_minutes=10, description="Cook.",
+                   ingredient_count=5)
+            for i in range(count)
+        ])
+        RecipeIngredient.objects.bulk_create([
+            RecipeIngredient(recipe=recipe, ingredient=ingredients[(i + j) % 20], amount=1, unit="g")
+            for i, recipe in enumerate(recipes)
+            for j in range(5)
+        ])
+        return user
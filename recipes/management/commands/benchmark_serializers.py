@@ -0,0 +1,93 @@
+import statistics
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Prefetch
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from recipes.fast_serializers import FastRecipeSerializer
+from recipes.models import Ingredient, Recipe, RecipeIngredient
+from recipes.serializers import RecipeSerializer
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares RecipeSerializer with the fast read-only serializer per page size. Synthetic "
+        "recipes are created in a transaction that is rolled back afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--page-sizes", type=int, nargs="+", default=[10, 50, 100, 500])
+        parser.add_argument("--ingredients", type=int, default=8, help="Ingredients per recipe.")
+        parser.add_argument("--repeat", type=int, default=20, help="Timed runs per page size.")
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.run(options)
+                raise Rollback
+        except Rollback:
+            pass
+
+    def run(self, options):
+        page_sizes = sorted(options["page_sizes"])
+        ids = self.create_recipes(page_sizes[-1], options["ingredients"])
+        request = Request(APIRequestFactory().get("/recipes/"))
+        context = {"request": request}
+        renderer = JSONRenderer()
+        prefetch = Prefetch("ingredients", RecipeIngredient.objects.select_related("ingredient").order_by("pk"))
+
+        def slow(page):
+            recipes = list(Recipe.objects.filter(pk__in=page).order_by("pk").prefetch_related(prefetch))
+            return renderer.render(RecipeSerializer(recipes, many=True, context=context).data)
+
+        def fast(page):
+            recipes = list(Recipe.objects.filter(pk__in=page).order_by("pk"))
+            return renderer.render(FastRecipeSerializer(context=context).serialize(recipes))
+
+        self.stdout.write(f"{'page size':>10} {'DRF ms':>10} {'fast ms':>10} {'speedup':>8}  output")
+        for size in page_sizes:
+            page = ids[:size]
+            if slow(page) != fast(page):
+                raise CommandError(f"The outputs differ for a page of {size} recipes")
+            slow_ms = self.time(slow, page, options["repeat"])
+            fast_ms = self.time(fast, page, options["repeat"])
+            self.stdout.write(
+                f"{size:>10} {slow_ms:>10.2f} {fast_ms:>10.2f} {slow_ms / fast_ms:>7.1f}x  identical"
+            )
+
+    @staticmethod
+    def time(function, page, repeat):
+        timings = []
+        for _ in range(max(repeat, 1)):
+            started = time.perf_counter()
+            function(page)
+            timings.append((time.perf_counter() - started) * 1000)
+        return statistics.median(timings)
+
+    def create_recipes(self, count, per_recipe):
+        user, _ = get_user_model().objects.get_or_create(username="benchmark-serializers")
+        ingredients = Ingredient.objects.bulk_create([
+            Ingredient(name=f"benchmark ingredient {i}", image=f"images/ingredients/benchmark-{i}.jpg")
+            for i in range(per_recipe * 4)
+        ])
+        recipes = Recipe.objects.bulk_create([
+            Recipe(user=user, title=f"Benchmark recipe {i}", time_minutes=i % 90 + 5,
+                   description="Mix everything and cook. " * 5, image=f"images/recipes/benchmark-{i}.jpg")
+            for i in range(count)
+        ])
+        RecipeIngredient.objects.bulk_create([
+            RecipeIngredient(recipe=recipe, ingredient=ingredients[(i + j) % len(ingredients)],
+                             amount=j + 0.5, unit="g", custom_name="custom" if j == 0 else None)
+            for i, recipe in enumerate(recipes)
+            for j in range(per_recipe)
+        ])
+        return [recipe.pk for recipe in recipes]
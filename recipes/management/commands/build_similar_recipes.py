@@ -0,0 +1,16 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from recipes.similar import similar_index
+
+
+class Command(BaseCommand):
+    help = "Computes the MinHash signatures of all recipes and saves them to SIMILAR_RECIPES_INDEX."
+
+    def handle(self, *args, **options):
+        if not settings.SIMILAR_RECIPES_INDEX:
+            raise CommandError("Set SIMILAR_RECIPES_INDEX to the file to save the index to.")
+        similar_index.build()
+        self.stdout.write(self.style.SUCCESS(
+            f"Saved the signatures of {similar_index.size()} recipes to {settings.SIMILAR_RECIPES_INDEX}."
+        ))
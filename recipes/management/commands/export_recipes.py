@@ -0,0 +1,49 @@
+import gzip
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+
+from recipes.export import iter_ndjson
+
+
+class Command(BaseCommand):
+    help = "Streams the recipe catalog as NDJSON, one recipe with its ingredients per line."
+
+    def add_arguments(self, parser):
+        parser.add_argument("output", nargs="?", default="-", help="Output file (default: stdout).")
+        parser.add_argument("--modified-since", help="Only export recipes modified since this ISO 8601 datetime.")
+        parser.add_argument("--gzip", action="store_true", help="Gzip the output (implied by a .gz file name).")
+        parser.add_argument("--chunk-size", type=int, default=1000, help="Recipes fetched per round trip.")
+
+    def handle(self, *args, **options):
+        modified_since = None
+        if options["modified_since"]:
+            modified_since = parse_datetime(options["modified_since"])
+            if modified_since is None:
+                raise CommandError("--modified-since must be an ISO 8601 datetime")
+
+        output = options["output"]
+        compress = options["gzip"] or output.endswith(".gz")
+        if output == "-":
+            stream = sys.stdout.buffer
+            if compress:
+                stream = gzip.GzipFile(fileobj=stream, mode="wb")
+        else:
+            stream = gzip.open(output, "wb") if compress else open(output, "wb")
+
+        started = time.monotonic()
+        count = 0
+        try:
+            for line in iter_ndjson(modified_since, options["chunk_size"]):
+                stream.write(line)
+                count += 1
+        finally:
+            if stream is not sys.stdout.buffer:
+                stream.close()
+            else:
+                stream.flush()
+
+        elapsed = max(time.monotonic() - started, 1e-9)
+        self.stderr.write(f"Exported {count} recipes in {elapsed:.1f}s ({count / elapsed:.0f} recipes/s)")
@@ -0,0 +1,50 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from recipes.images import IMAGE_FIELDS, field_storage, generate_derivatives, get_executor
+
+
+class Command(BaseCommand):
+    help = "Generates the missing resized derivatives of all existing images and marks them ready."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--force", action="store_true", help="Regenerate derivatives that already exist.")
+        parser.add_argument("--sync", action="store_true", help="Generate in this process instead of the pool.")
+
+    def images(self):
+        """
+        Yields the (name, storage) of every stored image once.
+        """
+        seen = set()
+        for model, field in IMAGE_FIELDS:
+            storage = field_storage(model, field)
+            names = model.objects.exclude(**{field: ""}).exclude(**{f"{field}__isnull": True})
+            for name in names.values_list(field, flat=True).distinct().iterator():
+                if (name, storage) not in seen:
+                    seen.add((name, storage))
+                    yield name, storage
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        images = written = 0
+        if options["sync"]:
+            for name, storage in self.images():
+                written += generate_derivatives(name, storage, options["force"])
+                images += 1
+        else:
+            executor = get_executor()
+            futures = [
+                executor.submit(generate_derivatives, name, storage, options["force"])
+                for name, storage in self.images()
+            ]
+            images = len(futures)
+            for future in futures:
+                try:
+                    written += future.result()
+                except Exception as exc:
+                    self.stderr.write(f"{exc.__class__.__name__}: {exc}")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Checked {images} images, wrote {written} derivatives in {time.monotonic() - started:.1f}s"
+        ))
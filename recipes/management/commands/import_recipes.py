@@ -0,0 +1,406 @@
+"""
+Bulk import of recipes (and their ingredients) from JSONL or CSV files.
+
+JSONL input has one recipe per line:
+
+    {"title": "Pancakes", "time_minutes": 20, "description": "...", "user": "alice",
+     "ingredients": [{"name": "egg", "amount": "2", "unit": "pc", "custom_name": null}]}
+
+CSV input has one row per recipe ingredient; consecutive rows with the same ``recipe`` key form
+one recipe, whose fields are read from its first row:
+
+    recipe,title,time_minutes,description,user,ingredient,amount,unit,custom_name
+
+``user`` is a username and may be left out when --user is given.
+
+Records are split from the file before they are parsed, so each shard only parses its own records
+and a resumed import skips the records it already wrote unparsed.
+"""
+import csv
+import io
+import json
+import multiprocessing
+import os
+import sys
+import time
+from itertools import groupby, islice, zip_longest
+
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError, OutputWrapper
+from django.db import connection, connections, transaction
+from django.utils import timezone
+
+from recipes import feed
+from recipes.models import ImportProgress, Ingredient, Recipe, RecipeIngredient
+from recipes.signals import recipes_created
+
+
+class InvalidRecord(ValueError):
+    pass
+
+
+def split_jsonl(stream):
+    for line in stream:
+        if line.strip():
+            yield line
+
+
+def load_jsonl(line):
+    try:
+        return json.loads(line)
+    except ValueError as exc:
+        raise InvalidRecord(f"invalid JSON: {exc}")
+
+
+def split_csv(stream):
+    rows = csv.reader(stream)
+    header = next(rows, None)
+    if header is None:
+        return
+    column = header.index("recipe")
+    rows = (row for row in rows if row)
+    for _, group in groupby(rows, key=lambda row: row[column] if column < len(row) else None):
+        yield header, list(group)
+
+
+def load_csv(raw):
+    header, group = raw
+    group = [dict(zip_longest(header, row)) for row in group]
+    first = group[0]
+    return {
+        "title": first["title"],
+        "time_minutes": first["time_minutes"],
+        "description": first.get("description", ""),
+        "user": first.get("user") or None,
+        "ingredients": [
+            {
+                "name": row["ingredient"],
+                "amount": row["amount"],
+                "unit": row.get("unit") or None,
+                "custom_name": row.get("custom_name") or None,
+            }
+            for row in group
+            if row.get("ingredient")
+        ],
+    }
+
+
+# format -> (split the file into raw records, parse one raw record)
+READERS = {"jsonl": (split_jsonl, load_jsonl), "csv": (split_csv, load_csv)}
+
+
+def copy_quote(value):
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+def progress_key(path, shard, shards):
+    return f"{os.path.abspath(path)}:{shard}/{shards}"
+
+
+def clean(model, name, value):
+    """
+    Converts and validates a value like the model field does. A value the field can't store would
+    otherwise fail the INSERT or COPY of its whole batch.
+    """
+    try:
+        return model._meta.get_field(name).clean(value, None)
+    except ValidationError as exc:
+        raise InvalidRecord(f"{name}: {' '.join(exc.messages)}")
+
+
+def parse_record(record, default_user):
+    """
+    Checks a raw input record and returns it with normalized values.
+    """
+    try:
+        title = str(record["title"]).strip()
+        time_minutes = record["time_minutes"]
+        ingredients = [
+            {
+                "name": str(item["name"]).strip(),
+                "amount": str(item["amount"]).strip(),
+                "unit": item.get("unit") or None,
+                "custom_name": item.get("custom_name") or None,
+            }
+            for item in record.get("ingredients") or []
+        ]
+    except (KeyError, TypeError, AttributeError) as exc:
+        raise InvalidRecord(f"{exc.__class__.__name__}: {exc}")
+    for item in ingredients:
+        item["name"] = clean(Ingredient, "name", item["name"])
+        for name in ("amount", "unit", "custom_name"):
+            item[name] = clean(RecipeIngredient, name, item[name])
+    user = record.get("user") or default_user
+    if not user:
+        raise InvalidRecord("no user given and no --user default")
+    return {
+        "title": clean(Recipe, "title", title),
+        "time_minutes": clean(Recipe, "time_minutes", time_minutes),
+        "description": str(record.get("description") or ""),
+        "user": str(user),
+        "ingredients": ingredients,
+    }
+
+
+class RecipeImporter:
+    """
+    Streams records from a file and writes them in batches.
+
+    Ingredients are upserted by their unique name and resolved through an in-memory name -> id
+    map, users likewise by username. Each batch is written in one transaction together with the
+    import's ImportProgress row, so an interrupted import resumes after the last committed batch.
+    On PostgreSQL rows are written with COPY, elsewhere with bulk_create.
+    """
+
+    def __init__(self, path, fmt, batch_size=1000, default_user=None, shard=0, shards=1,
+                 use_copy=None, stdout=None, stderr=None):
+        self.path = path
+        self.fmt = fmt
+        self.batch_size = batch_size
+        self.default_user = default_user
+        self.shard = shard
+        self.shards = shards
+        self.use_copy = connection.vendor == "postgresql" if use_copy is None else use_copy
+        self.stdout = stdout or OutputWrapper(sys.stdout)
+        self.stderr = stderr or OutputWrapper(sys.stderr)
+        self.ingredient_ids = {}
+        self.user_ids = {}
+        self.key = progress_key(path, shard, shards)
+        self.recipes = self.ingredients = self.invalid = 0
+
+    def records(self, start):
+        """
+        Yields (position, raw record) for this shard's records from position start onwards. The
+        records of other shards and those before start are skipped without parsing them.
+        """
+        split, _ = READERS[self.fmt]
+        first = start + (self.shard - start) % self.shards
+        with open(self.path, newline="", encoding="utf-8") as stream:
+            yield from islice(enumerate(split(stream)), first, None, self.shards)
+
+    def load(self, raw):
+        """
+        Parses a raw record yielded by records().
+        """
+        _, load = READERS[self.fmt]
+        return load(raw)
+
+    def run(self):
+        progress, _ = ImportProgress.objects.get_or_create(key=self.key)
+        if progress.position:
+            self.stdout.write(f"[{self.key}] resuming at record {progress.position}")
+        started = time.monotonic()
+        batch = []
+        next_position = progress.position
+        for position, raw in self.records(progress.position):
+            next_position = position + 1
+            try:
+                batch.append(parse_record(self.load(raw), self.default_user))
+            except InvalidRecord as exc:
+                self.invalid += 1
+                self.stderr.write(f"[{self.key}] record {position}: {exc}")
+            if len(batch) >= self.batch_size:
+                self.flush(batch, next_position, started)
+                batch = []
+        self.flush(batch, next_position, started)
+        return self.recipes, self.ingredients, self.invalid
+
+    def flush(self, batch, position, started):
+        with transaction.atomic():
+            if batch:
+                self.resolve_ingredients(batch)
+                self.resolve_users(batch)
+                batch = [record for record in batch if self.check_user(record)]
+                recipe_ids = self.write(batch)
+                recipes_created.send(sender=Recipe, recipe_ids=recipe_ids)
+            ImportProgress.objects.filter(key=self.key).update(position=position, modified_at=timezone.now())
+
+        if not batch:
+            return
+        elapsed = max(time.monotonic() - started, 1e-9)
+        self.stdout.write(
+            f"[{self.key}] {self.recipes} recipes, {self.ingredients} ingredients, "
+            f"{self.invalid} invalid, {self.recipes / elapsed:.0f} recipes/s"
+        )
+
+    def resolve_ingredients(self, batch):
+        names = {item["name"] for record in batch for item in record["ingredients"]}
+        missing = names - self.ingredient_ids.keys()
+        if not missing:
+            return
+        Ingredient.objects.bulk_create(
+            [Ingredient(name=name) for name in missing], ignore_conflicts=True, batch_size=1000
+        )
+        self.ingredient_ids.update(Ingredient.objects.filter(name__in=missing).values_list("name", "pk"))
+
+    def resolve_users(self, batch):
+        usernames = {record["user"] for record in batch} - self.user_ids.keys()
+        if usernames:
+            found = dict(get_user_model().objects.filter(username__in=usernames).values_list("username", "pk"))
+            self.user_ids.update({username: found.get(username) for username in usernames})
+
+    def check_user(self, record):
+        if self.user_ids[record["user"]] is None:
+            self.invalid += 1
+            self.stderr.write(f"[{self.key}] unknown user {record['user']!r}")
+            return False
+        return True
+
+    def write(self, batch):
+        if self.use_copy:
+            recipe_ids = self.write_copy(batch)
+        else:
+            recipe_ids = self.write_bulk_create(batch)
+        self.recipes += len(batch)
+        self.ingredients += sum(len(record["ingredients"]) for record in batch)
+        return recipe_ids
+
+    def write_bulk_create(self, batch):
+        recipes = Recipe.objects.bulk_create([
+            Recipe(
+                user_id=self.user_ids[record["user"]],
+                title=record["title"],
+                time_minutes=record["time_minutes"],
+                description=record["description"],
+                ingredient_count=len(record["ingredients"]),
+            )
+            for record in batch
+        ])
+        RecipeIngredient.objects.bulk_create(
+            [
+                RecipeIngredient(
+                    recipe=recipe,
+                    ingredient_id=self.ingredient_ids[item["name"]],
+                    amount=item["amount"],
+                    unit=item["unit"],
+                    custom_name=item["custom_name"],
+                )
+                for recipe, record in zip(recipes, batch)
+                for item in record["ingredients"]
+            ],
+            batch_size=self.batch_size,
+        )
+        return [recipe.pk for recipe in recipes]
+
+    def write_copy(self, batch):
+        now = timezone.now()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+                [Recipe._meta.db_table, len(batch)],
+            )
+            recipe_ids = [row[0] for row in cursor.fetchall()]
+            self.copy(cursor, Recipe, ["id", "user_id", "title", "time_minutes", "description", "image",
+                                       "image_derivatives_ready", "created_at", "modified_at",
+                                       "ingredient_count", "comment_count"], (
+                (recipe_id, self.user_ids[record["user"]], record["title"], record["time_minutes"],
+                 record["description"], None, False, now, now, len(record["ingredients"]), 0)
+                for recipe_id, record in zip(recipe_ids, batch)
+            ))
+            self.copy(cursor, RecipeIngredient, ["recipe_id", "ingredient_id", "amount", "unit", "custom_name",
+                                                 "custom_image", "custom_image_derivatives_ready"], (
+                (recipe_id, self.ingredient_ids[item["name"]], item["amount"], item["unit"],
+                 item["custom_name"], None, False)
+                for recipe_id, record in zip(recipe_ids, batch)
+                for item in record["ingredients"]
+            ))
+        return recipe_ids
+
+    @staticmethod
+    def copy(cursor, model, columns, rows):
+        # Values are quoted and NULL is the unquoted \N: COPY only takes an unquoted field for the
+        # NULL marker, so a field holding the text \N stays text.
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write(",".join("\\N" if value is None else copy_quote(value) for value in row))
+            buffer.write("\n")
+        buffer.seek(0)
+        cursor.copy_expert(
+            f"COPY {model._meta.db_table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')",
+            buffer,
+        )
+
+
+def run_shard(kwargs):
+    # Each worker process opens its own database connections.
+    connections.close_all()
+    try:
+        return RecipeImporter(**kwargs).run()
+    finally:
+        # The pool terminates its workers once they have returned: finish pushing the imported
+        # recipes to feeds first.
+        feed.wait()
+
+
+class Command(BaseCommand):
+    help = "Streams recipes from a JSONL or CSV file into the database in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="The JSONL or CSV file to import.")
+        parser.add_argument("--format", choices=sorted(READERS), help="Input format (default: by file extension).")
+        parser.add_argument("--batch-size", type=int, default=1000, help="Recipes per transaction.")
+        parser.add_argument("--user", help="Username for records without a user.")
+        parser.add_argument("--workers", type=int, default=1, help="Number of parallel worker processes.")
+        parser.add_argument("--shard", help="Only import shard INDEX/COUNT of the input, e.g. 0/4.")
+        parser.add_argument("--no-copy", action="store_true", help="Use bulk_create even on PostgreSQL.")
+        parser.add_argument("--restart", action="store_true", help="Ignore the saved progress and start over.")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        if not os.path.exists(path):
+            raise CommandError(f"{path} does not exist")
+        fmt = options["format"] or os.path.splitext(path)[1].lstrip(".").lower()
+        if fmt not in READERS:
+            raise CommandError(f"Unknown format {fmt!r}; use --format")
+
+        if options["shard"]:
+            try:
+                shard, shards = (int(part) for part in options["shard"].split("/"))
+                assert 0 <= shard < shards
+            except (ValueError, AssertionError):
+                raise CommandError("--shard must look like INDEX/COUNT, e.g. 0/4")
+            shard_list = [(shard, shards)]
+        else:
+            shards = max(options["workers"], 1)
+            shard_list = [(shard, shards) for shard in range(shards)]
+
+        jobs = [
+            {
+                "path": path,
+                "fmt": fmt,
+                "batch_size": options["batch_size"],
+                "default_user": options["user"],
+                "shard": shard,
+                "shards": shards,
+                "use_copy": False if options["no_copy"] else None,
+            }
+            for shard, shards in shard_list
+        ]
+        # Positions are only meaningful for the shard count they were saved with
+        saved = ImportProgress.objects.filter(key__startswith=f"{os.path.abspath(path)}:")
+        if options["restart"]:
+            saved.delete()
+        else:
+            saved_shards = {int(key.rpartition("/")[2]) for key in saved.values_list("key", flat=True)}
+            for other in saved_shards - {shards}:
+                raise CommandError(
+                    f"Saved progress of {path} is for {other} shards; resume with --workers {other} "
+                    f"(or --shard INDEX/{other}), or pass --restart"
+                )
+
+        started = time.monotonic()
+        if len(jobs) == 1:
+            results = [RecipeImporter(stdout=self.stdout, stderr=self.stderr, **jobs[0]).run()]
+            feed.wait()
+        else:
+            connections.close_all()
+            with multiprocessing.get_context("fork").Pool(len(jobs)) as pool:
+                results = pool.map(run_shard, jobs)
+
+        recipes, ingredients, invalid = (sum(column) for column in zip(*results))
+        elapsed = max(time.monotonic() - started, 1e-9)
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {recipes} recipes and {ingredients} ingredients in {elapsed:.1f}s "
+            f"({recipes / elapsed:.0f} recipes/s, {invalid} invalid records skipped)"
+        ))
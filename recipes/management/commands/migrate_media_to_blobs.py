@@ -0,0 +1,50 @@
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+
+from recipes.images import IMAGE_FIELDS, ready_field, schedule_derivatives
+from recipes.models import MediaBlob
+from recipes.storage import BLOBS_PREFIX, content_addressed_storage
+
+
+class Command(BaseCommand):
+    help = "Moves existing image files into the content-addressed media store, deduplicating them."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--delete-originals", action="store_true", help="Delete the old files once moved.")
+
+    def handle(self, *args, **options):
+        moved = {}
+        rows = 0
+        for model, field in IMAGE_FIELDS:
+            legacy = (
+                model.objects.exclude(**{f"{field}__startswith": f"{BLOBS_PREFIX}/"})
+                .exclude(**{field: ""})
+                .exclude(**{f"{field}__isnull": True})
+            )
+            for pk, name in legacy.values_list("pk", field).iterator():
+                if name not in moved:
+                    if not default_storage.exists(name):
+                        self.stderr.write(f"{model.__name__} {pk}: {name} is missing, skipped")
+                        continue
+                    with default_storage.open(name, "rb") as original:
+                        moved[name] = content_addressed_storage.save(name, original)
+                blob = moved[name]
+                # update() skips the model signals, so the reference is counted here
+                with transaction.atomic():
+                    model.objects.filter(pk=pk).update(**{field: blob, ready_field(field): False})
+                    MediaBlob.objects.filter(name=blob).update(references=F("references") + 1)
+                rows += 1
+
+        # Once every row holds its blob, so that the rows are marked ready
+        for blob in set(moved.values()):
+            schedule_derivatives(blob, content_addressed_storage)
+
+        if options["delete_originals"]:
+            for name in moved:
+                default_storage.delete(name)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Moved {len(moved)} files into {len(set(moved.values()))} blobs, updated {rows} rows."
+        ))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from recipes.models import Tombstone
+from recipes.refresh import tombstone_retention
+
+
+class Command(BaseCommand):
+    help = "Deletes the tombstones of deleted rows older than INDEX_TOMBSTONE_RETENTION."
+
+    def handle(self, *args, **options):
+        deleted, _ = Tombstone.objects.filter(deleted_at__lt=timezone.now() - tombstone_retention()).delete()
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} tombstones."))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from recipes.feed import rebuild_timeline
+from recipes.models import Follow
+
+
+class Command(BaseCommand):
+    help = "Recomputes the feed timelines of users from the recipes of the users they follow."
+
+    def add_arguments(self, parser):
+        parser.add_argument("users", nargs="*", type=int, help="Ids of the users (all followers by default).")
+
+    def handle(self, *args, **options):
+        user_ids = options["users"] or Follow.objects.order_by("follower_id").values_list(
+            "follower_id", flat=True
+        ).distinct().iterator()
+        rebuilt = 0
+        for user_id in user_ids:
+            rebuild_timeline(user_id)
+            rebuilt += 1
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {rebuilt} timelines."))
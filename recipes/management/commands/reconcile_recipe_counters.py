@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from recipes.counters import COUNTER_FIELDS, counter_expressions
+from recipes.models import Recipe
+
+
+class Command(BaseCommand):
+    help = "Recomputes the ingredient and comment counters of recipes and repairs the ones that drifted."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000, help="Recipes checked per query.")
+        parser.add_argument("--dry-run", action="store_true", help="Only report the recipes that drifted.")
+
+    def handle(self, *args, **options):
+        actual = {f"actual_{field}": expression for field, expression in counter_expressions().items()}
+        checked = repaired = 0
+        last_pk = 0
+        while True:
+            rows = list(
+                Recipe.objects.filter(pk__gt=last_pk)
+                .order_by("pk")
+                .annotate(**actual)
+                .values("pk", *COUNTER_FIELDS, *actual)[:options["batch_size"]]
+            )
+            if not rows:
+                break
+            last_pk = rows[-1]["pk"]
+            checked += len(rows)
+            drifted = [
+                row["pk"] for row in rows
+                if any(row[field] != row[f"actual_{field}"] for field in COUNTER_FIELDS)
+            ]
+            if not drifted:
+                continue
+            repaired += len(drifted)
+            if options["dry_run"]:
+                self.stdout.write(f"drifted: {', '.join(map(str, drifted))}")
+            else:
+                # Recomputed inside the UPDATE, so changes made since the check aren't lost
+                Recipe.objects.filter(pk__in=drifted).update(**counter_expressions(), modified_at=timezone.now())
+
+        verb = "Found" if options["dry_run"] else "Repaired"
+        self.stdout.write(self.style.SUCCESS(f"Checked {checked} recipes. {verb} {repaired} with drifted counters."))
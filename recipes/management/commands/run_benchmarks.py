@@ -0,0 +1,85 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from recipes.benchmark.runner import BenchmarkRunner, HTTPClient, InProcessClient, change, compare
+from recipes.benchmark.scenarios import SCENARIOS, BenchmarkContext, get_scenarios
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs the API benchmark scenarios in process or against a server (--url) and reports "
+        "latency percentiles, queries per request and throughput. Seed the data with "
+        "seed_benchmark_data first; the write scenarios add rows."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("scenarios", nargs="*", help="Scenario names (default: all but the heavy ones).")
+        parser.add_argument("--url", help="Base URL of a running server, e.g. http://localhost:8000.")
+        parser.add_argument("--requests", type=int, default=100, help="Timed requests per scenario.")
+        parser.add_argument("--concurrency", type=int, default=1, help="Concurrent workers per scenario.")
+        parser.add_argument("--warmup", type=int, default=5, help="Untimed requests per scenario first.")
+        parser.add_argument("--seed", type=int, default=0, help="Random seed of the requests.")
+        parser.add_argument("--output", help="Write the results to this JSON file.")
+        parser.add_argument("--compare", help="Compare with the results in this JSON file.")
+        parser.add_argument("--list", action="store_true", help="List the scenarios and exit.")
+
+    def handle(self, *args, **options):
+        if options["list"]:
+            for scenario in SCENARIOS:
+                self.stdout.write(scenario.name + (" (heavy)" if scenario.heavy else ""))
+            return
+        try:
+            scenarios = get_scenarios(options["scenarios"])
+        except KeyError as exc:
+            raise CommandError(f"Unknown scenarios: {exc.args[0]}; see --list")
+        baseline = None
+        if options["compare"]:
+            with open(options["compare"]) as stream:
+                baseline = json.load(stream)
+
+        url = options["url"]
+        runner = BenchmarkRunner(
+            (lambda: HTTPClient(url)) if url else InProcessClient,
+            BenchmarkContext(options["seed"]),
+            requests=options["requests"],
+            concurrency=options["concurrency"],
+            warmup=options["warmup"],
+        )
+        self.stdout.write(
+            f"{'scenario':<28} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>9} {'queries':>8} {'errors':>7}"
+        )
+        try:
+            results = runner.run(scenarios, progress=self.report)
+        except ValueError as exc:
+            raise CommandError(str(exc))
+
+        if options["output"]:
+            with open(options["output"], "w") as stream:
+                json.dump(results, stream, indent=2)
+            self.stdout.write(f"Results written to {options['output']}")
+        if baseline is not None:
+            self.report_comparison(results, baseline)
+
+    def report(self, name, result):
+        latency = result["latency_ms"]
+        # Unknown over HTTP
+        queries = f"{result['queries_per_request']['mean']:.1f}" if result["queries_per_request"] else "-"
+        self.stdout.write(
+            f"{name:<28} {latency['p50']:>9.2f} {latency['p95']:>9.2f} {latency['p99']:>9.2f} "
+            f"{result['throughput_rps']:>9.0f} {queries:>8} {result['errors']:>7}"
+        )
+
+    def report_comparison(self, results, baseline):
+        self.stdout.write(f"\nCompared with {baseline.get('git_commit') or 'the baseline'} of {baseline.get('created_at')}:")
+        if (baseline.get("mode"), baseline.get("concurrency")) != (results["mode"], results["concurrency"]):
+            self.stdout.write(self.style.WARNING(
+                f"The baseline ran {baseline.get('mode')} with concurrency {baseline.get('concurrency')}, "
+                f"this run {results['mode']} with concurrency {results['concurrency']}."
+            ))
+        for name, metric, before, after in compare(results, baseline):
+            delta = change(before, after)
+            self.stdout.write(
+                f"{name:<28} {metric:<15} {before:>10.2f} -> {after:>10.2f}"
+                + (f" ({delta:+.1f}%)" if delta is not None else "")
+            )
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from recipes.benchmark.data import PASSWORD, STAFF_USERNAME, DataGenerator
+
+
+class Command(BaseCommand):
+    help = (
+        "Seeds the database with synthetic users, ingredients, recipes and comments for the "
+        "benchmarks. The same --seed and --recipes always generate the same data."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--recipes", type=int, default=10000, help="Number of recipes, e.g. 10000 to 1000000.")
+        parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+        parser.add_argument("--batch-size", type=int, default=1000, help="Rows written per transaction.")
+        parser.add_argument("--clear", action="store_true", help="Delete all generated data first.")
+
+    def handle(self, *args, **options):
+        if options["recipes"] < 1:
+            raise CommandError("--recipes must be at least 1")
+        generator = DataGenerator(
+            options["recipes"], seed=options["seed"], batch_size=options["batch_size"],
+            stdout=self.stdout, stderr=self.stderr,
+        )
+        if options["clear"]:
+            self.stdout.write(f"Deleted {generator.clear()} rows of earlier benchmark data.")
+        counts = generator.run()
+        self.stdout.write(self.style.SUCCESS(
+            "Created " + ", ".join(f"{count} {name.replace('_', ' ')}" for name, count in counts.items())
+            + f". Generated users, and the staff user {STAFF_USERNAME}, have the password {PASSWORD!r}."
+        ))
@@ -0,0 +1,352 @@
+"""
+Request metrics in the Prometheus text format.
+
+metrics_middleware records, per resolved route (``recipes-list``, ``recipe-comments-detail``,
+...) and method, histograms of:
+
+* the request duration, by status code as well;
+* the response size;
+* the number of queries and the time spent in them, from an execute wrapper on every connection;
+* the serialization time, from MetricsMixin: read serializers and rendering in the viewsets,
+  and the recipe fast path and fragment cache (``serialization_timer``).
+
+The connection and statement timeout counters of recipes.db and the fragment cache hit counts
+are exported too.
+
+Every process keeps its own metrics. With METRICS_DIR set, each process also writes them to a
+file of its own there, at most every METRICS_FLUSH_INTERVAL seconds, and /metrics adds up the
+files of all processes: that is what makes the numbers whole under a pre-forking server. Empty
+the directory when the server (re)starts, like prometheus_client's multiprocess mode.
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.utils.decorators import sync_and_async_middleware
+
+from .cache import recipe_cache
+from .db import db_stats
+
+PREFIX = "dishcovery"
+SECONDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERIES = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+BYTES = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+# Route of requests no URL pattern matched, so that scanners can't create series at will
+UNMATCHED = "<unmatched>"
+
+_request_metrics = ContextVar("request_metrics", default=None)
+
+
+class RequestMetrics:
+    """
+    What one request did; mutated from every thread the request runs in.
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.serialization_seconds = 0.0
+        # A list to log the queries in, while the request is profiled (see recipes.profiling)
+        self.statements = None
+
+
+class MetricsRegistry:
+    """
+    Histograms, counters and gauges by name and label values.
+
+    Histograms are kept as ``{labels: [bucket counts..., count, sum]}`` with non-cumulative
+    bucket counts, so that the snapshots of several processes can simply be added up.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {
+            "http_request_duration_seconds": (
+                "Time to handle a request.", ("route", "method", "status"), SECONDS),
+            "http_response_size_bytes": (
+                "Size of response bodies (not of streamed ones).", ("route", "method"), BYTES),
+            "db_queries_per_request": (
+                "Database queries made by a request.", ("route", "method"), QUERIES),
+            "db_duration_seconds": (
+                "Time a request spent in database queries.", ("route", "method"), SECONDS),
+            "serialization_duration_seconds": (
+                "Time a request spent serializing and rendering its response.", ("route", "method"), SECONDS),
+        }
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.pid = os.getpid()
+            self.values = {name: {} for name in self.histograms}
+            self.flushed_at = 0.0
+
+    def observe(self, name, labels, value):
+        if self.pid != os.getpid():
+            # Forked from a process that had metrics already; they are that process's.
+            self.reset()
+        buckets = self.histograms[name][2]
+        with self._lock:
+            series = self.values[name].get(labels)
+            if series is None:
+                series = self.values[name][labels] = [0] * (len(buckets) + 2)
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    series[index] += 1
+                    break
+            series[-2] += 1
+            series[-1] += value
+
+    def snapshot(self):
+        """
+        Returns this process's metrics as JSON-compatible data.
+        """
+        with self._lock:
+            histograms = {
+                name: [[list(labels), series] for labels, series in values.items()]
+                for name, values in self.values.items()
+            }
+        database = db_stats.snapshot()
+        connections = database["connections"]
+        counters = {
+            "db_connections_opened_total": [[[alias], stats["opened"]] for alias, stats in connections.items()],
+            "db_connection_checkouts_total": [[[alias], stats["checkouts"]] for alias, stats in connections.items()],
+            "db_connection_reuses_total": [[[alias], stats["reused"]] for alias, stats in connections.items()],
+            "db_connection_failures_total": [[[alias], stats["failed"]] for alias, stats in connections.items()],
+            "db_connection_wait_seconds_total": [
+                [[alias], stats["wait_seconds"]] for alias, stats in connections.items()
+            ],
+            "db_statement_timeouts_total": [
+                [[view], count] for view, count in database["statement_timeouts"].items()
+            ],
+            "recipe_cache_requests_total": [[[result], count] for result, count in recipe_cache.stats().items()],
+        }
+        gauges = {
+            "db_connections_in_use": [[[alias], stats["in_use"]] for alias, stats in connections.items()],
+        }
+        return {"histograms": histograms, "counters": counters, "gauges": gauges}
+
+    def flush(self, force=False):
+        """
+        Writes this process's snapshot to METRICS_DIR, at most every METRICS_FLUSH_INTERVAL seconds.
+        """
+        directory = getattr(settings, "METRICS_DIR", None)
+        if not directory:
+            return
+        now = time.monotonic()
+        if not force and now - self.flushed_at < getattr(settings, "METRICS_FLUSH_INTERVAL", 5):
+            return
+        self.flushed_at = now
+        path = os.path.join(directory, f"metrics-{os.getpid()}.json")
+        # Written to a temporary file and renamed, so that readers never see half a file
+        temporary = f"{path}.tmp"
+        with open(temporary, "w") as stream:
+            json.dump(self.snapshot(), stream)
+        os.replace(temporary, path)
+
+    def collect(self):
+        """
+        Returns the metrics of all processes: this one's, and the files of the others.
+        """
+        snapshots = [self.snapshot()]
+        directory = getattr(settings, "METRICS_DIR", None)
+        if directory and os.path.isdir(directory):
+            own = f"metrics-{os.getpid()}.json"
+            for filename in sorted(os.listdir(directory)):
+                if filename.startswith("metrics-") and filename.endswith(".json") and filename != own:
+                    try:
+                        with open(os.path.join(directory, filename)) as stream:
+                            snapshots.append(json.load(stream))
+                    except (OSError, ValueError):
+                        continue
+        return merge(snapshots)
+
+    def render(self):
+        """
+        Returns the metrics of all processes in the Prometheus text exposition format.
+        """
+        merged = self.collect()
+        lines = []
+        for name, (description, label_names, buckets) in self.histograms.items():
+            metric = f"{PREFIX}_{name}"
+            lines += [f"# HELP {metric} {description}", f"# TYPE {metric} histogram"]
+            for labels, series in sorted(merged["histograms"].get(name, {}).items()):
+                pairs = list(zip(label_names, labels))
+                cumulative = 0
+                for bound, count in zip(buckets, series):
+                    cumulative += count
+                    lines.append(f"{metric}_bucket{format_labels(pairs + [('le', format_value(bound))])} {cumulative}")
+                lines.append(f"{metric}_bucket{format_labels(pairs + [('le', '+Inf')])} {series[-2]}")
+                lines.append(f"{metric}_count{format_labels(pairs)} {series[-2]}")
+                lines.append(f"{metric}_sum{format_labels(pairs)} {format_value(series[-1])}")
+        for kind, metric_type in (("counters", "counter"), ("gauges", "gauge")):
+            for name, values in sorted(merged[kind].items()):
+                metric = f"{PREFIX}_{name}"
+                lines.append(f"# TYPE {metric} {metric_type}")
+                for labels, value in sorted(values.items()):
+                    lines.append(f"{metric}{format_labels(list(zip(LABELS[name], labels)))} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+# Label names of the counters and gauges
+LABELS = {
+    "db_connections_opened_total": ("alias",),
+    "db_connection_checkouts_total": ("alias",),
+    "db_connection_reuses_total": ("alias",),
+    "db_connection_failures_total": ("alias",),
+    "db_connection_wait_seconds_total": ("alias",),
+    "db_statement_timeouts_total": ("view",),
+    "recipe_cache_requests_total": ("result",),
+    "db_connections_in_use": ("alias",),
+}
+
+
+def merge(snapshots):
+    """
+    Adds up snapshots into ``{kind: {name: {labels: value or series}}}``.
+    """
+    merged = {"histograms": {}, "counters": {}, "gauges": {}}
+    for snapshot in snapshots:
+        for name, rows in snapshot.get("histograms", {}).items():
+            values = merged["histograms"].setdefault(name, {})
+            for labels, series in rows:
+                labels = tuple(labels)
+                total = values.get(labels)
+                values[labels] = series if total is None else [a + b for a, b in zip(total, series)]
+        for kind in ("counters", "gauges"):
+            for name, rows in snapshot.get(kind, {}).items():
+                values = merged[kind].setdefault(name, {})
+                for labels, value in rows:
+                    values[tuple(labels)] = values.get(tuple(labels), 0) + value
+    return merged
+
+
+def format_labels(pairs):
+    if not pairs:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+registry = MetricsRegistry()
+
+
+def record_query(execute, sql, params, many, context):
+    """
+    Execute wrapper that adds each query's time to the current request's metrics.
+    """
+    metrics = _request_metrics.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        seconds = time.perf_counter() - started
+        metrics.queries += 1
+        metrics.db_seconds += seconds
+        if metrics.statements is not None:
+            metrics.statements.append(
+                {"alias": context["connection"].alias, "sql": sql, "ms": round(seconds * 1000, 3)}
+            )
+
+
+@receiver(connection_created)
+def time_queries(sender, connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+@contextmanager
+def serialization_timer():
+    """
+    Adds the time spent in the block to the current request's serialization time.
+    """
+    metrics = _request_metrics.get()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if metrics is not None:
+            metrics.serialization_seconds += time.perf_counter() - started
+
+
+def route_of(request):
+    match = getattr(request, "resolver_match", None)
+    return match.view_name if match is not None else UNMATCHED
+
+
+def record_request(request, response, metrics, seconds):
+    labels = (route_of(request), request.method)
+    registry.observe("http_request_duration_seconds", (*labels, str(response.status_code)), seconds)
+    if not response.streaming:
+        registry.observe("http_response_size_bytes", labels, len(response.content))
+    registry.observe("db_queries_per_request", labels, metrics.queries)
+    registry.observe("db_duration_seconds", labels, metrics.db_seconds)
+    registry.observe("serialization_duration_seconds", labels, metrics.serialization_seconds)
+    registry.flush()
+
+
+@sync_and_async_middleware
+def metrics_middleware(get_response):
+    """
+    Records the metrics of every request; goes first in MIDDLEWARE, to time all the others.
+    """
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            metrics = RequestMetrics()
+            token = _request_metrics.set(metrics)
+            started = time.perf_counter()
+            try:
+                response = await get_response(request)
+            finally:
+                _request_metrics.reset(token)
+            record_request(request, response, metrics, time.perf_counter() - started)
+            return response
+    else:
+        def middleware(request):
+            metrics = RequestMetrics()
+            token = _request_metrics.set(metrics)
+            started = time.perf_counter()
+            try:
+                response = get_response(request)
+            finally:
+                _request_metrics.reset(token)
+            record_request(request, response, metrics, time.perf_counter() - started)
+            return response
+    return middleware
+
+
+class MetricsMixin:
+    """
+    Times the serialization of a viewset's responses: read serializers and rendering.
+    """
+
+    def get_serializer(self, *args, **kwargs):
+        serializer = super().get_serializer(*args, **kwargs)
+        if args and "data" not in kwargs:
+            # A read: evaluate the cached .data now, inside the timer
+            with serialization_timer():
+                serializer.data
+        return serializer
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if hasattr(response, "render") and not response.is_rendered:
+            # Django would render it right after the view; rendering here times it.
+            with serialization_timer():
+                response.render()
+        return response
@@ -0,0 +1,49 @@
+# Generated by Django 4.2.6 on 2026-10-18 19:30
+
+from django.db import migrations, models
+import recipes.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0009_importprogress'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('size', models.BigIntegerField(default=0)),
+                ('references', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('modified_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'Media Blob',
+                'verbose_name_plural': 'Media Blobs',
+            },
+        ),
+        migrations.AlterField(
+            model_name='ingredient',
+            name='image',
+            field=models.ImageField(storage=recipes.storage.image_storage, upload_to='images/ingredients/'),
+        ),
+        migrations.AlterField(
+            model_name='profile',
+            name='image',
+            field=models.ImageField(blank=True, null=True, storage=recipes.storage.image_storage, upload_to='images/profiles/'),
+        ),
+        migrations.AlterField(
+            model_name='recipe',
+            name='image',
+            field=models.ImageField(blank=True, null=True, storage=recipes.storage.image_storage, upload_to='images/recipes/'),
+        ),
+        migrations.AlterField(
+            model_name='recipeingredient',
+            name='custom_image',
+            field=models.ImageField(blank=True, null=True, storage=recipes.storage.image_storage, upload_to='images/ingredients/'),
+        ),
+    ]
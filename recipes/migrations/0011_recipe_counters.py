@@ -0,0 +1,48 @@
+# Generated by Django 4.2.6 on 2026-10-18 19:45
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_counters(apps, schema_editor):
+    Recipe = apps.get_model("recipes", "Recipe")
+    RecipeIngredient = apps.get_model("recipes", "RecipeIngredient")
+    Comment = apps.get_model("recipes", "Comment")
+
+    def count(model):
+        rows = model.objects.filter(recipe_id=OuterRef("pk")).order_by().values("recipe_id")
+        return Coalesce(Subquery(rows.annotate(count=Count("pk")).values("count"), output_field=IntegerField()), 0)
+
+    latest = Comment.objects.filter(recipe_id=OuterRef("pk")).order_by("-created_at").values("created_at")[:1]
+    Recipe.objects.using(schema_editor.connection.alias).update(
+        ingredient_count=count(RecipeIngredient),
+        comment_count=count(Comment),
+        latest_comment_at=Subquery(latest),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0010_mediablob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='comment_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='ingredient_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='latest_comment_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
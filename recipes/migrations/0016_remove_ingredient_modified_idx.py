@@ -0,0 +1,17 @@
+# Generated by Django 4.2.6 on 2026-10-18 21:05
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0015_follow_timeline'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='ingredient',
+            name='ingredient_modified_idx',
+        ),
+    ]
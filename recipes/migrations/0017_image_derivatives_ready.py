@@ -0,0 +1,33 @@
+# Generated by Django 4.2.6 on 2026-10-18 21:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0016_remove_ingredient_modified_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ingredient',
+            name='image_derivatives_ready',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='image_derivatives_ready',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='image_derivatives_ready',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.AddField(
+            model_name='recipeingredient',
+            name='custom_image_derivatives_ready',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+    ]
@@ -1,6 +1,10 @@
 from django.db import models
 from django.conf import settings
 from django.contrib import admin
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
+from django.db.models.functions import Lower
+from .storage import image_storage
 
 user = settings.AUTH_USER_MODEL
 
@@ -11,12 +15,15 @@ class Ingredient(models.Model):
     Attributes:
         name (str): The name of the ingredient.
         image (ImageField): An image of the ingredient.
+        image_derivatives_ready (BooleanField): Whether the resized derivatives of the image
+            have been generated (see recipes.images).
         created_at (DateTimeField): The date and time the ingredient was created.
         modified_at (DateTimeField): The date and time the ingredient was last modified.
         created_by (ForeignKey): The user who created the ingredient.
     """
     name = models.CharField(max_length=255, unique=True)
-    image = models.ImageField(upload_to='images/ingredients/')
+    image = models.ImageField(upload_to='images/ingredients/', storage=image_storage)
+    image_derivatives_ready = models.BooleanField(default=False, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     modified_at = models.DateTimeField(auto_now=True)
     created_by = models.ForeignKey(user, on_delete=models.SET_NULL, null=True, blank=True, related_name="+")
@@ -28,6 +35,10 @@ class Ingredient(models.Model):
         ordering = ['name']
         verbose_name = 'Ingredient'
         verbose_name_plural = 'Ingredients'
+        indexes = [
+            # Case-insensitive lookups by name, e.g. ?ingredients_all=Garlic
+            models.Index(Lower('name'), name='ingredient_name_lower_idx'),
+        ]
     
 
 class Recipe(models.Model):
@@ -40,19 +51,36 @@ class Recipe(models.Model):
         time_minutes (IntegerField): The time required to prepare the recipe in minutes.
         description (TextField): The description of the recipe.
         image (ImageField): The image of the recipe.
+        image_derivatives_ready (BooleanField): Whether the resized derivatives of the image
+            have been generated (see recipes.images).
         created_at (DateTimeField): The date and time when the recipe was created.
         modified_at (DateTimeField): The date and time when the recipe was last modified.
+        search_vector (SearchVectorField): The weighted full-text document (title, description and
+            ingredient names), maintained by recipes.search. Only populated on PostgreSQL.
+        ingredient_count (IntegerField): The number of ingredient rows of the recipe.
+        comment_count (IntegerField): The number of comments on the recipe.
+        latest_comment_at (DateTimeField): The creation time of the newest comment (optional).
+
+    The counters are maintained by the signal handlers in recipes.signals; the
+    reconcile_recipe_counters command repairs them if they drift.
     """
+    # Indexed by recipe_user_created_idx, which starts with user
     user = models.ForeignKey(
         user,
-        on_delete=models.CASCADE
+        on_delete=models.CASCADE,
+        db_index=False,
     )
     title = models.CharField(max_length=255)
     time_minutes = models.IntegerField()
     description = models.TextField()
-    image = models.ImageField(upload_to='images/recipes/', blank=True, null=True)
+    image = models.ImageField(upload_to='images/recipes/', storage=image_storage, blank=True, null=True)
+    image_derivatives_ready = models.BooleanField(default=False, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     modified_at = models.DateTimeField(auto_now=True)
+    search_vector = SearchVectorField(null=True, editable=False)
+    ingredient_count = models.IntegerField(default=0, editable=False)
+    comment_count = models.IntegerField(default=0, editable=False)
+    latest_comment_at = models.DateTimeField(null=True, blank=True, editable=False)
     
 
     def __str__(self):
@@ -62,6 +90,16 @@ class Recipe(models.Model):
         ordering = ['created_at']
         verbose_name = 'Recipe'
         verbose_name_plural = 'Recipes'
+        indexes = [
+            GinIndex(fields=['search_vector'], name='recipe_search_vector_gin'),
+            # The default order, with the primary key as the keyset pagination's tiebreaker
+            models.Index(fields=['created_at', 'id'], name='recipe_created_idx'),
+            # A user's recipes in the default order; also serves the user foreign key
+            models.Index(fields=['user', 'created_at'], name='recipe_user_created_idx'),
+            models.Index(fields=['time_minutes'], name='recipe_time_minutes_idx'),
+            # The recipes modified since a date: exports and the similar-recipes index refresh
+            models.Index(fields=['modified_at'], name='recipe_modified_idx'),
+        ]
 
 
 class RecipeIngredient(models.Model):
@@ -73,13 +111,17 @@ class RecipeIngredient(models.Model):
         recipe (ForeignKey): The recipe that uses the ingredient.
         custom_name (CharField): A custom name for the ingredient (optional).
         custom_image (ImageField): An image of the ingredient (optional).
+        custom_image_derivatives_ready (BooleanField): Whether the resized derivatives of the
+            custom image have been generated (see recipes.images).
         amount (DecimalField): The amount of the ingredient used in the recipe.
         unit (CharField): The unit of measurement for the ingredient amount (optional).
     """
-    ingredient = models.ForeignKey(Ingredient, on_delete=models.CASCADE, related_name="recipes")
-    recipe = models.ForeignKey(Recipe, on_delete=models.CASCADE, related_name="ingredients")
+    # Both foreign keys are indexed by the composite indexes below, which start with them
+    ingredient = models.ForeignKey(Ingredient, on_delete=models.CASCADE, related_name="recipes", db_index=False)
+    recipe = models.ForeignKey(Recipe, on_delete=models.CASCADE, related_name="ingredients", db_index=False)
     custom_name = models.CharField(max_length=255, blank=True, null=True)
-    custom_image = models.ImageField(upload_to='images/ingredients/', blank=True, null=True)
+    custom_image = models.ImageField(upload_to='images/ingredients/', storage=image_storage, blank=True, null=True)
+    custom_image_derivatives_ready = models.BooleanField(default=False, editable=False)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     unit = models.CharField(max_length=255, blank=True, null=True)
     
@@ -89,6 +131,13 @@ class RecipeIngredient(models.Model):
     class Meta:
         verbose_name = 'Recipe Ingredient'
         verbose_name_plural = 'Recipe Ingredients'
+        indexes = [
+            # Recipes using an ingredient, straight from the index (see recipes.filters)
+            models.Index(fields=['ingredient', 'recipe'], name='recipeingredient_ingr_rec_idx'),
+            # The ingredients of a recipe; covers the counters and the pantry index without
+            # reading the table
+            models.Index(fields=['recipe', 'ingredient'], name='recipeingredient_rec_ingr_idx'),
+        ]
 
 
 class Comment(models.Model):
@@ -102,7 +151,8 @@ class Comment(models.Model):
         created_at (DateTimeField): The timestamp indicating when the comment was created.
         modified_at (DateTimeField): The timestamp indicating when the comment was last modified.
     """
-    recipe = models.ForeignKey(Recipe, on_delete=models.CASCADE, related_name="comments")
+    # Indexed by comment_recipe_created_idx, which starts with recipe
+    recipe = models.ForeignKey(Recipe, on_delete=models.CASCADE, related_name="comments", db_index=False)
     user = models.ForeignKey(user, on_delete=models.CASCADE)
     comment = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
@@ -115,6 +165,10 @@ class Comment(models.Model):
         ordering = ['created_at']
         verbose_name = 'Comment'
         verbose_name_plural = 'Comments'
+        indexes = [
+            # A recipe's comments in order
+            models.Index(fields=['recipe', 'created_at'], name='comment_recipe_created_idx'),
+        ]
         
         
 class Profile(models.Model):
@@ -124,15 +178,23 @@ class Profile(models.Model):
     Attributes:
         user (User): A one-to-one field to the User model.
         image (ImageField): An image field for the user's profile picture.
+        image_derivatives_ready (BooleanField): Whether the resized derivatives of the image
+            have been generated (see recipes.images).
         bio (TextField): A text field for the user's bio.
         phone_number (CharField): A char field for the user's phone number.
+        follower_count (IntegerField): The number of users following the user, kept by signals.
+        fan_out_on_read (BooleanField): Whether the user's recipes are merged into their followers'
+            feeds at read time instead of being pushed to their timelines (see recipes.feed).
         created_at (DateTimeField): A date time field for the creation date of the profile.
         modified_at (DateTimeField): A date time field for the last modification date of the profile.
     """
     user = models.OneToOneField(user, on_delete=models.CASCADE)
-    image = models.ImageField(upload_to='images/profiles/', blank=True, null=True)
+    image = models.ImageField(upload_to='images/profiles/', storage=image_storage, blank=True, null=True)
+    image_derivatives_ready = models.BooleanField(default=False, editable=False)
     bio = models.TextField(blank=True, null=True)
     phone_number = models.CharField(max_length=255, blank=True, null=True)
+    follower_count = models.IntegerField(default=0)
+    fan_out_on_read = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
     modified_at = models.DateTimeField(auto_now=True)
     
@@ -151,4 +213,181 @@ class Profile(models.Model):
     class Meta:
         ordering = ['user__first_name', 'user__last_name']
         verbose_name = 'Profile'
-        verbose_name_plural = 'Profiles'
\ No newline at end of file
+        verbose_name_plural = 'Profiles'
+
+
+class Follow(models.Model):
+    """
+    A model representing a user following the recipes of another user.
+
+    Attributes:
+        follower (ForeignKey): The user who follows.
+        followee (ForeignKey): The user who is followed.
+        created_at (DateTimeField): The date and time the user started following.
+    """
+    # Both foreign keys are indexed by the unique constraint and the index below, which start with them
+    follower = models.ForeignKey(user, on_delete=models.CASCADE, related_name='following', db_index=False)
+    followee = models.ForeignKey(user, on_delete=models.CASCADE, related_name='followers', db_index=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.follower} follows {self.followee}"
+
+    class Meta:
+        ordering = ['-created_at']
+        verbose_name = 'Follow'
+        verbose_name_plural = 'Follows'
+        constraints = [
+            models.UniqueConstraint(fields=['follower', 'followee'], name='follow_unique'),
+            models.CheckConstraint(check=~models.Q(follower=models.F('followee')), name='follow_not_self'),
+        ]
+        indexes = [
+            # The followers of a user in id order, walked in batches by the feed fan-out
+            models.Index(fields=['followee', 'follower'], name='follow_followee_follower_idx'),
+        ]
+
+
+class TimelineEntry(models.Model):
+    """
+    A model representing a recipe pushed to the home timeline of a follower of its author (see recipes.feed).
+
+    Attributes:
+        user (ForeignKey): The user whose timeline it is.
+        recipe (ForeignKey): The recipe.
+        created_at (DateTimeField): The creation date and time of the recipe, the order of the timeline.
+    """
+    # Indexed by the timeline index below, which starts with it
+    user = models.ForeignKey(user, on_delete=models.CASCADE, related_name='timeline', db_index=False)
+    recipe = models.ForeignKey(Recipe, on_delete=models.CASCADE, related_name='timeline_entries')
+    created_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.recipe_id} in the timeline of {self.user_id}"
+
+    class Meta:
+        verbose_name = 'Timeline Entry'
+        verbose_name_plural = 'Timeline Entries'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'recipe'], name='timelineentry_unique'),
+        ]
+        indexes = [
+            # A page of a timeline, newest first, read from the index alone
+            models.Index(fields=['user', '-created_at', '-recipe'], name='timeline_user_created_idx'),
+        ]
+
+
+class ImportProgress(models.Model):
+    """
+    A model recording how far a bulk import has got, so it can resume after a crash.
+
+    The position is updated in the same transaction as the rows of each batch.
+
+    Attributes:
+        key (CharField): The import source and shard, e.g. "/data/recipes.jsonl:0/4".
+        position (BigIntegerField): The number of input records of the source already processed.
+        created_at (DateTimeField): The date and time the import started.
+        modified_at (DateTimeField): The date and time the last batch was committed.
+    """
+    key = models.CharField(max_length=1024, unique=True)
+    position = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    modified_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.key} @ {self.position}"
+
+    class Meta:
+        verbose_name = 'Import Progress'
+        verbose_name_plural = 'Import Progress'
+
+
+class MediaBlob(models.Model):
+    """
+    A model representing a file in the content-addressed media store (see recipes.storage).
+
+    Attributes:
+        name (CharField): The storage name of the blob, derived from its SHA-256 digest.
+        size (BigIntegerField): The size of the file in bytes.
+        references (IntegerField): The number of image fields pointing at the blob.
+        created_at (DateTimeField): The date and time the blob was first stored.
+        modified_at (DateTimeField): The date and time the reference count last changed, or the
+            file was last uploaded again.
+    """
+    name = models.CharField(max_length=255, unique=True)
+    size = models.BigIntegerField(default=0)
+    references = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    modified_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} ({self.references} references)"
+
+    class Meta:
+        verbose_name = 'Media Blob'
+        verbose_name_plural = 'Media Blobs'
+
+
+class RequestProfile(models.Model):
+    """
+    A model holding the profile of one API request, taken on demand by a staff user (see recipes.profiling).
+
+    Attributes:
+        user (ForeignKey): The staff user who asked for the profile.
+        method (CharField): The HTTP method of the request.
+        path (CharField): The path and query string of the request.
+        route (CharField): The name of the URL pattern the request resolved to.
+        status_code (IntegerField): The status code of the response.
+        duration_ms (FloatField): The time taken by the request, profiler overhead included.
+        query_count (IntegerField): The number of SQL queries the request made.
+        query_ms (FloatField): The time spent in SQL queries.
+        queries (JSONField): The SQL queries with their database alias and time, in order.
+        stats (TextField): The profiler's report, by cumulative time.
+        data (BinaryField): The profile in the pstats format, for snakeviz and the like.
+        created_at (DateTimeField): The date and time the request was made.
+    """
+    user = models.ForeignKey(user, on_delete=models.SET_NULL, null=True, blank=True)
+    method = models.CharField(max_length=10)
+    path = models.CharField(max_length=2048)
+    route = models.CharField(max_length=255, blank=True)
+    status_code = models.IntegerField()
+    duration_ms = models.FloatField()
+    query_count = models.IntegerField(default=0)
+    query_ms = models.FloatField(default=0)
+    queries = models.JSONField(default=list)
+    stats = models.TextField(blank=True)
+    data = models.BinaryField(editable=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.method} {self.path} ({self.duration_ms:.0f} ms)"
+
+    class Meta:
+        ordering = ['-created_at']
+        verbose_name = 'Request Profile'
+        verbose_name_plural = 'Request Profiles'
+
+
+class Tombstone(models.Model):
+    """
+    A model recording a deleted row, so that the in-memory indexes of other worker processes can
+    drop it (see recipes.refresh). Tombstones are pruned by the prune_tombstones command.
+
+    Attributes:
+        model (CharField): The label of the deleted row's model, e.g. "recipes.recipe".
+        object_id (BigIntegerField): The primary key of the deleted row.
+        deleted_at (DateTimeField): The date and time the row was deleted.
+    """
+    model = models.CharField(max_length=100)
+    object_id = models.BigIntegerField()
+    deleted_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.model} {self.object_id}"
+
+    class Meta:
+        verbose_name = 'Tombstone'
+        verbose_name_plural = 'Tombstones'
+        indexes = [
+            # The rows of a model deleted since an index's last refresh
+            models.Index(fields=['model', 'deleted_at'], name='tombstone_model_deleted_idx'),
+        ]
@@ -1,5 +1,274 @@
-from rest_framework.pagination import PageNumberPagination
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
+from django.core.paginator import InvalidPage
+from django.db.models import Q, QuerySet
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Keyset (cursor) pagination.
+
+    Pages are ordered by one of the view's ordering fields (``?ordering=``, falling back to the
+    model's default ordering) with the primary key as a unique tiebreaker. The cursor encodes the
+    (value, id) of the last row seen, so every page is a ``WHERE (field, id) > (value, id)`` range
+    scan: no COUNT(*) and no OFFSET, and deep pages are as cheap as the first one.
+
+    A relevance rank has no cursor value, so search results (a filter backend of the view with
+    search terms in the request) are only paged by cursor in an explicit ``?ordering=``.
+    """
+    page_size = 10
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+    cursor_query_param = 'cursor'
+    ordering_query_param = 'ordering'
+    invalid_cursor_message = 'Invalid cursor'
+    ranked_message = (
+        "Search results are ordered by relevance, which cursor pages can't follow. "
+        "Use page numbers, or give an ordering."
+    )
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def get_requested_ordering(self, request, queryset, view):
+        """
+        Returns (field_name, descending) for the ``?ordering=`` of the request, or None when it
+        gives none the pages can follow.
+        """
+        # A (value, id) cursor can't express NULLs, so nullable fields fall back to the default.
+        model = queryset.model
+        allowed = [
+            field for field in getattr(view, 'ordering_fields', None) or []
+            if not model._meta.get_field(field).null
+        ]
+        requested = request.query_params.get(self.ordering_query_param, '').split(',')[0].strip()
+        if requested.lstrip('-') in allowed:
+            return requested.lstrip('-'), requested.startswith('-')
+        return None
+
+    def get_ordering(self, request, queryset, view):
+        """
+        Returns (field_name, descending) for the page ordering.
+
+        Raises:
+            ValidationError: The view ranks search results and no ordering was requested.
+        """
+        requested = self.get_requested_ordering(request, queryset, view)
+        if requested is not None:
+            return requested
+        if self.is_ranked(request, view):
+            raise ValidationError({self.cursor_query_param: [self.ranked_message]})
+        default = queryset.model._meta.ordering[0]
+        return default.lstrip('-'), default.startswith('-')
+
+    def is_ranked(self, request, view):
+        return any(
+            backend().get_search_terms(request)
+            for backend in getattr(view, 'filter_backends', None) or []
+            if hasattr(backend, 'get_search_terms')
+        )
+
+    def encode_cursor(self, value, pk, reverse):
+        payload = {'v': value.isoformat() if hasattr(value, 'isoformat') else value, 'id': pk}
+        if reverse:
+            payload['r'] = 1
+        raw = json.dumps(payload, default=str, separators=(',', ':')).encode()
+        return urlsafe_b64encode(raw).decode().rstrip('=')
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            payload = json.loads(urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4)))
+            field = self.queryset.model._meta.get_field(self.field)
+            return field.to_python(payload['v']), int(payload['id']), bool(payload.get('r'))
+        except (TypeError, ValueError, KeyError, AttributeError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return self.set_page(list(self.get_page_queryset(queryset, request, view)))
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        return self.set_page([row async for row in self.get_page_queryset(queryset, request, view)])
+
+    def get_page_queryset(self, queryset, request, view):
+        """
+        Returns the query for the requested page, plus one row to tell whether there are more.
+        """
+        self.request = request
+        self.queryset = queryset
+        self.page_size = self.get_page_size(request)
+        self.field, descending = self.get_ordering(request, queryset, view)
+
+        self.cursor = cursor = self.decode_cursor(request)
+        reverse = bool(cursor and cursor[2])
+        # Walking backwards means flipping the comparison and the order, then the rows.
+        backwards = descending != reverse
+        prefix = '-' if backwards else ''
+        queryset = queryset.order_by(f'{prefix}{self.field}', f'{prefix}pk')
+
+        if cursor is not None:
+            value, pk, _ = cursor
+            lookup = 'lt' if backwards else 'gt'
+            queryset = queryset.filter(
+                Q(**{f'{self.field}__{lookup}': value})
+                | Q(**{self.field: value, f'pk__{lookup}': pk})
+            )
+        return queryset[:self.page_size + 1]
+
+    def set_page(self, rows):
+        cursor = self.cursor
+        reverse = bool(cursor and cursor[2])
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if reverse:
+            rows.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, cursor is not None
+        self.page = rows
+        return rows
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        last = self.page[-1]
+        cursor = self.encode_cursor(getattr(last, self.field), last.pk, reverse=False)
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, cursor)
+
+    def get_previous_link(self):
+        if not self.has_previous or not self.page:
+            return None
+        first = self.page[0]
+        cursor = self.encode_cursor(getattr(first, self.field), first.pk, reverse=True)
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, cursor)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+
+class TimelinePagination(KeysetPagination):
+    """
+    Keyset pagination of a feed, newest first, whose rows the view fetches itself.
+
+    The cursor is the (created_at, id) of the last recipe seen, as with KeysetPagination, and
+    only goes forward.
+    """
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            payload = json.loads(urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4)))
+            created_at = parse_datetime(payload['v'])
+            if created_at is None:
+                raise ValueError(payload['v'])
+            return created_at, int(payload['id'])
+        except (TypeError, ValueError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def paginate_timeline(self, fetch, request):
+        """
+        Returns the (created_at, id) rows of the requested page.
+
+        Args:
+            fetch (callable): Takes a cursor (or None) and a limit, and returns up to that many
+                (created_at, id) rows after the cursor, newest first.
+            request (Request): The request.
+        """
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        rows = fetch(self.decode_cursor(request), self.page_size + 1)
+        self.has_next, self.has_previous = len(rows) > self.page_size, False
+        self.page = rows[:self.page_size]
+        return self.page
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        created_at, pk = self.page[-1]
+        cursor = self.encode_cursor(created_at, pk, reverse=False)
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, cursor)
+
 
 class DefaultPagination(PageNumberPagination):
+    """
+    Page number pagination with a per-request opt-in to keyset pagination.
+
+    Clients switch to keyset pagination with ``?pagination=cursor`` and then follow the
+    ``next``/``previous`` links, which carry a ``?cursor=``. Without either parameter the usual
+    ``?page=`` pagination is used.
+    """
     page_size = 10
-    page_size_query_param = 'page_size'
\ No newline at end of file
+    page_size_query_param = 'page_size'
+    mode_query_param = 'pagination'
+    keyset_class = KeysetPagination
+
+    def wants_keyset(self, request):
+        return (
+            request.query_params.get(self.mode_query_param) == 'cursor'
+            or self.keyset_class.cursor_query_param in request.query_params
+        )
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = None
+        if isinstance(queryset, QuerySet) and self.wants_keyset(request):
+            self.keyset = self.keyset_class()
+            return self.keyset.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        """
+        Like paginate_queryset(), with the count and the page fetched with the async ORM.
+        """
+        self.keyset = None
+        if self.wants_keyset(request):
+            self.keyset = self.keyset_class()
+            return await self.keyset.apaginate_queryset(queryset, request, view)
+
+        self.request = request
+        page_size = self.get_page_size(request)
+        if not page_size:
+            return None
+        paginator = self.django_paginator_class(queryset, page_size)
+        paginator.count = await queryset.acount()
+        page_number = self.get_page_number(request, paginator)
+        try:
+            self.page = paginator.page(page_number)
+        except InvalidPage as exc:
+            raise NotFound(self.invalid_page_message.format(page_number=page_number, message=str(exc)))
+        self.page.object_list = [row async for row in self.page.object_list]
+        if paginator.num_pages > 1 and self.template is not None:
+            self.display_page_controls = True
+        return list(self.page)
+
+    def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data)
+        return super().get_paginated_response(data)
+
+
+class OptInKeysetPagination(DefaultPagination):
+    """
+    No pagination unless the client opts in to keyset pagination, for lists that have always been
+    returned whole: without ``?pagination=cursor`` or ``?cursor=`` the response is a bare list.
+    """
+
+    def get_page_size(self, request):
+        return None
@@ -0,0 +1,327 @@
+"""
+In-memory ingredient index for "what can I cook" queries.
+
+The index maps every ingredient id to a bitset (a Python int) with bit ``n`` set when recipe
+``n`` uses that ingredient. Recipes are grouped by their number of distinct ingredients in the
+same way. A bitset takes a bit per recipe id up to the largest, so the recipes of a rare
+ingredient are kept as a set of ids instead, and turned into a bitset when a match needs it. A
+pantry match then only needs whole-bitset arithmetic:
+
+- the pantry's bitsets are summed into bit-sliced counters, giving every recipe's number of
+  matched ingredients at once;
+- intersecting "matched == size - m" with each size group yields the recipes missing exactly
+  ``m`` ingredients.
+
+The index is built from RecipeIngredient when a worker process starts. It lives in process
+memory, so every worker process holds its own copy: the signal handlers in recipes.signals apply
+the changes committed by this process, and the changes of other processes are picked up by
+refresh() (see recipes.refresh).
+"""
+import threading
+from collections import defaultdict
+
+from .models import Recipe, RecipeIngredient
+from .refresh import RefreshClock, deleted_since
+
+# Roughly the bits a set takes per recipe id: the recipes of an ingredient are kept as a set while
+# a bitset of them (a bit per recipe id up to the largest) would take more memory
+SET_BITS_PER_ID = 512
+
+
+def _add(counter, bits):
+    """
+    Adds a bitset to bit-sliced counters (least significant slice first), in place.
+    """
+    carry = bits
+    for i, value in enumerate(counter):
+        if not carry:
+            return
+        counter[i], carry = value ^ carry, value & carry
+    if carry:
+        counter.append(carry)
+
+
+def _equal(counter, value, universe):
+    """
+    Returns the bitset of positions whose counter equals value, limited to universe.
+    """
+    if value >> len(counter):
+        return 0
+    result = universe
+    for i, bits in enumerate(counter):
+        result &= bits if (value >> i) & 1 else ~bits
+        if not result:
+            break
+    return result
+
+
+def _positions(bits):
+    """
+    Yields the set bit positions of a bitset in ascending order.
+    """
+    data = bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+    for index, byte in enumerate(data):
+        while byte:
+            low = byte & -byte
+            yield index * 8 + low.bit_length() - 1
+            byte ^= low
+
+
+class PantryMatches:
+    """
+    Lazy, sliceable sequence of (recipe_id, missing_count) pairs.
+
+    Only the bits of the requested slice are decoded, so paginating over a large match is cheap.
+    """
+
+    def __init__(self, groups):
+        self._groups = [(missing, bits, bits.bit_count()) for missing, bits in groups if bits]
+
+    def __len__(self):
+        return sum(count for _, _, count in self._groups)
+
+    def __iter__(self):
+        for missing, bits, _ in self._groups:
+            for recipe_id in _positions(bits):
+                yield recipe_id, missing
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return list(self)[index]
+        start, stop, step = index.indices(len(self))
+        results = []
+        for missing, bits, count in self._groups:
+            if stop <= 0:
+                break
+            if start < count:
+                for i, recipe_id in enumerate(_positions(bits)):
+                    if i >= stop:
+                        break
+                    if i >= start:
+                        results.append((recipe_id, missing))
+            start = max(start - count, 0)
+            stop -= count
+        return results[::step]
+
+
+class PantryIndex:
+    """
+    Inverted index from ingredient id to the bitset of recipe ids using it.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._clock = RefreshClock()
+        self._built = False
+        self._ingredients = {}
+        self._size_groups = {}
+        self._recipes = {}
+        # The largest recipe id indexed, the length of the bitsets
+        self._last_recipe_id = 0
+        # Bumped whenever the recipes of an ingredient may have changed
+        self._version = 0
+
+    def build(self):
+        """
+        (Re)builds the index from the database in one pass over RecipeIngredient.
+        """
+        self._clock.start()
+        recipes = defaultdict(set)
+        rows = RecipeIngredient.objects.values_list("recipe_id", "ingredient_id")
+        for recipe_id, ingredient_id in rows.iterator(chunk_size=10000):
+            recipes[recipe_id].add(ingredient_id)
+
+        postings = defaultdict(list)
+        sizes = defaultdict(list)
+        for recipe_id, ingredient_ids in recipes.items():
+            sizes[len(ingredient_ids)].append(recipe_id)
+            for ingredient_id in ingredient_ids:
+                postings[ingredient_id].append(recipe_id)
+
+        with self._lock:
+            self._recipes = {recipe_id: tuple(ids) for recipe_id, ids in recipes.items()}
+            self._last_recipe_id = max(recipes, default=0)
+            self._ingredients = {key: self._postings(ids) for key, ids in postings.items()}
+            self._size_groups = {key: self._bitset(ids) for key, ids in sizes.items()}
+            self._version += 1
+            self._built = True
+
+    @staticmethod
+    def _bitset(recipe_ids):
+        buffer = bytearray(max(recipe_ids) // 8 + 1)
+        for recipe_id in recipe_ids:
+            buffer[recipe_id >> 3] |= 1 << (recipe_id & 7)
+        return int.from_bytes(buffer, "little")
+
+    def _postings(self, recipe_ids):
+        """
+        Returns the recipes of an ingredient as a set of ids or a bitset, whichever is smaller.
+        """
+        if len(recipe_ids) * SET_BITS_PER_ID < self._last_recipe_id:
+            return set(recipe_ids)
+        return self._bitset(recipe_ids)
+
+    def _bits(self, ingredient_id):
+        postings = self._ingredients.get(ingredient_id, 0)
+        return self._bitset(postings) if isinstance(postings, set) else postings
+
+    def reset(self):
+        """
+        Drops the index; it will be rebuilt on the next match.
+        """
+        with self._lock:
+            self._built = False
+            self._clock.reset()
+            self._ingredients = {}
+            self._size_groups = {}
+            self._recipes = {}
+            self._last_recipe_id = 0
+
+    def _toggle(self, table, key, bit):
+        bits = table.get(key, 0) ^ bit
+        if bits:
+            table[key] = bits
+        else:
+            table.pop(key, None)
+
+    def _toggle_posting(self, ingredient_id, recipe_id):
+        postings = self._ingredients.setdefault(ingredient_id, set())
+        if isinstance(postings, set):
+            postings ^= {recipe_id}
+            if not postings:
+                del self._ingredients[ingredient_id]
+            elif len(postings) * SET_BITS_PER_ID >= self._last_recipe_id:
+                self._ingredients[ingredient_id] = self._bitset(postings)
+            return
+        self._toggle(self._ingredients, ingredient_id, 1 << recipe_id)
+        bits = self._ingredients.get(ingredient_id, 0)
+        if bits and bits.bit_count() * SET_BITS_PER_ID < self._last_recipe_id:
+            self._ingredients[ingredient_id] = set(_positions(bits))
+
+    def _set_recipe(self, recipe_id, ingredient_ids):
+        self._version += 1
+        self._last_recipe_id = max(self._last_recipe_id, recipe_id)
+        bit = 1 << recipe_id
+        old = self._recipes.pop(recipe_id, ())
+        if old:
+            self._toggle(self._size_groups, len(old), bit)
+        for ingredient_id in set(old) ^ set(ingredient_ids):
+            self._toggle_posting(ingredient_id, recipe_id)
+        if ingredient_ids:
+            self._recipes[recipe_id] = tuple(ingredient_ids)
+            self._toggle(self._size_groups, len(ingredient_ids), bit)
+
+    def update_recipe(self, recipe_id):
+        """
+        Reloads one recipe's ingredients from the database.
+        """
+        self.update_recipes([recipe_id])
+
+    def update_recipes(self, recipe_ids):
+        """
+        Reloads the ingredients of several recipes from the database in one query.
+        """
+        with self._lock:
+            if not self._built:
+                return
+            ingredients = {recipe_id: set() for recipe_id in recipe_ids}
+            rows = RecipeIngredient.objects.filter(recipe_id__in=ingredients)
+            for recipe_id, ingredient_id in rows.values_list("recipe_id", "ingredient_id"):
+                ingredients[recipe_id].add(ingredient_id)
+            for recipe_id, ingredient_ids in ingredients.items():
+                self._set_recipe(recipe_id, ingredient_ids)
+
+    def remove_recipe(self, recipe_id):
+        with self._lock:
+            if self._built:
+                self._set_recipe(recipe_id, ())
+
+    def refresh(self):
+        """
+        Reloads the recipes other processes have changed since the last refresh, once
+        INDEX_REFRESH_INTERVAL has passed, and drops the deleted ones.
+        """
+        with self._lock:
+            since = self._clock.due() if self._built else None
+            if since is None:
+                return
+            deleted = deleted_since(Recipe, since)
+            if deleted is None:
+                deleted = self._recipes.keys() - set(Recipe.objects.values_list("pk", flat=True))
+            for recipe_id in deleted:
+                self._set_recipe(recipe_id, ())
+            self.update_recipes(Recipe.objects.filter(modified_at__gte=since).values_list("pk", flat=True))
+
+    def _ensure_built(self):
+        if self._built:
+            self.refresh()
+        else:
+            self.build()
+
+    def warm_up(self):
+        """
+        Builds the index ahead of its first lookup.
+        """
+        with self._lock:
+            self._ensure_built()
+
+    def recipe_counts(self, ingredient_ids):
+        """
+        Returns the number of recipes using each of the given ingredients, by ingredient id.
+        """
+        with self._lock:
+            self._ensure_built()
+            return {i: self._count(self._ingredients[i]) for i in ingredient_ids if i in self._ingredients}
+
+    @staticmethod
+    def _count(postings):
+        return len(postings) if isinstance(postings, set) else postings.bit_count()
+
+    def version(self):
+        """
+        Returns a number that changes whenever the recipe counts may have changed, so that results
+        derived from them can be cached.
+        """
+        with self._lock:
+            self._ensure_built()
+            return self._version
+
+    def match(self, ingredient_ids, max_missing=None):
+        """
+        Ranks recipes by how well the given ingredients cover them.
+
+        Args:
+            ingredient_ids (iterable): The ids of the ingredients in the pantry.
+            max_missing (int): Skip recipes missing more ingredients than this (optional).
+
+        Returns:
+            PantryMatches: (recipe_id, missing_count) pairs; fully cookable recipes first, then by
+            the fewest missing ingredients, then by recipe id.
+        """
+        with self._lock:
+            self._ensure_built()
+            bitsets = [self._bits(i) for i in set(ingredient_ids)]
+            size_groups = sorted(self._size_groups.items())
+
+        counter = []
+        candidates = 0
+        for bits in bitsets:
+            if bits:
+                _add(counter, bits)
+                candidates |= bits
+        if not candidates:
+            return PantryMatches([])
+
+        largest = size_groups[-1][0]
+        missing_limit = largest if max_missing is None else min(max_missing, largest)
+        groups = []
+        for missing in range(missing_limit + 1):
+            found = 0
+            for size, group in size_groups:
+                if size > missing:
+                    found |= _equal(counter, size - missing, group & candidates)
+            groups.append((missing, found))
+        return PantryMatches(groups)
+
+
+pantry_index = PantryIndex()
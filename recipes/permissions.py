@@ -1,3 +1,5 @@
+from django.conf import settings
+from django.utils.crypto import constant_time_compare
 from rest_framework.permissions import BasePermission, SAFE_METHODS
 
 class IsOwner(BasePermission):
@@ -18,4 +20,15 @@ class IsAuthenticatedOrReadOnly(BasePermission):
             request.method in SAFE_METHODS or
             request.user and
             request.user.is_authenticated
-        )
\ No newline at end of file
+        )
+
+class IsAdminOrMetricsScraper(BasePermission):
+    """
+    Allows access to staff users, and to scrapers that send METRICS_TOKEN as a bearer token.
+    """
+    def has_permission(self, request, view):
+        if request.user and request.user.is_staff:
+            return True
+        token = getattr(settings, "METRICS_TOKEN", "")
+        header = request.headers.get("Authorization", "")
+        return bool(token) and constant_time_compare(header, f"Bearer {token}")
@@ -0,0 +1,175 @@
+"""
+On-demand profiling of single API requests by staff users.
+
+A staff user, authenticated with their JWT like on any API request, adds ``X-Profile: 1`` (or
+``?profile=1``) to a request: it then runs under cProfile, and the profile is saved as a
+RequestProfile, with the request's SQL queries and their times, and listed in the admin. The
+response carries the id of the profile in ``X-Profile-Id``; ``X-Profile: text`` (or
+``?profile=text``) returns the report instead of the response.
+
+Other requests only pay for a header lookup and a substring test: the JWT is only checked on
+requests that ask for a profile, and queries are logged by recipes.metrics' execute wrapper,
+which runs anyway. Requests that ask for a profile without being staff are served as usual.
+
+Under ASGI, the profile is of the event loop's thread: it misses the code sync views run in a
+worker thread (their queries are logged all the same), and can include other requests served
+concurrently.
+"""
+import cProfile
+import io
+import marshal
+import pstats
+import time
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.decorators import sync_and_async_middleware
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+from .metrics import RequestMetrics, _request_metrics, route_of
+from .models import RequestProfile
+
+PROFILE_HEADER = "HTTP_X_PROFILE"
+PROFILE_PARAMETER = "profile"
+TEXT = "text"
+
+
+def requested_mode(request):
+    """
+    Returns the value of the profile header or query parameter, or None.
+    """
+    mode = request.META.get(PROFILE_HEADER)
+    # request.GET is only parsed when the query string may ask for a profile
+    if mode is None and f"{PROFILE_PARAMETER}=" in request.META.get("QUERY_STRING", ""):
+        mode = request.GET.get(PROFILE_PARAMETER)
+    return mode or None
+
+
+def staff_user(request):
+    """
+    Returns the active staff user the request's JWT authenticates, or None.
+    """
+    try:
+        authenticated = JWTAuthentication().authenticate(request)
+    except AuthenticationFailed:
+        return None
+    if authenticated is None:
+        return None
+    user = authenticated[0]
+    return user if user.is_active and user.is_staff else None
+
+
+class RequestProfiler:
+    """
+    Profiles one request, from start() to stop(), and saves the profile.
+    """
+
+    def __init__(self, request, user, mode):
+        self.request = request
+        self.user = user
+        self.mode = mode
+        self.profiler = cProfile.Profile()
+
+    def start(self):
+        self.metrics = _request_metrics.get()
+        self.token = None
+        if self.metrics is None:
+            # metrics_middleware isn't installed; log the queries all the same
+            self.metrics = RequestMetrics()
+            self.token = _request_metrics.set(self.metrics)
+        self.metrics.statements = []
+        self.started = time.perf_counter()
+        self.profiler.enable()
+
+    def stop(self):
+        self.profiler.disable()
+        self.duration = time.perf_counter() - self.started
+        self.statements = self.metrics.statements
+        self.metrics.statements = None
+        if self.token is not None:
+            _request_metrics.reset(self.token)
+
+    def save(self, response):
+        """
+        Saves the profile and returns the response to send.
+        """
+        stream = io.StringIO()
+        stats = pstats.Stats(self.profiler, stream=stream)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(settings.PROFILE_STATS_LIMIT)
+        # Not counted in the request's metrics
+        token = _request_metrics.set(None)
+        try:
+            profile = RequestProfile.objects.create(
+                user=self.user,
+                method=self.request.method,
+                path=self.request.get_full_path()[:2048],
+                route=route_of(self.request),
+                status_code=response.status_code,
+                duration_ms=self.duration * 1000,
+                query_count=len(self.statements),
+                query_ms=sum(statement["ms"] for statement in self.statements),
+                queries=self.statements,
+                stats=stream.getvalue(),
+                # What pstats.Stats.dump_stats() writes
+                data=marshal.dumps(stats.stats),
+            )
+        finally:
+            _request_metrics.reset(token)
+
+        if self.mode == TEXT:
+            response = HttpResponse(report(profile), content_type="text/plain; charset=utf-8")
+        response["X-Profile-Id"] = str(profile.pk)
+        return response
+
+
+def report(profile):
+    """
+    Returns a profile as text: the request, its queries, then the profiler's report.
+    """
+    lines = [
+        f"{profile.method} {profile.path} -> {profile.status_code} in {profile.duration_ms:.1f} ms",
+        f"{profile.query_count} queries in {profile.query_ms:.1f} ms",
+        "",
+    ]
+    lines += [f"{query['ms']:9.3f} ms  [{query['alias']}] {query['sql']}" for query in profile.queries]
+    return "\n".join(lines) + "\n\n" + profile.stats
+
+
+@sync_and_async_middleware
+def profiling_middleware(get_response):
+    """
+    Profiles the requests of staff users that ask for it; goes right after metrics_middleware.
+    """
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            mode = requested_mode(request)
+            if mode is None:
+                return await get_response(request)
+            user = await sync_to_async(staff_user)(request)
+            if user is None:
+                return await get_response(request)
+            profiler = RequestProfiler(request, user, mode)
+            profiler.start()
+            try:
+                response = await get_response(request)
+            finally:
+                profiler.stop()
+            return await sync_to_async(profiler.save)(response)
+    else:
+        def middleware(request):
+            mode = requested_mode(request)
+            if mode is None:
+                return get_response(request)
+            user = staff_user(request)
+            if user is None:
+                return get_response(request)
+            profiler = RequestProfiler(request, user, mode)
+            profiler.start()
+            try:
+                response = get_response(request)
+            finally:
+                profiler.stop()
+            return profiler.save(response)
+    return middleware
@@ -0,0 +1,95 @@
+"""
+Keeping the in-memory indexes (recipes.pantry, recipes.similar and recipes.autocomplete) current
+across worker processes.
+
+Every worker process holds its own copy of these indexes, built when the process starts (see
+build_indexes). The signal handlers in recipes.signals update the copy of the process that made a
+change, once the change is committed. Other processes never hear of it: instead, on their first
+lookup once INDEX_REFRESH_INTERVAL seconds have passed, their indexes re-read the rows modified
+since their last refresh, and drop the rows deleted since, which the signal handlers record as
+Tombstone rows. Their results can therefore lag the writes of other processes by that interval.
+
+Tombstones are kept for INDEX_TOMBSTONE_RETENTION seconds. An index that hasn't been refreshed for
+that long falls back to comparing its ids with the whole table.
+"""
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DatabaseError
+from django.utils import timezone
+
+from .models import Tombstone
+
+# modified_at comes from the clock of the process that saved a row, before its transaction
+# commits: the rows modified this long before a refresh started are read again by the next one.
+MARGIN = timedelta(minutes=1)
+
+logger = logging.getLogger(__name__)
+
+
+def tombstone_retention():
+    return timedelta(seconds=getattr(settings, "INDEX_TOMBSTONE_RETENTION", 7 * 24 * 60 * 60))
+
+
+def deleted_since(model, since):
+    """
+    Returns the ids of the rows of a model deleted since a time, or None when the tombstones of
+    that time may have been pruned.
+    """
+    if since < timezone.now() - tombstone_retention():
+        return None
+    tombstones = Tombstone.objects.filter(model=model._meta.label_lower, deleted_at__gte=since)
+    return set(tombstones.values_list("object_id", flat=True))
+
+
+def build_indexes():
+    """
+    Builds the in-memory indexes of this process, so that no request waits for them; called when
+    a worker process starts (see dishcovery.wsgi and dishcovery.asgi). When the database can't be
+    reached, the indexes are built by their first lookup instead.
+    """
+    # The indexes import this module
+    from .autocomplete import autocomplete_index
+    from .pantry import pantry_index
+    from .similar import similar_index
+
+    for index in (pantry_index, similar_index, autocomplete_index):
+        try:
+            index.warm_up()
+        except DatabaseError:
+            logger.exception("Building %s failed", index.__class__.__name__)
+
+
+class RefreshClock:
+    """
+    Tells an index when its next refresh is due, and which rows it must read again.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._since = None
+        self._checked = 0
+
+    def start(self, since=None):
+        """
+        Marks the index as current with the database as of since (now by default); called before
+        the index reads its rows.
+        """
+        self._since = since or timezone.now()
+        self._checked = time.monotonic()
+
+    def due(self):
+        """
+        Returns the time from which modified rows must be read again when a refresh is due, else
+        None. The clock then restarts.
+        """
+        interval = getattr(settings, "INDEX_REFRESH_INTERVAL", 30)
+        if self._since is None or time.monotonic() - self._checked < interval:
+            return None
+        since = self._since - MARGIN
+        self.start()
+        return since
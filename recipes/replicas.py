@@ -0,0 +1,177 @@
+"""
+Routing of API reads to read replicas of the default database.
+
+Only the reads of safe (GET/HEAD/OPTIONS) requests to viewsets with ReplicaReadMixin go to a
+replica; everything else, including the admin, the auth endpoints and every write, uses the
+primary ("default"). The mixin switches replica reads on for the duration of the view through a
+context variable, which ReplicaRouter reads, so it works for sync and async views alike.
+
+Read-your-writes: after a user makes an unsafe request, read_your_writes_middleware pins their reads
+to the primary for REPLICA_PIN_SECONDS, long enough for the replicas to catch up. Pins are kept
+in the default cache, which must be shared between processes in production.
+
+Replicas (DATABASE_REPLICAS) lagging behind by more than REPLICA_MAX_LAG_SECONDS are skipped. The
+lag is measured at most every REPLICA_LAG_CHECK_INTERVAL seconds per process (PostgreSQL only;
+other databases are assumed to be current).
+"""
+import random
+import threading
+import time
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils.decorators import sync_and_async_middleware
+from rest_framework.permissions import SAFE_METHODS
+
+_replica_reads = ContextVar("replica_reads", default=False)
+
+LAG_SQL = """
+SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END
+"""
+
+
+def get_replicas():
+    return getattr(settings, "DATABASE_REPLICAS", [])
+
+
+class ReplicaLagMonitor:
+    """
+    Caches the replication lag of each replica for REPLICA_LAG_CHECK_INTERVAL seconds.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._checked = {}
+
+    def measure(self, alias):
+        connection = connections[alias]
+        if connection.vendor != "postgresql":
+            return 0.0
+        with connection.cursor() as cursor:
+            cursor.execute(LAG_SQL)
+            return float(cursor.fetchone()[0])
+
+    def lag(self, alias):
+        """
+        Returns the replica's lag in seconds (infinite when it can't be reached).
+        """
+        interval = getattr(settings, "REPLICA_LAG_CHECK_INTERVAL", 10)
+        now = time.monotonic()
+        with self._lock:
+            checked = self._checked.get(alias)
+        if checked is not None and now - checked[0] < interval:
+            return checked[1]
+        try:
+            lag = self.measure(alias)
+        except Exception:
+            lag = float("inf")
+        with self._lock:
+            self._checked[alias] = (now, lag)
+        return lag
+
+    def healthy(self, aliases):
+        max_lag = getattr(settings, "REPLICA_MAX_LAG_SECONDS", 5)
+        return [alias for alias in aliases if self.lag(alias) <= max_lag]
+
+    def reset(self):
+        with self._lock:
+            self._checked.clear()
+
+
+lag_monitor = ReplicaLagMonitor()
+
+
+class ReplicaRouter:
+    """
+    Sends reads to a current replica while replica reads are switched on, and writes to the primary.
+    """
+    monitor = lag_monitor
+
+    def db_for_read(self, model, **hints):
+        if not _replica_reads.get():
+            return None
+        replicas = self.monitor.healthy(get_replicas())
+        return random.choice(replicas) if replicas else DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        # Objects read from a replica must still be saved to the primary.
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *get_replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+def pin_key(user):
+    return f"replicas:pinned:{user.pk}"
+
+
+def pin_to_primary(user):
+    cache.set(pin_key(user), True, getattr(settings, "REPLICA_PIN_SECONDS", 5))
+
+
+def is_pinned(user):
+    return bool(user and user.is_authenticated and cache.get(pin_key(user)))
+
+
+class ReplicaReadMixin:
+    """
+    Reads from the replicas while a viewset handles a safe request of a user who isn't pinned.
+    """
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if get_replicas() and request.method in SAFE_METHODS and not is_pinned(request.user):
+            self._replica_reads_token = _replica_reads.set(True)
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            self.end_replica_reads()
+
+    async def adispatch(self, request, *args, **kwargs):
+        try:
+            return await super().adispatch(request, *args, **kwargs)
+        finally:
+            self.end_replica_reads()
+
+    def end_replica_reads(self):
+        # Also after exceptions that escape the view, so that the thread's later queries use the primary
+        token = getattr(self, "_replica_reads_token", None)
+        if token is not None:
+            _replica_reads.reset(token)
+            self._replica_reads_token = None
+
+
+def pin_writer(request):
+    user = getattr(request, "user", None)
+    if user is not None and user.is_authenticated:
+        pin_to_primary(user)
+
+
+@sync_and_async_middleware
+def read_your_writes_middleware(get_response):
+    """
+    Pins the reads of users who make an unsafe request to the primary for REPLICA_PIN_SECONDS.
+    """
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            response = await get_response(request)
+            if request.method not in SAFE_METHODS:
+                # Resolving a session user queries the database
+                await sync_to_async(pin_writer)(request)
+            return response
+    else:
+        def middleware(request):
+            response = get_response(request)
+            if request.method not in SAFE_METHODS:
+                pin_writer(request)
+            return response
+    return middleware
@@ -0,0 +1,225 @@
+"""
+Full-text search for recipes.
+
+Two backends share the same interface:
+
+- PostgresSearchBackend keeps ``Recipe.search_vector`` up to date and queries it through the
+  GIN index, ranking results with ``ts_rank``.
+- PythonSearchBackend keeps an in-process inverted index with the same field weights. It is used
+  on databases without full-text search (e.g. SQLite in tests and local development).
+
+Title terms are weighted above description terms, which are weighted above ingredient names.
+"""
+import math
+import re
+import threading
+from collections import defaultdict
+
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from django.db import connection
+from django.db.models import Case, F, IntegerField, OuterRef, Subquery, Value, When
+
+from .models import Recipe, RecipeIngredient
+
+# Relative weights of the document parts; these match PostgreSQL's default A/B/C weights.
+WEIGHTS = {"A": 1.0, "B": 0.4, "C": 0.2}
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text):
+    """
+    Splits text into lowercase search terms.
+
+    Args:
+        text (str): The text to tokenize.
+
+    Returns:
+        list: The terms found in the text.
+    """
+    if not text:
+        return []
+    return TOKEN_RE.findall(text.lower())
+
+
+class PostgresSearchBackend:
+    """
+    Search backend using PostgreSQL's tsvector/tsquery support.
+    """
+    config = "english"
+
+    def document(self):
+        """
+        Returns the weighted SearchVector expression for a recipe row.
+        """
+        ingredient_names = (
+            RecipeIngredient.objects.filter(recipe=OuterRef("pk"))
+            .values("recipe")
+            .annotate(names=StringAgg("ingredient__name", " "))
+            .values("names")
+        )
+        return (
+            SearchVector("title", weight="A", config=self.config)
+            + SearchVector("description", weight="B", config=self.config)
+            + SearchVector(Subquery(ingredient_names), weight="C", config=self.config)
+        )
+
+    def prepare(self):
+        pass
+
+    def update_recipes(self, recipe_ids):
+        Recipe.objects.filter(pk__in=recipe_ids).update(search_vector=self.document())
+
+    def remove_recipe(self, recipe_id):
+        # The row is gone together with its search vector.
+        pass
+
+    def search(self, queryset, query):
+        search_query = SearchQuery(query, search_type="websearch", config=self.config)
+        return (
+            queryset.filter(search_vector=search_query)
+            .annotate(rank=SearchRank(F("search_vector"), search_query))
+            .order_by("-rank", "-created_at", "-id")
+        )
+
+
+class PythonSearchBackend:
+    """
+    Search backend backed by an in-process inverted index.
+
+    The index is built lazily from the database on the first search and kept current by the
+    signal handlers in recipes.signals. Every query term must match (like ``plainto_tsquery``);
+    results are ranked by weighted term frequency times inverse document frequency.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._postings = defaultdict(dict)
+        self._documents = {}
+        self._built = False
+
+    def _index(self, recipe_id, title, description, ingredient_names):
+        scores = defaultdict(float)
+        for weight, text in (("A", title), ("B", description), ("C", " ".join(ingredient_names))):
+            for term in tokenize(text):
+                scores[term] += WEIGHTS[weight]
+        self._unindex(recipe_id)
+        for term, score in scores.items():
+            self._postings[term][recipe_id] = score
+        self._documents[recipe_id] = set(scores)
+
+    def _unindex(self, recipe_id):
+        for term in self._documents.pop(recipe_id, ()):
+            postings = self._postings[term]
+            postings.pop(recipe_id, None)
+            if not postings:
+                del self._postings[term]
+
+    def _load(self, recipe_ids=None):
+        recipes = Recipe.objects.all()
+        ingredients = RecipeIngredient.objects.all()
+        if recipe_ids is not None:
+            recipes = recipes.filter(pk__in=recipe_ids)
+            ingredients = ingredients.filter(recipe_id__in=recipe_ids)
+
+        names = defaultdict(list)
+        for recipe_id, name in ingredients.values_list("recipe_id", "ingredient__name"):
+            names[recipe_id].append(name)
+
+        found = set()
+        for recipe_id, title, description in recipes.values_list("id", "title", "description"):
+            self._index(recipe_id, title, description, names[recipe_id])
+            found.add(recipe_id)
+        for recipe_id in set(recipe_ids or ()) - found:
+            self._unindex(recipe_id)
+
+    def build(self):
+        """
+        (Re)builds the whole index from the database.
+        """
+        with self._lock:
+            self._postings.clear()
+            self._documents.clear()
+            self._load()
+            self._built = True
+
+    def reset(self):
+        """
+        Drops the index; it will be rebuilt on the next search.
+        """
+        with self._lock:
+            self._postings.clear()
+            self._documents.clear()
+            self._built = False
+
+    def prepare(self):
+        """
+        Builds the index if it hasn't been built yet, so that searching doesn't query the database.
+        """
+        with self._lock:
+            if not self._built:
+                self.build()
+
+    def update_recipes(self, recipe_ids):
+        with self._lock:
+            if self._built:
+                self._load(list(recipe_ids))
+
+    def remove_recipe(self, recipe_id):
+        with self._lock:
+            self._unindex(recipe_id)
+
+    def rank(self, query):
+        """
+        Returns (recipe_id, score) pairs matching every term of the query, best first.
+
+        Args:
+            query (str): The raw search string.
+
+        Returns:
+            list: The matching recipe ids with their scores.
+        """
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+        with self._lock:
+            self.prepare()
+            postings = [self._postings.get(term, {}) for term in terms]
+            if not all(postings):
+                return []
+            total = len(self._documents)
+            postings.sort(key=len)
+            scores = {}
+            for recipe_id in postings[0]:
+                if all(recipe_id in p for p in postings[1:]):
+                    scores[recipe_id] = sum(
+                        p[recipe_id] * math.log(1 + total / len(p)) for p in postings
+                    )
+        return sorted(scores.items(), key=lambda item: (-item[1], -item[0]))
+
+    def search(self, queryset, query):
+        ranked = [recipe_id for recipe_id, _ in self.rank(query)]
+        if not ranked:
+            return queryset.none()
+        position = Case(
+            *[When(pk=recipe_id, then=Value(i)) for i, recipe_id in enumerate(ranked)],
+            output_field=IntegerField(),
+        )
+        return queryset.filter(pk__in=ranked).annotate(rank=position).order_by("rank")
+
+
+_backends = {}
+
+
+def get_backend():
+    """
+    Returns the search backend for the default database.
+    """
+    vendor = connection.vendor
+    if vendor not in _backends:
+        if vendor == "postgresql":
+            _backends[vendor] = PostgresSearchBackend()
+        else:
+            _backends[vendor] = PythonSearchBackend()
+    return _backends[vendor]
@@ -1,5 +1,41 @@
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
 from rest_framework import serializers
-from .models import Profile, Recipe, Ingredient, RecipeIngredient, Comment
+from .filters import pk_range
+from .images import derivative_urls, ready_field
+from .models import Follow, Profile, Recipe, Ingredient, RecipeIngredient, Comment
+from .signals import recipes_created
+
+
+def image_variant_urls(image, request=None):
+    """
+    Returns the URLs of an image's resized derivatives as {size: {format: url}}, or None until
+    they have been generated.
+    """
+    if not image:
+        return None
+    variants = derivative_urls(image.name, image.storage, getattr(image.instance, ready_field(image.field.name)))
+    if variants is None or request is None:
+        return variants
+    return {
+        size: {extension: request.build_absolute_uri(url) for extension, url in urls.items()}
+        for size, urls in variants.items()
+    }
+
+
+class ImageVariantsField(serializers.Field):
+    """
+    Read-only field returning the URLs of an image's resized derivatives.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs["read_only"] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, value):
+        return image_variant_urls(value, self.context.get("request"))
 
 
 class RecipeIngredientSimpleSerializer(serializers.ModelSerializer):
@@ -12,10 +48,12 @@ class RecipeIngredientSimpleSerializer(serializers.ModelSerializer):
     Methods:
     - get_name: Returns the ingredient's custom name if available, otherwise returns the default name.
     - get_image: Returns the ingredient's custom image if available, otherwise returns the default image.
+    - get_image_variants: Returns the resized variants of the image returned by get_image.
     """
 
     name = serializers.SerializerMethodField(method_name="get_name", read_only=True)
     image = serializers.SerializerMethodField(method_name="get_image", read_only=True)
+    image_variants = serializers.SerializerMethodField(method_name="get_image_variants", read_only=True)
 
     def get_name(self, obj):
         if obj.custom_name is not None:
@@ -24,13 +62,18 @@ class RecipeIngredientSimpleSerializer(serializers.ModelSerializer):
 
     def get_image(self, obj):
         request = self.context.get("request")
-        if obj.custom_image != "":
-            return request.build_absolute_uri(obj.custom_image.url)
-        return request.build_absolute_uri(obj.ingredient.image.url)
+        # custom_image is NULL rather than "" for rows written with COPY by import_recipes
+        image = obj.custom_image or obj.ingredient.image
+        if not image:
+            return None
+        return request.build_absolute_uri(image.url)
+
+    def get_image_variants(self, obj):
+        return image_variant_urls(obj.custom_image or obj.ingredient.image, self.context.get("request"))
 
     class Meta:
         model = RecipeIngredient
-        fields = ["id", "name", "amount", "unit", "image"]
+        fields = ["id", "name", "amount", "unit", "image", "image_variants"]
 
 
 class RecipeSerializer(serializers.ModelSerializer):
@@ -40,6 +83,7 @@ class RecipeSerializer(serializers.ModelSerializer):
 
     ingredients = RecipeIngredientSimpleSerializer(many=True)
     user = serializers.PrimaryKeyRelatedField(read_only=True)
+    image_variants = ImageVariantsField(source="image")
 
     class Meta:
         model = Recipe
@@ -50,8 +94,12 @@ class RecipeSerializer(serializers.ModelSerializer):
             "time_minutes",
             "description",
             "image",
+            "image_variants",
             "created_at",
             "modified_at",
+            "ingredient_count",
+            "comment_count",
+            "latest_comment_at",
             "ingredients",
         ]
 
@@ -105,6 +153,111 @@ class RecipeCreateSerializer(serializers.ModelSerializer):
         return recipe
 
 
+class BatchIngredientField(serializers.IntegerField):
+    """
+    An ingredient id checked against the ids RecipeBulkListSerializer loaded for the whole batch,
+    instead of one query per ingredient like PrimaryKeyRelatedField.
+    """
+    default_error_messages = {
+        "does_not_exist": 'Invalid pk "{pk_value}" - object does not exist.',
+    }
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault("min_value", 1)
+        kwargs.setdefault("max_value", pk_range(Ingredient)[1])
+        super().__init__(**kwargs)
+
+    def to_internal_value(self, data):
+        value = super().to_internal_value(data)
+        if value not in self.context["ingredient_ids"]:
+            self.fail("does_not_exist", pk_value=value)
+        return value
+
+
+class RecipeBulkIngredientSerializer(serializers.ModelSerializer):
+    """
+    Serializer for the ingredients of a recipe created in bulk.
+    """
+    ingredient = BatchIngredientField()
+
+    class Meta:
+        model = RecipeIngredient
+        fields = ["ingredient", "amount", "unit", "custom_name"]
+
+
+class RecipeBulkListSerializer(serializers.ListSerializer):
+    """
+    List serializer that validates a batch of recipes together and creates them with bulk_create.
+
+    Every item is validated and errors are reported per item; ingredient ids of the whole batch are
+    checked with a single query. All recipes and their ingredient rows are inserted in one
+    transaction, so either the whole batch is created or nothing is.
+    """
+
+    def to_internal_value(self, data):
+        # Ids the column can't hold are left out of the query; BatchIngredientField rejects them
+        low, high = pk_range(Ingredient)
+        ids = set()
+        if isinstance(data, list):
+            for item in data:
+                ingredients = item.get("ingredients") if isinstance(item, dict) else None
+                for ingredient in ingredients if isinstance(ingredients, list) else []:
+                    try:
+                        ingredient_id = int(ingredient.get("ingredient"))
+                    except (AttributeError, TypeError, ValueError):
+                        continue
+                    if low <= ingredient_id <= high:
+                        ids.add(ingredient_id)
+        self.context["ingredient_ids"] = set(
+            Ingredient.objects.filter(pk__in=ids).values_list("pk", flat=True)
+        )
+        return super().to_internal_value(data)
+
+    def create(self, validated_data):
+        user = self.context["request"].user
+        with transaction.atomic():
+            recipes = Recipe.objects.bulk_create([
+                Recipe(user=user, ingredient_count=len(item["ingredients"]), **{
+                    key: value for key, value in item.items() if key != "ingredients"
+                })
+                for item in validated_data
+            ])
+            RecipeIngredient.objects.bulk_create(
+                [
+                    RecipeIngredient(recipe=recipe, ingredient_id=row["ingredient"], **{
+                        key: value for key, value in row.items() if key != "ingredient"
+                    })
+                    for recipe, item in zip(recipes, validated_data)
+                    for row in item["ingredients"]
+                ],
+                batch_size=1000,
+            )
+            recipes_created.send(sender=Recipe, recipe_ids=[recipe.pk for recipe in recipes])
+        return recipes
+
+
+class RecipeBulkCreateSerializer(serializers.ModelSerializer):
+    """
+    Serializer for one recipe of a bulk creation request. Images can't be sent in bulk.
+    """
+    user = serializers.PrimaryKeyRelatedField(read_only=True)
+    ingredients = RecipeBulkIngredientSerializer(many=True, write_only=True)
+
+    class Meta:
+        model = Recipe
+        list_serializer_class = RecipeBulkListSerializer
+        fields = [
+            "id",
+            "user",
+            "title",
+            "time_minutes",
+            "description",
+            "created_at",
+            "modified_at",
+            "ingredients",
+        ]
+
+
 class IngredientSerializer(serializers.ModelSerializer):
     """
     Serializer for Ingredient model.
@@ -113,10 +266,11 @@ class IngredientSerializer(serializers.ModelSerializer):
     created_at = serializers.DateTimeField(read_only=True)
     modified_at = serializers.DateTimeField(read_only=True)
     created_by = serializers.PrimaryKeyRelatedField(read_only=True)
+    image_variants = ImageVariantsField(source="image")
 
     class Meta:
         model = Ingredient
-        fields = ["id", "name", "image", "created_at", "modified_at", "created_by"]
+        fields = ["id", "name", "image", "image_variants", "created_at", "modified_at", "created_by"]
 
     def create(self, validated_data):
         """
@@ -179,6 +333,7 @@ class ProfileSerializer(serializers.ModelSerializer):
     """
 
     user = serializers.PrimaryKeyRelatedField(read_only=True)
+    image_variants = ImageVariantsField(source="image")
 
     class Meta:
         model = Profile
@@ -186,6 +341,93 @@ class ProfileSerializer(serializers.ModelSerializer):
             "id",
             "user",
             "image",
+            "image_variants",
             "bio",
             "phone_number",
+            "follower_count",
         ]
+        read_only_fields = ["follower_count"]
+
+
+class FollowSerializer(serializers.ModelSerializer):
+    """
+    Serializer for the Follow model; the follower is the current user.
+    """
+
+    followee = serializers.PrimaryKeyRelatedField(queryset=get_user_model().objects.all())
+
+    class Meta:
+        model = Follow
+        fields = ["followee", "created_at"]
+        read_only_fields = ["created_at"]
+
+    def validate_followee(self, followee):
+        follower = self.context["request"].user
+        if followee == follower:
+            raise serializers.ValidationError("You can't follow yourself.")
+        if Follow.objects.filter(follower=follower, followee=followee).exists():
+            raise serializers.ValidationError("You already follow this user.")
+        return followee
+
+
+class PantryMatchSerializer(serializers.Serializer):
+    """
+    Serializer for the pantry-match query.
+
+    Fields:
+    - ingredients: The ids of the ingredients the user has.
+    - max_missing: Only return recipes missing at most this many ingredients (optional).
+    """
+
+    ingredients = serializers.ListField(child=serializers.IntegerField(min_value=1), allow_empty=False)
+    max_missing = serializers.IntegerField(min_value=0, required=False)
+
+
+class SimilarRecipesQuerySerializer(serializers.Serializer):
+    """
+    Serializer for the similar recipes query.
+
+    Fields:
+    - limit: The maximum number of recipes (optional, 10 by default).
+    """
+
+    limit = serializers.IntegerField(min_value=1, max_value=50, default=10)
+
+
+class AutocompleteQuerySerializer(serializers.Serializer):
+    """
+    Serializer for the ingredient autocomplete query.
+
+    Fields:
+    - q: What the user has typed so far.
+    - limit: The maximum number of suggestions (optional, 10 by default).
+    """
+
+    q = serializers.CharField(max_length=100, trim_whitespace=False)
+    limit = serializers.IntegerField(min_value=1, max_value=50, default=10)
+
+
+class ShoppingListRecipeSerializer(serializers.Serializer):
+    """
+    Serializer for one recipe of a shopping list.
+
+    Fields:
+    - id: The id of the recipe.
+    - multiplier: How many times the recipe is made, e.g. 2 to double it (optional, 1 by default).
+    """
+
+    id = serializers.IntegerField(min_value=1, max_value=pk_range(Recipe)[1])
+    multiplier = serializers.DecimalField(
+        max_digits=8, decimal_places=3, min_value=Decimal("0.001"), default=Decimal(1)
+    )
+
+
+class ShoppingListQuerySerializer(serializers.Serializer):
+    """
+    Serializer for the shopping-list query.
+
+    Fields:
+    - recipes: The recipes to shop for; a recipe given twice is made twice.
+    """
+
+    recipes = serializers.ListField(child=ShoppingListRecipeSerializer(), allow_empty=False, max_length=500)
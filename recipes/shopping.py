@@ -0,0 +1,115 @@
+"""
+Shopping lists: the ingredients of several recipes, added up.
+
+RecipeIngredient.unit is free text, so units are normalized in the database: the lowercased,
+trimmed unit is mapped through UNITS to a base unit (g, ml or none for counted things) and a
+factor, inside the one grouped query that sums ``amount * factor * multiplier`` per ingredient
+and base unit. All rows are converted at once by that query, whatever the number of recipes.
+Totals are then shown in the largest unit they make at least one of (1500 g -> 1.5 kg).
+
+Units that aren't in UNITS, like "pinch" or "clove", are kept as they are, and summed with the
+amounts in the same unit.
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db.models import Case, CharField, DecimalField, F, Sum, Value, When
+from django.db.models.functions import Coalesce, Lower, Trim
+
+from .models import RecipeIngredient
+
+GRAM, MILLILITRE, COUNT = "g", "ml", ""
+
+# Unit spellings -> (base unit, factor)
+UNITS = {
+    **dict.fromkeys(["mg", "milligram", "milligrams"], (GRAM, Decimal("0.001"))),
+    **dict.fromkeys(["g", "gr", "gram", "grams", "gramme", "grammes"], (GRAM, Decimal(1))),
+    **dict.fromkeys(["kg", "kilo", "kilos", "kilogram", "kilograms"], (GRAM, Decimal(1000))),
+    **dict.fromkeys(["oz", "ounce", "ounces"], (GRAM, Decimal("28.349523125"))),
+    **dict.fromkeys(["lb", "lbs", "pound", "pounds"], (GRAM, Decimal("453.59237"))),
+    **dict.fromkeys(["ml", "millilitre", "millilitres", "milliliter", "milliliters"], (MILLILITRE, Decimal(1))),
+    **dict.fromkeys(["cl", "centilitre", "centilitres", "centiliter", "centiliters"], (MILLILITRE, Decimal(10))),
+    **dict.fromkeys(["dl", "decilitre", "decilitres", "deciliter", "deciliters"], (MILLILITRE, Decimal(100))),
+    **dict.fromkeys(["l", "litre", "litres", "liter", "liters"], (MILLILITRE, Decimal(1000))),
+    **dict.fromkeys(["tsp", "teaspoon", "teaspoons"], (MILLILITRE, Decimal(5))),
+    **dict.fromkeys(["tbsp", "tablespoon", "tablespoons"], (MILLILITRE, Decimal(15))),
+    **dict.fromkeys(["cup", "cups"], (MILLILITRE, Decimal(240))),
+    **dict.fromkeys(["fl oz", "fluid ounce", "fluid ounces"], (MILLILITRE, Decimal("29.5735295625"))),
+    **dict.fromkeys(["", "pc", "pcs", "piece", "pieces", "x"], (COUNT, Decimal(1))),
+}
+
+# Base unit -> (larger unit, its size in the base unit)
+LARGER_UNITS = {GRAM: ("kg", Decimal(1000)), MILLILITRE: ("l", Decimal(1000))}
+
+AMOUNT = DecimalField(max_digits=20, decimal_places=6)
+
+
+def unit_expressions():
+    """
+    Returns the expressions of a RecipeIngredient row's normalized unit spelling, and of its
+    base unit and factor from UNITS; the latter two refer to the former as "unit_spelling".
+    """
+    spelling = Lower(Trim(Coalesce("unit", Value(""))))
+    by_base = defaultdict(list)
+    by_factor = defaultdict(list)
+    for name, (base, factor) in UNITS.items():
+        by_base[base].append(name)
+        by_factor[factor].append(name)
+    base = Case(
+        *[When(unit_spelling__in=names, then=Value(unit)) for unit, names in by_base.items()],
+        default=F("unit_spelling"),
+        output_field=CharField(),
+    )
+    factor = Case(
+        *[When(unit_spelling__in=names, then=Value(value)) for value, names in by_factor.items() if value != 1],
+        default=Value(Decimal(1)),
+        output_field=AMOUNT,
+    )
+    return spelling, base, factor
+
+
+def shopping_list(multipliers):
+    """
+    Adds up the ingredients of recipes.
+
+    Args:
+        multipliers (dict): Recipe ids -> how many times each recipe is made (a Decimal).
+
+    Returns:
+        list: Dicts with the ingredient's id and name, the total amount (a string, like the
+        serializers' decimals) and its unit (None for counted ingredients), by name and unit.
+    """
+    if not multipliers:
+        return []
+    spelling, base, factor = unit_expressions()
+    multiplier = Case(
+        *[When(recipe_id=recipe_id, then=Value(value)) for recipe_id, value in multipliers.items()],
+        output_field=AMOUNT,
+    )
+    rows = (
+        RecipeIngredient.objects.filter(recipe_id__in=multipliers)
+        .alias(unit_spelling=spelling)
+        .annotate(base_unit=base)
+        .values("ingredient_id", "ingredient__name", "base_unit")
+        .annotate(total=Sum(F("amount") * factor * multiplier, output_field=AMOUNT))
+        .order_by("ingredient__name", "base_unit")
+    )
+    return [
+        {
+            "ingredient": row["ingredient_id"],
+            "name": row["ingredient__name"],
+            **display(row["total"], row["base_unit"]),
+        }
+        for row in rows
+    ]
+
+
+def display(total, unit):
+    """
+    Returns the amount, rounded to 2 decimal places, and the unit to show a total in.
+    """
+    total = Decimal(total)
+    larger = LARGER_UNITS.get(unit)
+    if larger is not None and total >= larger[1]:
+        unit, total = larger[0], total / larger[1]
+    return {"amount": str(total.quantize(Decimal("0.01"))), "unit": unit or None}
@@ -1,11 +1,259 @@
 from django.conf import settings
-from django.db.models.signals import post_save
-from django.dispatch import receiver
+from django.db.models import F, Value
+from django.db.models.functions import Coalesce, Greatest
+from django.db.models.signals import post_save, post_delete, pre_save
+from django.db import transaction
+from django.dispatch import Signal, receiver
+from django.utils import timezone
 from django.conf import settings
-from .models import Profile
+from .models import Comment, Follow, MediaBlob, Profile, Recipe, RecipeIngredient, Ingredient, Tombstone
+from . import feed
+from .autocomplete import autocomplete_index
+from .cache import recipe_cache
+from .counters import latest_comment_subquery
+from .images import IMAGE_FIELDS, field_storage, ready_field, schedule_derivatives
+from .pantry import pantry_index
+from .search import get_backend as get_search_backend
+from .similar import similar_index
+
+# Sent after recipes are created with bulk_create, which doesn't send post_save.
+# Receivers get the ids of the new recipes as recipe_ids.
+recipes_created = Signal()
 
 # This signal is used to create a profile for each new user
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
 def create_profle_for_new_user(sender, created, instance, **kwargs):
     if created:
         Profile.objects.create(user=instance)
+
+
+# These signals keep the recipe search index in sync with recipes and their ingredients
+@receiver(post_save, sender=Recipe)
+def update_search_for_recipe(sender, instance, **kwargs):
+    get_search_backend().update_recipes([instance.pk])
+
+
+@receiver(post_delete, sender=Recipe)
+def remove_search_for_recipe(sender, instance, **kwargs):
+    get_search_backend().remove_recipe(instance.pk)
+
+
+@receiver(post_save, sender=RecipeIngredient)
+@receiver(post_delete, sender=RecipeIngredient)
+def update_search_for_recipe_ingredient(sender, instance, **kwargs):
+    get_search_backend().update_recipes([instance.recipe_id])
+
+
+@receiver(post_save, sender=Ingredient)
+def update_search_for_ingredient(sender, instance, created, **kwargs):
+    if not created:
+        recipe_ids = instance.recipes.values_list("recipe_id", flat=True)
+        get_search_backend().update_recipes(recipe_ids)
+
+
+# These signals record deleted recipes and ingredients, so that the in-memory indexes of the other
+# processes drop them on their next refresh (see recipes.refresh)
+@receiver(post_delete, sender=Recipe)
+@receiver(post_delete, sender=Ingredient)
+def record_tombstone(sender, instance, **kwargs):
+    Tombstone.objects.create(model=sender._meta.label_lower, object_id=instance.pk)
+
+
+# These signals apply committed changes to the pantry-match ingredient index of this process;
+# the other processes refresh theirs (see recipes.refresh). A rolled back change is never applied.
+@receiver(post_save, sender=RecipeIngredient)
+@receiver(post_delete, sender=RecipeIngredient)
+def update_pantry_for_recipe_ingredient(sender, instance, **kwargs):
+    recipe_id = instance.recipe_id
+    transaction.on_commit(lambda: pantry_index.update_recipe(recipe_id))
+
+
+@receiver(post_delete, sender=Recipe)
+def remove_pantry_for_recipe(sender, instance, **kwargs):
+    recipe_id = instance.pk
+    transaction.on_commit(lambda: pantry_index.remove_recipe(recipe_id))
+
+
+# These signals apply committed changes to the similar-recipes index of this process
+@receiver(post_save, sender=RecipeIngredient)
+@receiver(post_delete, sender=RecipeIngredient)
+def update_similar_for_recipe_ingredient(sender, instance, **kwargs):
+    recipe_id = instance.recipe_id
+    transaction.on_commit(lambda: similar_index.update_recipe(recipe_id))
+
+
+@receiver(post_delete, sender=Recipe)
+def remove_similar_for_recipe(sender, instance, **kwargs):
+    recipe_id = instance.pk
+    transaction.on_commit(lambda: similar_index.remove_recipe(recipe_id))
+
+
+# These signals apply committed changes to the ingredient autocomplete index of this process
+@receiver(post_save, sender=Ingredient)
+def update_autocomplete_for_ingredient(sender, instance, **kwargs):
+    ingredient_id, name = instance.pk, instance.name
+    transaction.on_commit(lambda: autocomplete_index.update_ingredient(ingredient_id, name))
+
+
+@receiver(post_delete, sender=Ingredient)
+def remove_autocomplete_for_ingredient(sender, instance, **kwargs):
+    ingredient_id = instance.pk
+    transaction.on_commit(lambda: autocomplete_index.remove_ingredient(ingredient_id))
+
+
+# These signals drop cached recipe fragments when a recipe or anything it shows changes.
+# Deleting an ingredient cascades to its RecipeIngredient rows, which are handled one by one.
+@receiver(post_save, sender=Recipe)
+@receiver(post_delete, sender=Recipe)
+def invalidate_cache_for_recipe(sender, instance, **kwargs):
+    recipe_cache.invalidate([instance.pk])
+
+
+@receiver(post_save, sender=RecipeIngredient)
+@receiver(post_delete, sender=RecipeIngredient)
+def invalidate_cache_for_recipe_ingredient(sender, instance, **kwargs):
+    recipe_cache.invalidate([instance.recipe_id])
+
+
+@receiver(post_save, sender=Ingredient)
+@receiver(post_delete, sender=Ingredient)
+def invalidate_cache_for_ingredient(sender, instance, **kwargs):
+    recipe_cache.invalidate(instance.recipes.values_list("recipe_id", flat=True))
+
+
+# These signals bump Recipe.modified_at when its ingredients change, so the validators and
+# cache keys derived from it follow changes to everything a recipe shows.
+# The recipe's ingredient_count is updated in the same query.
+@receiver(post_save, sender=RecipeIngredient)
+@receiver(post_delete, sender=RecipeIngredient)
+def touch_recipe_for_recipe_ingredient(sender, instance, signal, created=False, **kwargs):
+    changes = {"modified_at": timezone.now()}
+    if created:
+        changes["ingredient_count"] = F("ingredient_count") + 1
+    elif signal is post_delete:
+        changes["ingredient_count"] = F("ingredient_count") - 1
+    Recipe.objects.filter(pk=instance.recipe_id).update(**changes)
+
+
+@receiver(post_save, sender=Ingredient)
+def touch_recipes_for_ingredient(sender, instance, created, **kwargs):
+    if not created:
+        Recipe.objects.filter(ingredients__ingredient=instance).update(modified_at=timezone.now())
+
+
+# These signals keep the comment counters of a recipe current. They bump modified_at too, since
+# the counters are part of the recipe's representation.
+@receiver(post_save, sender=Comment)
+def count_new_comment(sender, instance, created, **kwargs):
+    if created:
+        created_at = Value(instance.created_at)
+        Recipe.objects.filter(pk=instance.recipe_id).update(
+            comment_count=F("comment_count") + 1,
+            latest_comment_at=Greatest(Coalesce("latest_comment_at", created_at), created_at),
+            modified_at=timezone.now(),
+        )
+
+
+@receiver(post_delete, sender=Comment)
+def count_deleted_comment(sender, instance, **kwargs):
+    Recipe.objects.filter(pk=instance.recipe_id).update(
+        comment_count=F("comment_count") - 1,
+        latest_comment_at=latest_comment_subquery(),
+        modified_at=timezone.now(),
+    )
+
+
+# These signals keep the follower counts of profiles and the feed timelines current.
+# New recipes are pushed to timelines by a background job, once they are committed.
+@receiver(post_save, sender=Recipe)
+def fan_out_new_recipe(sender, instance, created, **kwargs):
+    if created:
+        transaction.on_commit(lambda: feed.schedule(feed.fan_out, [instance.pk]))
+
+
+@receiver(post_save, sender=Follow)
+def count_new_follow(sender, instance, created, **kwargs):
+    if created:
+        Profile.objects.filter(user_id=instance.followee_id).update(
+            follower_count=F("follower_count") + 1,
+            modified_at=timezone.now(),
+        )
+        transaction.on_commit(lambda: feed.schedule(feed.backfill, instance.follower_id, instance.followee_id))
+
+
+@receiver(post_delete, sender=Follow)
+def count_deleted_follow(sender, instance, **kwargs):
+    Profile.objects.filter(user_id=instance.followee_id).update(
+        follower_count=F("follower_count") - 1,
+        modified_at=timezone.now(),
+    )
+    transaction.on_commit(lambda: feed.schedule(feed.unfollow, instance.follower_id, instance.followee_id))
+
+
+# bulk_create skips post_save, so the indexes are updated for the whole batch at once, after commit
+@receiver(recipes_created)
+def index_created_recipes(sender, recipe_ids, **kwargs):
+    get_search_backend().update_recipes(recipe_ids)
+    transaction.on_commit(lambda: pantry_index.update_recipes(recipe_ids))
+    transaction.on_commit(lambda: similar_index.update_recipes(recipe_ids))
+    # Importers bulk-create the ingredients of new recipes too
+    transaction.on_commit(autocomplete_index.add_new_ingredients)
+    transaction.on_commit(lambda: feed.schedule(feed.fan_out, recipe_ids))
+
+
+# This signal generates resized variants of newly uploaded images once the upload is committed.
+# Saves that keep the image (_previous_image is set by remember_previous_image) schedule nothing;
+# a new image has no variants until they are generated.
+def schedule_image_derivatives(sender, instance, created, **kwargs):
+    field = IMAGE_FIELD_NAMES[sender]
+    name = getattr(instance, field).name
+    if name == getattr(instance, "_previous_image", None):
+        return
+    if not created and getattr(instance, ready_field(field)):
+        setattr(instance, ready_field(field), False)
+        sender.objects.filter(pk=instance.pk).update(**{ready_field(field): False})
+    if name:
+        storage = field_storage(sender, field)
+        transaction.on_commit(lambda: schedule_derivatives(name, storage))
+
+
+IMAGE_FIELD_NAMES = dict(IMAGE_FIELDS)
+for model in IMAGE_FIELD_NAMES:
+    post_save.connect(schedule_image_derivatives, sender=model, dispatch_uid=f"image_derivatives_{model.__name__}")
+
+
+# These signals keep the reference counts of content-addressed media blobs current
+def count_blob_references(names, delta):
+    names = [name for name in names if name]
+    if names:
+        MediaBlob.objects.filter(name__in=names).update(references=F("references") + delta, modified_at=timezone.now())
+
+
+def remember_previous_image(sender, instance, raw=False, update_fields=None, **kwargs):
+    field = IMAGE_FIELD_NAMES[sender]
+    instance._previous_image = None
+    if update_fields is not None and field not in update_fields:
+        # The stored image isn't written, so it stays what it is
+        instance._previous_image = getattr(instance, field).name
+    elif instance.pk and not raw:
+        instance._previous_image = sender.objects.filter(pk=instance.pk).values_list(field, flat=True).first()
+
+
+def update_blob_references(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    current = getattr(instance, IMAGE_FIELD_NAMES[sender]).name
+    previous = getattr(instance, "_previous_image", None)
+    if current != previous:
+        count_blob_references([current], 1)
+        count_blob_references([previous], -1)
+
+
+def release_blob_reference(sender, instance, **kwargs):
+    count_blob_references([getattr(instance, IMAGE_FIELD_NAMES[sender]).name], -1)
+
+
+for model in IMAGE_FIELD_NAMES:
+    pre_save.connect(remember_previous_image, sender=model, dispatch_uid=f"previous_image_{model.__name__}")
+    post_save.connect(update_blob_references, sender=model, dispatch_uid=f"blob_references_{model.__name__}")
+    post_delete.connect(release_blob_reference, sender=model, dispatch_uid=f"release_blob_{model.__name__}")
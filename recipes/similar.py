@@ -0,0 +1,387 @@
+"""
+Similar recipes: MinHash signatures of the recipes' ingredient sets, in an LSH banding index.
+
+Each recipe's set of ingredient ids gets a signature of NUM_HASHES minimums, one per hash
+function: two signatures agree at a position with a probability equal to the Jaccard similarity
+of the two sets. Signatures are cut into BANDS bands of ROWS positions, and recipes with an
+identical band share a bucket. The candidates for a recipe are the recipes in its buckets, ranked
+by the share of signature positions they agree on; nothing is compared pairwise over the catalog.
+
+Every ingredient's hash values are computed once, so that a recipe's signature is the
+element-wise minimum of its ingredients' vectors (``map(min, *vectors)``), without a Python loop
+per hash function. Signatures are kept in flat ``array("I")`` buffers.
+
+With SIMILAR_RECIPES_INDEX set, the index is saved to that file: the signatures, and for every
+band its bucket keys, sorted. Worker processes memory-map the file when they first need it and
+look buckets up by bisection, so nothing is computed or copied at start; only the recipes
+modified or deleted since the file was written are read from the database, into an in-memory layer
+over it. A file older than the tombstone retention (see recipes.refresh) is rebuilt instead.
+The build_similar_recipes command rewrites the file. Changes made afterwards go to the in-memory
+layer: those committed by this process through the signal handlers in recipes.signals, those of
+other processes through refresh() (see recipes.refresh).
+"""
+import heapq
+import mmap
+import operator
+import os
+import random
+import struct
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import Recipe, RecipeIngredient
+from .refresh import RefreshClock, deleted_since
+
+NUM_HASHES = 60
+# 20 bands of 3 rows: a recipe with a Jaccard similarity of 0.5 is a candidate with a probability
+# of 93%, one of 0.2 with 15%. Bands of 2 rows make buckets of most of the catalog when a few
+# ingredients (salt, oil) are in most recipes.
+BANDS, ROWS = 20, 3
+# Hash functions (a * x + b) mod a Mersenne prime, truncated to 32 bits. They are drawn from a
+# fixed seed, since saved signatures are only comparable with the same functions.
+SEED = 0x5EED
+PRIME = (1 << 61) - 1
+MASK = (1 << 32) - 1
+
+# Saved index: a header (with the build time in microseconds), then, for N recipes, their ids
+# (int64, ascending), the bucket keys of each band (uint64, ascending), the signatures (uint32)
+# and the rows the keys of each band belong to (uint32). The 8-byte arrays come first, so that
+# every array is aligned.
+MAGIC = b"DSIMHASH"
+VERSION = 1
+HEADER = struct.Struct("<8sIIIIIIq")
+
+
+def hash_functions(count=NUM_HASHES, seed=SEED):
+    generator = random.Random(seed)
+    return [(generator.randrange(1, PRIME), generator.randrange(PRIME)) for _ in range(count)]
+
+
+def band_keys(signature):
+    """
+    Returns the bucket key of each band of a signature; equal bands have equal keys.
+    """
+    return [
+        int.from_bytes(signature[i * ROWS:(i + 1) * ROWS].tobytes(), "little") % PRIME
+        for i in range(BANDS)
+    ]
+
+
+class SavedIndex:
+    """
+    A memory-mapped index file; its arrays are read in place, page by page, as lookups need them.
+    """
+
+    def __init__(self, data, count):
+        view = memoryview(data)
+        offset = HEADER.size
+
+        def take(size, format):
+            nonlocal offset
+            part = view[offset:offset + count * size].cast(format)
+            offset += count * size
+            return part
+
+        self.recipe_ids = take(8, "q")
+        self.keys = [take(8, "Q") for _ in range(BANDS)]
+        self.signatures = take(4 * NUM_HASHES, "I")
+        self.rows = [take(4, "I") for _ in range(BANDS)]
+
+    @staticmethod
+    def size(count):
+        return HEADER.size + count * (8 + 8 * BANDS + 4 * NUM_HASHES + 4 * BANDS)
+
+    def signature(self, recipe_id):
+        row = bisect_left(self.recipe_ids, recipe_id)
+        if row < len(self.recipe_ids) and self.recipe_ids[row] == recipe_id:
+            return self.signatures[row * NUM_HASHES:(row + 1) * NUM_HASHES]
+        return None
+
+    def bucket(self, band, key):
+        """
+        Returns the rows of the recipes in a bucket.
+        """
+        keys = self.keys[band]
+        start = bisect_left(keys, key)
+        return self.rows[band][start:bisect_right(keys, key, start)]
+
+    def row(self, row):
+        return self.recipe_ids[row], self.signatures[row * NUM_HASHES:(row + 1) * NUM_HASHES]
+
+    def items(self):
+        return map(self.row, range(len(self.recipe_ids)))
+
+
+class SimilarRecipesIndex:
+    """
+    MinHash signatures of the recipes, with an LSH index of their bands: a saved, memory-mapped
+    index (optional) under an in-memory one of the recipes changed since.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._clock = RefreshClock()
+        self._functions = hash_functions()
+        # Ingredient id -> its hash values under every function
+        self._vectors = {}
+        self.reset()
+
+    def reset(self):
+        """
+        Drops the index; it will be loaded or rebuilt on the next lookup.
+        """
+        with self._lock:
+            self._built = False
+            self._clock.reset()
+            self._saved = None
+            # Recipe id -> signature, or None for recipes without ingredients; hides the saved index
+            self._signatures = {}
+            # One dict per band: bucket key -> ids of the in-memory recipes in that bucket
+            self._buckets = [{} for _ in range(BANDS)]
+
+    def _vector(self, ingredient_id):
+        vector = self._vectors.get(ingredient_id)
+        if vector is None:
+            vector = self._vectors[ingredient_id] = array(
+                "I", [((a * ingredient_id + b) % PRIME) & MASK for a, b in self._functions]
+            )
+        return vector
+
+    def signature(self, ingredient_ids):
+        """
+        Returns the MinHash signature of a non-empty set of ingredient ids.
+        """
+        # The row of MASK values gives min() two arguments even for a single ingredient
+        return array("I", map(min, *[self._vector(i) for i in ingredient_ids], [MASK] * NUM_HASHES))
+
+    def _signature(self, recipe_id):
+        if recipe_id in self._signatures:
+            return self._signatures[recipe_id]
+        return self._saved.signature(recipe_id) if self._saved is not None else None
+
+    def _set(self, recipe_id, signature):
+        old = self._signatures.get(recipe_id)
+        if old is not None:
+            for buckets, key in zip(self._buckets, band_keys(old)):
+                bucket = buckets[key]
+                bucket.discard(recipe_id)
+                if not bucket:
+                    del buckets[key]
+        self._signatures[recipe_id] = signature
+        if signature is not None:
+            for buckets, key in zip(self._buckets, band_keys(signature)):
+                buckets.setdefault(key, set()).add(recipe_id)
+
+    def _items(self):
+        if self._saved is not None:
+            for recipe_id, signature in self._saved.items():
+                if recipe_id not in self._signatures:
+                    yield recipe_id, signature
+        for recipe_id, signature in self._signatures.items():
+            if signature is not None:
+                yield recipe_id, signature
+
+    def _ingredient_sets(self, queryset):
+        recipes = {}
+        for recipe_id, ingredient_id in queryset.values_list("recipe_id", "ingredient_id").iterator(chunk_size=10000):
+            recipes.setdefault(recipe_id, set()).add(ingredient_id)
+        return recipes
+
+    def build(self):
+        """
+        (Re)builds the index from the database in one pass over RecipeIngredient, and saves it to
+        SIMILAR_RECIPES_INDEX when that is set.
+        """
+        # Taken before reading, so that changes made during the build are refreshed on load
+        built_at = timezone.now()
+        recipes = self._ingredient_sets(RecipeIngredient.objects.all())
+        with self._lock:
+            self.reset()
+            self._clock.start(built_at)
+            for recipe_id, ingredient_ids in recipes.items():
+                self._set(recipe_id, self.signature(ingredient_ids))
+            self._built = True
+            path = getattr(settings, "SIMILAR_RECIPES_INDEX", "")
+            if path:
+                self.save(path, built_at)
+
+    def save(self, path, built_at):
+        """
+        Writes the index to a file, with the time the data it comes from was read.
+        """
+        with self._lock:
+            items = sorted(self._items(), key=operator.itemgetter(0))
+        signatures = array("I")
+        bands = [[] for _ in range(BANDS)]
+        for row, (_, signature) in enumerate(items):
+            signatures.extend(signature)
+            for band, key in zip(bands, band_keys(signature)):
+                band.append((key, row))
+        for band in bands:
+            band.sort()
+        header = HEADER.pack(
+            MAGIC, VERSION, NUM_HASHES, BANDS, ROWS, SEED, len(items), int(built_at.timestamp() * 1_000_000)
+        )
+        # Written to a temporary file and renamed, so that workers never map half a file
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as stream:
+            stream.write(header)
+            array("q", [recipe_id for recipe_id, _ in items]).tofile(stream)
+            for band in bands:
+                array("Q", [key for key, _ in band]).tofile(stream)
+            signatures.tofile(stream)
+            for band in bands:
+                array("I", [row for _, row in band]).tofile(stream)
+        os.replace(temporary, path)
+
+    def load(self, path):
+        """
+        Memory-maps a saved index and refreshes the recipes modified or deleted since it was
+        written.
+
+        Returns:
+            bool: Whether the file could be used; it can't when it's missing, was written with
+            other parameters or predates the tombstones kept.
+        """
+        try:
+            with open(path, "rb") as stream:
+                data = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return False
+        if len(data) < HEADER.size:
+            return False
+        *parameters, count, built_at = HEADER.unpack_from(data)
+        if parameters != [MAGIC, VERSION, NUM_HASHES, BANDS, ROWS, SEED] or len(data) != SavedIndex.size(count):
+            return False
+        built_at = datetime.fromtimestamp(built_at / 1_000_000, tz=dt_timezone.utc)
+        deleted = deleted_since(Recipe, built_at)
+        if deleted is None:
+            return False
+        with self._lock:
+            self.reset()
+            self._saved = SavedIndex(data, count)
+            self._built = True
+            self._clock.start()
+            self._remove_recipes(deleted)
+            self.update_recipes(Recipe.objects.filter(modified_at__gte=built_at).values_list("pk", flat=True))
+        return True
+
+    def _ensure_built(self):
+        if self._built:
+            self.refresh()
+            return
+        path = getattr(settings, "SIMILAR_RECIPES_INDEX", "")
+        if not (path and self.load(path)):
+            self.build()
+
+    def warm_up(self):
+        """
+        Loads or builds the index ahead of its first lookup.
+        """
+        with self._lock:
+            self._ensure_built()
+
+    def refresh(self):
+        """
+        Recomputes the signatures of the recipes other processes have changed since the last
+        refresh, once INDEX_REFRESH_INTERVAL has passed, and drops the deleted recipes.
+        """
+        with self._lock:
+            since = self._clock.due() if self._built else None
+            if since is None:
+                return
+            deleted = deleted_since(Recipe, since)
+            if deleted is None:
+                indexed = set(self._signatures)
+                if self._saved is not None:
+                    indexed.update(self._saved.recipe_ids)
+                deleted = indexed - set(Recipe.objects.values_list("pk", flat=True))
+            self._remove_recipes(deleted)
+            self.update_recipes(Recipe.objects.filter(modified_at__gte=since).values_list("pk", flat=True))
+
+    def _remove_recipes(self, recipe_ids):
+        for recipe_id in recipe_ids:
+            if self._signature(recipe_id) is not None:
+                self._set(recipe_id, None)
+
+    def update_recipe(self, recipe_id):
+        """
+        Recomputes one recipe's signature from the database.
+        """
+        self.update_recipes([recipe_id])
+
+    def update_recipes(self, recipe_ids):
+        """
+        Recomputes the signatures of several recipes from the database in one query.
+        """
+        with self._lock:
+            if not self._built:
+                return
+            recipe_ids = list(recipe_ids)
+            recipes = self._ingredient_sets(RecipeIngredient.objects.filter(recipe_id__in=recipe_ids))
+            for recipe_id in recipe_ids:
+                ingredient_ids = recipes.get(recipe_id)
+                self._set(recipe_id, self.signature(ingredient_ids) if ingredient_ids else None)
+
+    def remove_recipe(self, recipe_id):
+        with self._lock:
+            if self._built:
+                self._set(recipe_id, None)
+
+    def size(self):
+        """
+        Returns the number of recipes in the index.
+        """
+        with self._lock:
+            self._ensure_built()
+            return sum(1 for _ in self._items())
+
+    def similar(self, recipe_id, limit=10):
+        """
+        Returns the recipes most similar to a recipe by their ingredients.
+
+        Args:
+            recipe_id (int): The recipe to find similar ones for.
+            limit (int): The maximum number of recipes.
+
+        Returns:
+            list: (recipe_id, similarity) pairs, the most similar first, then by recipe id. The
+            similarity is an estimate of the Jaccard similarity of the ingredient sets.
+        """
+        with self._lock:
+            self._ensure_built()
+            signature = self._signature(recipe_id)
+            if signature is None and recipe_id not in self._signatures:
+                # Created in another process since this index was built
+                self.update_recipe(recipe_id)
+                signature = self._signatures[recipe_id]
+            if signature is None:
+                return []
+            rows = set()
+            candidates = {}
+            for band, (buckets, key) in enumerate(zip(self._buckets, band_keys(signature))):
+                for candidate in buckets.get(key, ()):
+                    candidates[candidate] = self._signatures[candidate]
+                if self._saved is not None:
+                    rows.update(self._saved.bucket(band, key))
+            for row in rows:
+                candidate, other = self._saved.row(row)
+                # Recipes in the in-memory index have changed since the file was saved
+                if candidate not in self._signatures:
+                    candidates[candidate] = other
+            candidates.pop(recipe_id, None)
+
+        scored = (
+            (sum(map(operator.eq, signature, other)), candidate)
+            for candidate, other in candidates.items()
+        )
+        best = heapq.nsmallest(limit, scored, key=lambda item: (-item[0], item[1]))
+        return [(candidate, agreed / NUM_HASHES) for agreed, candidate in best]
+
+
+similar_index = SimilarRecipesIndex()
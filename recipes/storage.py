@@ -0,0 +1,100 @@
+"""
+Content-addressed storage for uploaded images.
+
+Uploads are hashed (SHA-256) while they are streamed to a temporary file, then stored once under
+their digest:
+
+    blobs/3f/a2/3fa2...e9.jpg
+
+Uploading a file that is already stored writes nothing and returns the existing name, so every
+model pointing at the same picture shares one file. Each blob has a MediaBlob row whose
+reference count is maintained by the signal handlers in recipes.signals; the gc_media_blobs
+command recounts references and deletes unreferenced blobs, and migrate_media_to_blobs moves
+existing files into the store.
+"""
+import hashlib
+import os
+import tempfile
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.core.files.move import file_move_safe
+from django.utils import timezone
+from django.utils.functional import cached_property
+
+BLOBS_PREFIX = "blobs"
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    File system storage that deduplicates files by their content.
+    """
+    chunk_size = 64 * 1024
+
+    @cached_property
+    def named(self):
+        """
+        A plain FileSystemStorage over the same directory, for files that keep the name they are
+        saved under (e.g. image derivatives, which are named after their original).
+        """
+        return FileSystemStorage(
+            location=self._location,
+            base_url=self._base_url,
+            file_permissions_mode=self._file_permissions_mode,
+            directory_permissions_mode=self._directory_permissions_mode,
+        )
+
+    def blob_name(self, digest, extension):
+        return f"{BLOBS_PREFIX}/{digest[:2]}/{digest[2:4]}/{digest}{extension}"
+
+    def get_available_name(self, name, max_length=None):
+        # The final name is derived from the content in _save(); identical names are the same file.
+        return name
+
+    def _save(self, name, content):
+        extension = os.path.splitext(name)[1].lower()[:10]
+        temp_dir = self.path(f"{BLOBS_PREFIX}/tmp")
+        os.makedirs(temp_dir, exist_ok=True)
+
+        digest = hashlib.sha256()
+        size = 0
+        with tempfile.NamedTemporaryFile(dir=temp_dir, delete=False) as temp:
+            if hasattr(content, "seek"):
+                content.seek(0)
+            for chunk in content.chunks(self.chunk_size):
+                if isinstance(chunk, str):
+                    chunk = chunk.encode()
+                digest.update(chunk)
+                temp.write(chunk)
+                size += len(chunk)
+
+        blob = self.blob_name(digest.hexdigest(), extension)
+        if self.exists(blob):
+            os.unlink(temp.name)
+        else:
+            os.makedirs(os.path.dirname(self.path(blob)), exist_ok=True)
+            file_move_safe(temp.name, self.path(blob), allow_overwrite=True)
+            if self.file_permissions_mode is not None:
+                os.chmod(self.path(blob), self.file_permissions_mode)
+
+        MediaBlob = apps.get_model("recipes", "MediaBlob")
+        blob_row, created = MediaBlob.objects.get_or_create(name=blob, defaults={"size": size})
+        if not created:
+            # Restarts the gc grace period of an unreferenced blob until the new reference is saved
+            MediaBlob.objects.filter(pk=blob_row.pk).update(modified_at=timezone.now())
+        return blob
+
+
+def image_storage():
+    """
+    Returns the storage used by the models' image fields.
+
+    The content-addressed store is used unless CONTENT_ADDRESSED_MEDIA is False.
+    """
+    if getattr(settings, "CONTENT_ADDRESSED_MEDIA", True):
+        return content_addressed_storage
+    return default_storage
+
+
+content_addressed_storage = ContentAddressedStorage()
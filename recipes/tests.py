@@ -1,3 +1,1887 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import io
+import json
+import os
+import tempfile
+from datetime import timedelta
+from decimal import Decimal
+from types import ModuleType
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from PIL import Image
+
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+from django.db.models import Prefetch
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+from rest_framework.permissions import BasePermission
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+from rest_framework_simplejwt.tokens import AccessToken
+
+from . import feed, urls as recipe_urls
+
+from .async_views import AsyncReadMixin, async_read_urlpatterns
+from .autocomplete import autocomplete_index, normalize
+from .benchmark.data import DataGenerator
+from .benchmark.runner import BenchmarkRunner, InProcessClient, percentile
+from .benchmark.scenarios import SCENARIOS, BenchmarkContext, get_scenarios
+from .cache import recipe_cache
+from .db import _statement_budget, db_stats
+from .fast_serializers import FastRecipeSerializer
+from .explain import sequential_scans
+from .filters import RecipeFilter
+from .images import derivative_name, derivative_urls, generate_derivatives
+from .management.commands.import_recipes import RecipeImporter
+from .metrics import MetricsRegistry, registry as metrics_registry
+from .models import Comment, Follow, ImportProgress, Ingredient, MediaBlob, Profile, Recipe, RecipeIngredient, RequestProfile, TimelineEntry, Tombstone
+from .pantry import pantry_index
+from .replicas import ReplicaLagMonitor, ReplicaRouter, _replica_reads, pin_key
+from .search import PythonSearchBackend, get_backend as get_search_backend
+from .serializers import FollowSerializer, RecipeSerializer
+from .similar import similar_index
+from .storage import content_addressed_storage
+from .views import FollowViewSet, IngredientViewSet, RecipeViewSet
+
+
+class RecipeTestMixin:
+    """
+    Helpers for building recipes with ingredients in tests.
+    """
+
+    def make_user(self, username="cook"):
+        return get_user_model().objects.create_user(
+            username=username, email=f"{username}@example.com", password="secret-pass-123"
+        )
+
+    def make_ingredient(self, name):
+        return Ingredient.objects.create(name=name, image=f"images/ingredients/{name}.jpg")
+
+    def make_recipe(self, user, title, description="", ingredients=(), time_minutes=10):
+        recipe = Recipe.objects.create(
+            user=user, title=title, description=description, time_minutes=time_minutes
+        )
+        for ingredient in ingredients:
+            RecipeIngredient.objects.create(recipe=recipe, ingredient=ingredient, amount=1, unit="g")
+        return recipe
+
+
+@override_settings(FEED_FANOUT_ASYNC=False)
+class FeedTests(RecipeTestMixin, TestCase):
+    def setUp(self):
+        self.reader, self.alice, self.bob, self.carol = (
+            self.make_user(name) for name in ["reader", "alice", "bob", "carol"]
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.reader)
+
+    def post(self, user, title):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.make_recipe(user, title)
+
+    def follow(self, follower, followee):
+        client = APIClient()
+        client.force_authenticate(follower)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = client.post("/following/", {"followee": followee.id}, format="json")
+        self.assertEqual(response.status_code, 201)
+
+    def feed(self, **params):
+        response = self.client.get("/feed/", params)
+        self.assertEqual(response.status_code, 200)
+        return [recipe["title"] for recipe in response.json()["results"]]
+
+    def test_feed_follows_the_follow_graph(self):
+        self.post(self.alice, "Old soup")
+        self.post(self.bob, "Bread")
+        self.follow(self.reader, self.alice)
+        # The followee's earlier recipes are copied into the timeline
+        self.assertEqual(self.feed(), ["Old soup"])
+        self.post(self.alice, "New stew")
+        self.assertEqual(self.feed(), ["New stew", "Old soup"])
+        self.assertEqual(Profile.objects.get(user=self.alice).follower_count, 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.delete(f"/following/{self.alice.id}/")
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.feed(), [])
+        self.assertFalse(TimelineEntry.objects.filter(user=self.reader).exists())
+        self.assertEqual(Profile.objects.get(user=self.alice).follower_count, 0)
+
+    def test_pushes_after_an_unfollow_are_not_shown(self):
+        self.follow(self.reader, self.alice)
+        recipe = self.post(self.alice, "Soup")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(f"/following/{self.alice.id}/")
+        # Jobs that read the follow before it was deleted
+        feed.backfill(self.reader.id, self.alice.id)
+        feed.push([self.reader.id], [(recipe.id, recipe.created_at)])
+        self.assertEqual(self.feed(), [])
+        # Following again shows the entries again
+        self.follow(self.reader, self.alice)
+        self.assertEqual(self.feed(), ["Soup"])
+
+    def test_cursor_pagination(self):
+        self.follow(self.reader, self.alice)
+        titles = [f"Recipe {i}" for i in range(5)]
+        for title in titles:
+            self.post(self.alice, title)
+        seen = []
+        response = self.client.get("/feed/", {"page_size": 2})
+        while True:
+            seen += [recipe["title"] for recipe in response.json()["results"]]
+            if not response.json()["next"]:
+                break
+            response = self.client.get(response.json()["next"])
+        self.assertEqual(seen, titles[::-1])
+        self.assertEqual(self.client.get("/feed/", {"cursor": "garbage"}).status_code, 404)
+
+    @override_settings(FEED_TIMELINE_LENGTH=3)
+    def test_timelines_are_capped(self):
+        for i in range(5):
+            self.post(self.alice, f"Recipe {i}")
+        self.follow(self.reader, self.alice)
+        self.assertEqual(self.feed(), ["Recipe 4", "Recipe 3", "Recipe 2"])
+        self.post(self.alice, "Recipe 5")
+        self.assertEqual(TimelineEntry.objects.filter(user=self.reader).count(), 3)
+        self.assertEqual(self.feed(), ["Recipe 5", "Recipe 4", "Recipe 3"])
+
+    @override_settings(FEED_FANOUT_MAX_FOLLOWERS=2)
+    def test_popular_authors_are_fanned_out_on_read(self):
+        self.post(self.alice, "Pushed")
+        for follower in [self.reader, self.bob]:
+            self.follow(follower, self.alice)
+        self.follow(self.reader, self.carol)
+        self.post(self.carol, "Carol's")
+        self.follow(self.carol, self.alice)
+        self.post(self.alice, "Pulled")
+        self.assertTrue(Profile.objects.get(user=self.alice).fan_out_on_read)
+        self.assertFalse(TimelineEntry.objects.filter(recipe__title="Pulled").exists())
+        self.assertEqual(self.feed(), ["Pulled", "Carol's", "Pushed"])
+        self.assertEqual(self.feed(page_size=1), ["Pulled"])
+
+        TimelineEntry.objects.all().delete()
+        call_command("rebuild_timelines", stdout=io.StringIO())
+        self.assertEqual(self.feed(), ["Pulled", "Carol's", "Pushed"])
+        self.assertEqual(TimelineEntry.objects.filter(user=self.reader).count(), 1)
+
+    def test_follows_are_validated(self):
+        response = self.client.post("/following/", {"followee": self.reader.id}, format="json")
+        self.assertEqual(response.status_code, 400)
+        self.follow(self.reader, self.alice)
+        response = self.client.post("/following/", {"followee": self.alice.id}, format="json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            [follow["followee"] for follow in self.client.get("/following/").json()["results"]], [self.alice.id]
+        )
+        self.assertEqual(APIClient().get("/feed/").status_code, 401)
+
+    def test_follower_counts_revalidate_the_profile(self):
+        client = APIClient()
+        client.force_authenticate(self.alice)
+        etag = client.get("/profiles/me/")["ETag"]
+        for change in [
+            lambda: self.follow(self.reader, self.alice),
+            lambda: self.client.delete(f"/following/{self.alice.id}/"),
+        ]:
+            with self.captureOnCommitCallbacks(execute=True):
+                change()
+            response = client.get("/profiles/me/", HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            etag = response["ETag"]
+        self.assertEqual(response.json()["follower_count"], 0)
+
+    def test_concurrent_follows_are_rejected(self):
+        request = APIRequestFactory().post("/following/")
+        request.user = self.reader
+        serializer = FollowSerializer(data={"followee": self.alice.id}, context={"request": request})
+        self.assertTrue(serializer.is_valid())
+        # Another request creates the follow between validation and saving
+        Follow.objects.create(follower=self.reader, followee=self.alice)
+        view = FollowViewSet(request=request, format_kwarg=None)
+        with self.assertRaises(ValidationError):
+            view.perform_create(serializer)
+        self.assertEqual(Profile.objects.get(user=self.alice).follower_count, 1)
+
+
+class SimilarRecipesTests(RecipeTestMixin, TestCase):
+    def setUp(self):
+        similar_index.reset()
+        self.client = APIClient()
+        user = self.make_user()
+        self.egg, self.flour, self.milk, self.sugar, self.butter, self.vanilla, self.basil = (
+            self.make_ingredient(name) for name in ["egg", "flour", "milk", "sugar", "butter", "vanilla", "basil"]
+        )
+        baking = [self.egg, self.flour, self.milk, self.sugar, self.butter]
+        self.cake = self.make_recipe(user, "Cake", ingredients=baking)
+        self.sponge = self.make_recipe(user, "Sponge", ingredients=baking)
+        self.vanilla_cake = self.make_recipe(user, "Vanilla cake", ingredients=[*baking, self.vanilla])
+        self.pesto = self.make_recipe(user, "Pesto", ingredients=[self.basil])
+
+    def similar(self, recipe, **params):
+        response = self.client.get(f"/recipes/{recipe.id}/similar/", params)
+        self.assertEqual(response.status_code, 200)
+        return [(match["id"], match["similarity"]) for match in response.json()]
+
+    def test_ranks_by_shared_ingredients(self):
+        matches = self.similar(self.cake)
+        # Identical ingredient sets always have identical signatures
+        self.assertEqual(matches[0], (self.sponge.id, 1.0))
+        self.assertEqual([recipe_id for recipe_id, _ in matches], [self.sponge.id, self.vanilla_cake.id])
+        self.assertLess(matches[1][1], 1)
+        self.assertEqual(self.similar(self.cake, limit=1), [(self.sponge.id, 1.0)])
+        self.assertEqual(self.similar(self.pesto), [])
+
+    def change_pesto_and_delete_sponge(self):
+        RecipeIngredient.objects.filter(recipe=self.pesto).delete()
+        for ingredient in [self.egg, self.flour, self.milk, self.sugar, self.butter]:
+            RecipeIngredient.objects.create(recipe=self.pesto, ingredient=ingredient, amount=1)
+        self.sponge.delete()
+
+    def test_index_follows_changes(self):
+        self.similar(self.cake)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.change_pesto_and_delete_sponge()
+        self.assertEqual(self.similar(self.cake)[0], (self.pesto.id, 1.0))
+        self.assertNotIn(self.sponge.id, [recipe_id for recipe_id, _ in self.similar(self.cake)])
+
+    @override_settings(INDEX_REFRESH_INTERVAL=0)
+    def test_changes_of_other_processes_are_refreshed(self):
+        self.similar(self.cake)
+        # Committed by another process: the handlers of this one never run
+        with self.captureOnCommitCallbacks(execute=False):
+            self.change_pesto_and_delete_sponge()
+        with CaptureQueriesContext(connection) as queries:
+            matches = similar_index.similar(self.cake.id)
+        self.assertEqual(matches[0], (self.pesto.id, 1.0))
+        self.assertNotIn(self.sponge.id, [recipe_id for recipe_id, _ in matches])
+        # Deletions are read from the tombstones, not by scanning the table
+        self.assertTrue(all("WHERE" in query["sql"] for query in queries.captured_queries))
+
+    def test_saved_index_is_mapped_and_refreshed(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "similar.idx")
+            with override_settings(SIMILAR_RECIPES_INDEX=path):
+                call_command("build_similar_recipes", stdout=io.StringIO())
+                self.assertTrue(os.path.exists(path))
+                similar_index.reset()
+                # Changed while no worker had the index: refreshed from the database on load
+                RecipeIngredient.objects.filter(recipe=self.sponge, ingredient=self.butter).delete()
+                pesto_id = self.pesto.id
+                self.pesto.delete()
+                matches = self.similar(self.cake)
+                self.assertIsNotNone(similar_index._saved)
+                similarities = dict(matches)
+                self.assertEqual(similarities.keys(), {self.sponge.id, self.vanilla_cake.id})
+                self.assertIsNone(similar_index._signature(pesto_id))
+                self.assertLess(similarities[self.sponge.id], 1)
+                # A file written with other parameters is ignored and rebuilt
+                with open(path, "r+b") as stream:
+                    stream.write(b"XXXXXXXX")
+                similar_index.reset()
+                self.assertEqual(len(self.similar(self.cake)), 2)
+                self.assertIsNone(similar_index._saved)
+                similar_index.reset()
+
+    def test_query_is_validated(self):
+        self.assertEqual(self.client.get(f"/recipes/{self.cake.id}/similar/", {"limit": 0}).status_code, 400)
+        self.assertEqual(self.client.get("/recipes/999999/similar/").status_code, 404)
+
+
+class IngredientAutocompleteTests(RecipeTestMixin, TestCase):
+    def setUp(self):
+        autocomplete_index.reset()
+        pantry_index.reset()
+        self.client = APIClient()
+        user = self.make_user()
+        names = ["Tomato", "Tomato paste", "Cherry tomatoes", "Tomme de Savoie", "Olive oil", "Crème fraîche"]
+        self.ingredients = {name: self.make_ingredient(name) for name in names}
+        for i in range(3):
+            self.make_recipe(user, f"Sauce {i}", ingredients=[self.ingredients["Tomato paste"]])
+        self.make_recipe(user, "Salad", ingredients=[self.ingredients["Tomato"]])
+
+    def names(self, query, **params):
+        response = self.client.get("/ingredients/autocomplete/", {"q": query, **params})
+        self.assertEqual(response.status_code, 200)
+        return [match["name"] for match in response.json()]
+
+    def test_prefix_matches_rank_by_popularity(self):
+        self.assertEqual(self.names("tom"), ["Tomato paste", "Tomato", "Tomme de Savoie", "Cherry tomatoes"])
+        self.assertEqual(self.names("TOM", limit=1), ["Tomato paste"])
+        self.assertEqual(self.names("oil"), ["Olive oil"])
+        self.assertEqual(self.names("olive o"), ["Olive oil"])
+        response = self.client.get("/ingredients/autocomplete/", {"q": "tomato p", "limit": 1})
+        self.assertEqual(response.json(), [
+            {"id": self.ingredients["Tomato paste"].pk, "name": "Tomato paste", "recipe_count": 3}
+        ])
+
+    def test_typos_and_accents(self):
+        self.assertEqual(self.names("chery")[0], "Cherry tomatoes")
+        # A word's prefix still ranks above the closest spelling
+        self.assertEqual(self.names("tomatoe"), ["Cherry tomatoes", "Tomato", "Tomato paste"])
+        self.assertEqual(self.names("tomoto")[0], "Tomato")
+        self.assertEqual(self.names("creme"), ["Crème fraîche"])
+        self.assertEqual(normalize("  Crème   FRAÎCHE "), "creme fraiche")
+        self.assertEqual(self.names("xyz"), [])
+
+    def test_index_follows_ingredient_changes(self):
+        self.names("tom")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.change_ingredients()
+        autocomplete_index.add_new_ingredients()
+        self.assertEqual(self.names("tom"), ["Tomato", "Tomatillo", "Cherry tomatoes"])
+        self.assertEqual(self.names("pas"), ["Passata"])
+
+    def change_ingredients(self):
+        paste = self.ingredients["Tomato paste"]
+        paste.name = "Passata"
+        paste.save()
+        self.ingredients["Tomme de Savoie"].delete()
+        Ingredient.objects.bulk_create([Ingredient(name="Tomatillo")])
+
+    @override_settings(INDEX_REFRESH_INTERVAL=0)
+    def test_changes_of_other_processes_are_refreshed(self):
+        self.names("tom")
+        # Committed by another process: the handlers of this one never run
+        with self.captureOnCommitCallbacks(execute=False):
+            self.change_ingredients()
+        self.assertEqual(self.names("tom"), ["Tomato", "Tomatillo", "Cherry tomatoes"])
+        self.assertEqual(self.names("pas"), ["Passata"])
+
+    def test_rolled_back_changes_are_not_indexed(self):
+        self.names("tom")
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                self.change_ingredients()
+                raise RuntimeError("rolled back")
+        self.assertEqual(self.names("pas"), ["Tomato paste"])
+        self.assertIn("Tomme de Savoie", self.names("tom"))
+
+    @override_settings(FEED_FANOUT_ASYNC=False)
+    def test_cached_rankings_follow_recipe_counts(self):
+        self.assertEqual(self.names("t", limit=2), ["Tomato paste", "Tomato"])
+        user = get_user_model().objects.get()
+        with self.captureOnCommitCallbacks(execute=True):
+            for i in range(4):
+                self.make_recipe(user, f"Fondue {i}", ingredients=[self.ingredients["Tomme de Savoie"]])
+        self.assertEqual(self.names("t", limit=2), ["Tomme de Savoie", "Tomato paste"])
+
+    def test_lookup_makes_no_queries(self):
+        self.names("tom")
+        with self.assertNumQueries(0):
+            self.names("tomato")
+
+    def test_query_is_validated(self):
+        self.assertEqual(self.client.get("/ingredients/autocomplete/").status_code, 400)
+        self.assertEqual(self.client.get("/ingredients/autocomplete/", {"q": "tom", "limit": 0}).status_code, 400)
+
+
+class IngredientFilterTests(RecipeTestMixin, TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        user = self.make_user()
+        chicken, garlic, peanuts, rice = (self.make_ingredient(name) for name in ["Chicken", "Garlic", "Peanuts", "Rice"])
+        self.ids = {"chicken": chicken.pk, "garlic": garlic.pk, "peanuts": peanuts.pk}
+        self.make_recipe(user, "Garlic chicken", ingredients=[chicken, garlic])
+        self.make_recipe(user, "Satay", ingredients=[chicken, garlic, peanuts])
+        self.make_recipe(user, "Chicken rice", ingredients=[chicken, rice])
+        # The same ingredient twice, which a join would return twice
+        self.make_recipe(user, "Garlic bread", ingredients=[garlic, garlic])
+
+    def titles(self, **params):
+        response = self.client.get("/recipes/", params)
+        self.assertEqual(response.status_code, 200)
+        return sorted(recipe["title"] for recipe in response.json()["results"])
+
+    def test_all_any_none(self):
+        self.assertEqual(self.titles(ingredients_all="chicken,GARLIC"), ["Garlic chicken", "Satay"])
+        self.assertEqual(
+            self.titles(ingredients_all=f"{self.ids['chicken']},garlic", ingredients_none="peanuts"),
+            ["Garlic chicken"],
+        )
+        self.assertEqual(self.titles(ingredients_any="peanuts,Rice"), ["Chicken rice", "Satay"])
+        self.assertEqual(self.titles(ingredients_none=f"{self.ids['chicken']}"), ["Garlic bread"])
+        self.assertEqual(self.titles(ingredients_all="chicken,unknown"), [])
+
+    def test_ids_are_ascii_digits_in_range(self):
+        # Other digits are part of a name
+        self.assertEqual(self.titles(ingredients_all="²"), [])
+        self.assertEqual(self.titles(ingredients_none="٣"), ["Chicken rice", "Garlic bread", "Garlic chicken", "Satay"])
+        for params in [{"ingredients_all": "99999999999999999999"}, {"ingredients_any": "garlic,9223372036854775808"},
+                       {"ingredients__ingredient__name__iexact": "99999999999999999999"}]:
+            with self.subTest(params=params):
+                response = self.client.get("/recipes/", params)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn(next(iter(params)), response.json())
+        self.assertEqual(self.titles(ingredients_any="9223372036854775807"), [])
+
+    def test_no_duplicates_from_joins(self):
+        self.assertEqual(self.titles(ingredients__ingredient__name__iexact="garlic"), ["Garlic bread", "Garlic chicken", "Satay"])
+        self.assertEqual(self.titles(ingredients_any="garlic,chicken"), ["Chicken rice", "Garlic bread", "Garlic chicken", "Satay"])
+
+    def test_compiles_to_exists(self):
+        filterset = RecipeFilter({"ingredients_all": "chicken,garlic", "ingredients_none": "7"}, Recipe.objects.all())
+        sql = str(filterset.qs.query).upper()
+        self.assertEqual(sql.count("EXISTS"), 3)
+        self.assertNotIn("DISTINCT", sql)
+        self.assertNotIn("JOIN", sql)
+
+
+class QueryPlanTests(RecipeTestMixin, TestCase):
+    """
+    Runs EXPLAIN on every query of the main endpoints and fails on full scans of the large tables.
+    """
+    large_tables = {model._meta.db_table for model in (get_user_model(), Recipe, RecipeIngredient, Ingredient, Comment)}
+
+    def setUp(self):
+        self.client = APIClient()
+        self.user = self.make_user()
+        self.ingredients = [self.make_ingredient(name) for name in ["Chicken", "Garlic", "Peanuts"]]
+        self.recipes = [
+            self.make_recipe(self.user, f"Recipe {i}", ingredients=self.ingredients[:i % 3 + 1], time_minutes=10 * i)
+            for i in range(1, 6)
+        ]
+        self.comment = Comment.objects.create(recipe=self.recipes[0], user=self.user, comment="Tasty")
+
+    def endpoints(self):
+        recipe, chicken = self.recipes[0], self.ingredients[0]
+        return [
+            ("/recipes/", {}),
+            ("/recipes/", {"pagination": "cursor"}),
+            ("/recipes/", {"ordering": "-created_at"}),
+            ("/recipes/", {"time_minutes__lte": 30}),
+            ("/recipes/", {"user__username__iexact": "COOK"}),
+            ("/recipes/", {"ingredients_all": f"{chicken.pk},garlic", "ingredients_none": "peanuts"}),
+            (f"/recipes/{recipe.pk}/", {}),
+            ("/recipes/pantry-match/", {"ingredients": f"{chicken.pk}"}),
+            (f"/recipes/{recipe.pk}/comments/", {}),
+            (f"/recipes/{recipe.pk}/comments/{self.comment.pk}/", {}),
+            ("/ingredients/", {}),
+            (f"/ingredients/{chicken.pk}/", {}),
+        ]
+
+    def test_no_sequential_scans(self):
+        for path, params in self.endpoints():
+            with self.subTest(path=path, params=params):
+                cache.clear()
+                with CaptureQueriesContext(connection) as queries:
+                    self.assertEqual(self.client.get(path, params).status_code, 200)
+                for query in queries:
+                    if query["sql"].startswith("SELECT"):
+                        scans = sequential_scans(query["sql"]) & self.large_tables
+                        self.assertFalse(scans, f"{query['sql']} scans {', '.join(sorted(scans))}")
+
+    def test_scans_are_found(self):
+        recipes = Recipe.objects.order_by()
+        self.assertEqual(sequential_scans(str(recipes.filter(ingredient_count=2).query)), {"recipes_recipe"})
+        self.assertEqual(sequential_scans(str(recipes.filter(time_minutes=10).query)), set())
+
+
+class ShoppingListTests(RecipeTestMixin, TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = self.make_user()
+        self.flour, self.milk, self.egg, self.garlic = (
+            self.make_ingredient(name) for name in ["Flour", "Milk", "Egg", "Garlic"]
+        )
+
+    def make_recipe_with(self, title, *rows):
+        recipe = self.make_recipe(self.user, title)
+        for ingredient, amount, unit in rows:
+            RecipeIngredient.objects.create(recipe=recipe, ingredient=ingredient, amount=amount, unit=unit)
+        return recipe
+
+    def test_units_are_converted_and_summed(self):
+        pancakes = self.make_recipe_with(
+            "Pancakes", (self.flour, "250", "g"), (self.milk, "0.5", "l"), (self.egg, "2", None),
+            (self.garlic, "1", "clove"),
+        )
+        bread = self.make_recipe_with(
+            "Bread", (self.flour, "0.5", " KG "), (self.milk, "2", "tbsp"), (self.egg, "1", "pc"),
+            (self.garlic, "2", "Cloves"), (self.garlic, "1", "tsp"),
+        )
+        response = self.client.post("/shopping-list/", {
+            "recipes": [{"id": pancakes.pk, "multiplier": "2"}, {"id": bread.pk}, {"id": 999}],
+        }, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {
+            "recipes": 2,
+            "missing_recipes": [999],
+            "items": [
+                {"ingredient": self.egg.pk, "name": "Egg", "amount": "5.00", "unit": None},
+                {"ingredient": self.flour.pk, "name": "Flour", "amount": "1.00", "unit": "kg"},
+                {"ingredient": self.garlic.pk, "name": "Garlic", "amount": "2.00", "unit": "clove"},
+                {"ingredient": self.garlic.pk, "name": "Garlic", "amount": "2.00", "unit": "cloves"},
+                {"ingredient": self.garlic.pk, "name": "Garlic", "amount": "5.00", "unit": "ml"},
+                {"ingredient": self.milk.pk, "name": "Milk", "amount": "1.03", "unit": "l"},
+            ],
+        })
+
+    def test_many_recipes_in_two_queries(self):
+        recipes = [
+            self.make_recipe_with(f"Bread {i}", (self.flour, "100", "g"), (self.milk, "1", "cup"))
+            for i in range(120)
+        ]
+        with self.assertNumQueries(2):
+            response = self.client.get("/shopping-list/", {"recipes": ",".join(f"{r.pk}:0.5" for r in recipes)})
+        self.assertEqual(response.json()["items"], [
+            {"ingredient": self.flour.pk, "name": "Flour", "amount": "6.00", "unit": "kg"},
+            {"ingredient": self.milk.pk, "name": "Milk", "amount": "14.40", "unit": "l"},
+        ])
+
+    def test_query_is_validated(self):
+        self.assertEqual(self.client.get("/shopping-list/").status_code, 400)
+        self.assertEqual(self.client.get("/shopping-list/", {"recipes": "1:0"}).status_code, 400)
+        self.assertEqual(self.client.get("/shopping-list/", {"recipes": "one"}).status_code, 400)
+        self.assertEqual(self.client.get("/shopping-list/", {"recipes": str(2 ** 70)}).status_code, 400)
+        response = self.client.post("/shopping-list/", {"recipes": [{"id": 2 ** 63}]}, format="json")
+        self.assertEqual(response.status_code, 400)
+
+
+class RecipeSearchTests(RecipeTestMixin, TestCase):
+    def setUp(self):
+        backend = get_search_backend()
+        if isinstance(backend, PythonSearchBackend):
+            backend.reset()
+        self.client = APIClient()
+        self.user = self.make_user()
+        garlic = self.make_ingredient("garlic")
+        chicken = self.make_ingredient("chicken")
+        self.soup = self.make_recipe(self.user, "Chicken soup", "A warm soup.", [chicken])
+        self.roast = self.make_recipe(self.user, "Sunday roast", "Roast chicken with garlic.", [chicken, garlic])
+        self.bread = self.make_recipe(self.user, "Garlic bread", "Bread with butter.", [garlic])
+
+    def search(self, query):
+        response = self.client.get("/recipes/", {"q": query})
+        self.assertEqual(response.status_code, 200)
+        return [recipe["id"] for recipe in response.data["results"]]
+
+    def test_title_matches_rank_above_description_and_ingredients(self):
+        self.assertEqual(self.search("chicken"), [self.soup.id, self.roast.id])
+        self.assertEqual(self.search("garlic"), [self.bread.id, self.roast.id])
+
+    def test_all_terms_must_match(self):
+        self.assertEqual(self.search("garlic chicken"), [self.roast.id])
+        self.assertEqual(self.search("garlic soup"), [])
+
+    def test_index_follows_changes(self):
+        self.search("chicken")
+        self.bread.title = "Chicken bread"
+        self.bread.save()
+        self.soup.delete()
+        self.assertEqual(self.search("chicken"), [self.bread.id, self.roast.id])
+
+    def test_legacy_search_param(self):
+        response = self.client.get("/recipes/", {"search": "bread"})
+        self.assertEqual([recipe["id"] for recipe in response.data["results"]], [self.bread.id])
+
+
+class PantryMatchTests(RecipeTestMixin, TestCase):
+    def setUp(self):
+        pantry_index.reset()
+        self.client = APIClient()
+        user = self.make_user()
+        self.egg, self.flour, self.milk, self.sugar = (
+            self.make_ingredient(name) for name in ["egg", "flour", "milk", "sugar"]
+        )
+        self.omelette = self.make_recipe(user, "Omelette", ingredients=[self.egg])
+        self.pancakes = self.make_recipe(user, "Pancakes", ingredients=[self.egg, self.flour, self.milk])
+        self.cake = self.make_recipe(user, "Cake", ingredients=[self.egg, self.flour, self.milk, self.sugar])
+        self.custard = self.make_recipe(user, "Custard", ingredients=[self.milk, self.sugar])
+
+    def match(self, ingredients, **params):
+        ids = ",".join(str(ingredient.id) for ingredient in ingredients)
+        response = self.client.get("/recipes/pantry-match/", {"ingredients": ids, **params})
+        self.assertEqual(response.status_code, 200)
+        return [(recipe["id"], recipe["missing_count"]) for recipe in response.data["results"]]
+
+    def test_ranks_by_missing_ingredients(self):
+        self.assertEqual(
+            self.match([self.egg, self.flour]),
+            [(self.omelette.id, 0), (self.pancakes.id, 1), (self.cake.id, 2)],
+        )
+        self.assertEqual(
+            self.match([self.egg, self.flour], max_missing=1),
+            [(self.omelette.id, 0), (self.pancakes.id, 1)],
+        )
+
+    def change_recipes(self):
+        RecipeIngredient.objects.create(recipe=self.omelette, ingredient=self.milk, amount=1)
+        RecipeIngredient.objects.filter(recipe=self.custard, ingredient=self.sugar).delete()
+        self.cake.delete()
+
+    def test_index_follows_changes(self):
+        self.match([self.milk])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.change_recipes()
+        self.assertEqual(
+            self.match([self.milk]),
+            [(self.custard.id, 0), (self.omelette.id, 1), (self.pancakes.id, 2)],
+        )
+
+    @override_settings(INDEX_REFRESH_INTERVAL=0)
+    def test_changes_of_other_processes_are_refreshed(self):
+        self.match([self.milk])
+        # Committed by another process: the handlers of this one never run
+        with self.captureOnCommitCallbacks(execute=False):
+            self.change_recipes()
+        with CaptureQueriesContext(connection) as queries:
+            matches = list(pantry_index.match([self.milk.id]))
+        self.assertEqual(matches, [(self.custard.id, 0), (self.omelette.id, 1), (self.pancakes.id, 2)])
+        # Deletions are read from the tombstones, not by scanning the table
+        self.assertTrue(all("WHERE" in query["sql"] for query in queries.captured_queries))
+
+    @override_settings(INDEX_REFRESH_INTERVAL=0, INDEX_TOMBSTONE_RETENTION=0)
+    def test_refreshes_older_than_the_tombstones_compare_ids(self):
+        self.match([self.milk])
+        with self.captureOnCommitCallbacks(execute=False):
+            self.change_recipes()
+        call_command("prune_tombstones", stdout=io.StringIO())
+        self.assertFalse(Tombstone.objects.exists())
+        self.assertEqual(
+            list(pantry_index.match([self.milk.id])),
+            [(self.custard.id, 0), (self.omelette.id, 1), (self.pancakes.id, 2)],
+        )
+
+    def test_rare_ingredients_are_kept_as_sets(self):
+        user = get_user_model().objects.get()
+        Recipe.objects.create(id=100_000, user=user, title="Late", time_minutes=1, description="")
+        with self.captureOnCommitCallbacks(execute=True):
+            RecipeIngredient.objects.create(recipe_id=100_000, ingredient=self.sugar, amount=1)
+        pantry_index.reset()
+        self.assertEqual(
+            list(pantry_index.match([self.sugar.id])),
+            [(100_000, 0), (self.custard.id, 1), (self.cake.id, 3)],
+        )
+        self.assertIsInstance(pantry_index._ingredients[self.sugar.id], set)
+        self.assertEqual(pantry_index.recipe_counts([self.sugar.id, self.egg.id]), {self.sugar.id: 3, self.egg.id: 3})
+        with self.captureOnCommitCallbacks(execute=True):
+            RecipeIngredient.objects.create(recipe=self.omelette, ingredient=self.sugar, amount=1)
+            self.custard.delete()
+        self.assertEqual(
+            list(pantry_index.match([self.sugar.id, self.egg.id])),
+            [(self.omelette.id, 0), (100_000, 0), (self.pancakes.id, 2), (self.cake.id, 2)],
+        )
+
+    def test_rolled_back_changes_are_not_indexed(self):
+        cake_id = self.cake.id
+        self.match([self.milk])
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                self.change_recipes()
+                raise RuntimeError("rolled back")
+        self.assertEqual(
+            list(pantry_index.match([self.milk.id])),
+            [(self.custard.id, 1), (self.pancakes.id, 2), (cake_id, 3)],
+        )
+
+    def test_post_body_and_validation(self):
+        response = self.client.post(
+            "/recipes/pantry-match/", {"ingredients": [self.milk.id, self.sugar.id]}, format="json"
+        )
+        self.assertEqual(response.data["results"][0]["id"], self.custard.id)
+        response = self.client.get("/recipes/pantry-match/", {"ingredients": "abc"})
+        self.assertEqual(response.status_code, 400)
+
+
+class QueryBudgetTests(RecipeTestMixin, TestCase):
+    """
+    Every read endpoint must load in a fixed number of queries, whatever the page size.
+    """
+    page_sizes = [1, 5, 20]
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user(
+            username="budget", email="budget@example.com", password="secret-pass-123"
+        )
+        cls.admin = get_user_model().objects.create_superuser(
+            username="admin", email="admin@example.com", password="secret-pass-123"
+        )
+        ingredients = [
+            Ingredient.objects.create(name=f"ingredient {i}", image=f"images/ingredients/{i}.jpg")
+            for i in range(12)
+        ]
+        for i in range(20):
+            recipe = Recipe.objects.create(user=cls.user, title=f"Recipe {i}", description="", time_minutes=i)
+            for ingredient in ingredients:
+                RecipeIngredient.objects.create(recipe=recipe, ingredient=ingredient, amount=1, unit="g")
+            Comment.objects.create(recipe=recipe, user=cls.user, comment="Tasty")
+        cls.recipe = recipe
+        cls.ingredients = ingredients
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+    def assertBudget(self, budget, url, params=None):
+        # ETag validators are computed from the fetched rows, without a query of their own.
+        with self.assertNumQueries(budget):
+            response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_recipe_list(self):
+        for page_size in self.page_sizes:
+            with self.subTest(page_size=page_size):
+                # COUNT, recipes, ingredient rows joined with their ingredients
+                response = self.assertBudget(3, "/recipes/", {"page_size": page_size})
+                self.assertEqual(len(response.data["results"]), page_size)
+                # Served from the fragment cache: COUNT, recipes
+                self.assertBudget(2, "/recipes/", {"page_size": page_size})
+
+    def test_recipe_detail(self):
+        self.assertBudget(2, f"/recipes/{self.recipe.id}/")
+        self.assertBudget(1, f"/recipes/{self.recipe.id}/")
+
+    def test_pantry_match(self):
+        pantry_index.build()
+        ids = ",".join(str(ingredient.id) for ingredient in self.ingredients[:3])
+        for page_size in self.page_sizes:
+            with self.subTest(page_size=page_size):
+                self.assertBudget(2, "/recipes/pantry-match/", {"ingredients": ids, "page_size": page_size})
+
+    def test_ingredient_list(self):
+        for page_size in self.page_sizes:
+            with self.subTest(page_size=page_size):
+                self.assertBudget(2, "/ingredients/", {"page_size": page_size})
+
+    def test_ingredient_detail(self):
+        self.assertBudget(1, f"/ingredients/{self.ingredients[0].id}/")
+
+    def test_comment_list(self):
+        # Not paginated by default: one query for all the comments
+        response = self.assertBudget(1, f"/recipes/{self.recipe.id}/comments/")
+        self.assertIsInstance(response.data, list)
+
+    def test_keyset_pages(self):
+        for page_size in self.page_sizes:
+            with self.subTest(page_size=page_size):
+                cache.clear()
+                # No COUNT: recipes, ingredient rows joined with their ingredients
+                response = self.assertBudget(2, "/recipes/", {"pagination": "cursor", "page_size": page_size})
+                if response.data["next"]:
+                    self.assertBudget(2, response.data["next"])
+                self.assertBudget(1, "/ingredients/", {"pagination": "cursor", "page_size": page_size})
+                self.assertBudget(1, f"/recipes/{self.recipe.id}/comments/", {"pagination": "cursor"})
+
+    def test_profile_list(self):
+        self.client.force_authenticate(self.admin)
+        self.assertBudget(1, "/profiles/")
+
+    def test_profile_me(self):
+        self.client.force_authenticate(self.user)
+        self.assertBudget(1, "/profiles/me/")
+
+
+class KeysetPaginationTests(RecipeTestMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = get_user_model().objects.create_user(
+            username="pager", email="pager@example.com", password="secret-pass-123"
+        )
+        # Duplicate time_minutes values exercise the id tiebreaker.
+        cls.recipes = [
+            Recipe.objects.create(user=user, title=f"Recipe {i}", description="", time_minutes=i % 3)
+            for i in range(7)
+        ]
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def walk(self, url, link):
+        ids = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn("count", response.data)
+            ids.append([recipe["id"] for recipe in response.data["results"]])
+            url = response.data[link]
+        return ids
+
+    def test_walks_forward_and_back(self):
+        pages = self.walk("/recipes/?pagination=cursor&page_size=3", "next")
+        self.assertEqual(pages, [[r.id for r in self.recipes[i:i + 3]] for i in range(0, 7, 3)])
+
+        last = self.client.get("/recipes/?pagination=cursor&page_size=3").data["next"]
+        last = self.client.get(last).data["next"]
+        self.assertEqual(self.walk(last, "previous")[1:], [pages[1], pages[0]])
+
+    def test_orders_by_requested_field_with_id_tiebreaker(self):
+        pages = self.walk("/recipes/?pagination=cursor&page_size=2&ordering=-time_minutes", "next")
+        expected = sorted(self.recipes, key=lambda r: (-r.time_minutes, -r.id))
+        self.assertEqual(sum(pages, []), [r.id for r in expected])
+
+    def test_page_numbers_still_work(self):
+        response = self.client.get("/recipes/", {"page": 2, "page_size": 3})
+        self.assertEqual(response.data["count"], 7)
+        self.assertEqual([r["id"] for r in response.data["results"]], [r.id for r in self.recipes[3:6]])
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get("/recipes/", {"cursor": "nope"}).status_code, 404)
+
+    def test_search_results_are_paged_by_cursor_only_in_an_ordering(self):
+        response = self.client.get("/recipes/", {"q": "recipe", "pagination": "cursor"})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("cursor", response.data)
+        pages = self.walk("/recipes/?q=recipe&pagination=cursor&page_size=3&ordering=time_minutes", "next")
+        expected = sorted(self.recipes, key=lambda r: (r.time_minutes, r.id))
+        self.assertEqual(sum(pages, []), [r.id for r in expected])
+
+    def test_ingredients_are_ordered_by_name(self):
+        for name in ["thyme", "basil", "sage"]:
+            Ingredient.objects.create(name=name)
+        response = self.client.get("/ingredients/", {"ordering": "-name"})
+        self.assertEqual([ingredient["name"] for ingredient in response.data["results"]], ["thyme", "sage", "basil"])
+        pages = self.walk("/ingredients/?pagination=cursor&page_size=2&ordering=name", "next")
+        self.assertEqual(pages, [[Ingredient.objects.get(name=name).id for name in names]
+                                 for names in [["basil", "sage"], ["thyme"]]])
+
+    def test_comments_are_only_paginated_on_request(self):
+        recipe = self.recipes[0]
+        comments = [
+            Comment.objects.create(recipe=recipe, user=recipe.user, comment=f"Comment {i}").id for i in range(12)
+        ]
+        response = self.client.get(f"/recipes/{recipe.id}/comments/")
+        self.assertEqual([comment["id"] for comment in response.data], comments)
+        pages = self.walk(f"/recipes/{recipe.id}/comments/?pagination=cursor&page_size=5", "next")
+        self.assertEqual(pages, [comments[:5], comments[5:10], comments[10:]])
+
+
+class RecipeFragmentCacheTests(RecipeTestMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        recipe_cache.reset_stats()
+        self.client = APIClient()
+        user = self.make_user()
+        self.garlic = self.make_ingredient("garlic")
+        self.recipe = self.make_recipe(user, "Garlic bread", ingredients=[self.garlic])
+
+    def get(self):
+        return self.client.get(f"/recipes/{self.recipe.id}/").data
+
+    def test_counts_hits_and_misses(self):
+        first = self.get()
+        self.assertEqual(self.client.get("/recipes/").data["results"], [first])
+        self.assertEqual(recipe_cache.stats(), {"hits": 1, "misses": 1})
+
+    def test_invalidated_by_changes(self):
+        self.get()
+        self.garlic.name = "wild garlic"
+        self.garlic.save()
+        self.assertEqual(self.get()["ingredients"][0]["name"], "wild garlic")
+
+        RecipeIngredient.objects.create(recipe=self.recipe, ingredient=self.make_ingredient("oil"), amount=2)
+        self.assertEqual(len(self.get()["ingredients"]), 2)
+
+        self.recipe.title = "Garlic toast"
+        self.recipe.save()
+        self.assertEqual(self.get()["title"], "Garlic toast")
+        self.assertEqual(recipe_cache.stats(), {"hits": 0, "misses": 4})
+
+    def test_keyed_by_base_url(self):
+        self.get()
+        response = self.client.get(f"/recipes/{self.recipe.id}/", HTTP_HOST="api.example.com")
+        self.assertTrue(response.data["ingredients"][0]["image"].startswith("http://api.example.com/"))
+
+
+class ConditionalGetTests(RecipeTestMixin, TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = self.make_user()
+        self.salt = self.make_ingredient("salt")
+        self.recipe = self.make_recipe(self.user, "Fries", ingredients=[self.salt])
+
+    def assertRevalidates(self, url, change, queries=1):
+        response = self.client.get(url)
+        etag = response["ETag"]
+        # Only the rows of the response are fetched; nothing is serialized
+        with self.assertNumQueries(queries):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        change()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_recipe_list(self):
+        # COUNT and the page
+        self.assertRevalidates("/recipes/", lambda: self.make_recipe(self.user, "Chips"), queries=2)
+        self.assertRevalidates("/recipes/", lambda: Recipe.objects.filter(title="Chips").delete(), queries=2)
+
+    def test_keyset_pages_are_not_counted(self):
+        for i in range(3):
+            self.make_recipe(self.user, f"Chips {i}")
+        url = self.client.get("/recipes/", {"pagination": "cursor", "page_size": 2}).data["next"]
+        # Only the page is fetched, however deep it is
+        self.assertRevalidates(url, lambda: Recipe.objects.get(title="Chips 2").save())
+        self.assertRevalidates(url, lambda: self.make_recipe(self.user, "Chips 3"))
+        # Rows past a page that already links to the next one leave it unchanged
+        etag = self.client.get(url)["ETag"]
+        self.make_recipe(self.user, "Chips 4")
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_recipe_detail(self):
+        url = f"/recipes/{self.recipe.id}/"
+        self.assertRevalidates(url, lambda: Ingredient.objects.filter(pk=self.salt.pk).get().save())
+        last_modified = self.client.get(url)["Last-Modified"]
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+    def test_ingredients_and_comments(self):
+        self.assertRevalidates("/ingredients/", lambda: self.make_ingredient("pepper"), queries=2)
+        self.assertRevalidates(
+            f"/recipes/{self.recipe.id}/comments/",
+            lambda: Comment.objects.create(recipe=self.recipe, user=self.user, comment="Crispy"),
+        )
+
+    def test_profile_me(self):
+        self.client.force_authenticate(self.user)
+        profile = self.user.profile
+        self.assertRevalidates("/profiles/me/", lambda: profile.save())
+
+    def test_missing_object_is_not_found(self):
+        response = self.client.get("/recipes/0/", HTTP_IF_NONE_MATCH="*")
+        self.assertEqual(response.status_code, 404)
+
+    def test_object_permissions_are_checked_before_not_modified(self):
+        class Denied(BasePermission):
+            def has_object_permission(self, request, view, obj):
+                return False
+
+        url = f"/recipes/{self.recipe.id}/"
+        etag = self.client.get(url)["ETag"]
+        class DeniedRecipeViewSet(RecipeViewSet):
+            def get_permissions(self):
+                return [Denied()]
+
+        view = DeniedRecipeViewSet.as_view({"get": "retrieve"})
+        request = APIRequestFactory().get(url, HTTP_IF_NONE_MATCH=etag)
+        # Denied to an anonymous user, hence 401
+        self.assertEqual(view(request, pk=self.recipe.id).status_code, 401)
+
+
+# New recipes are pushed to feeds inline: a pool thread can't see the test's transaction
+@override_settings(FEED_FANOUT_ASYNC=False)
+class BulkCreateTests(RecipeTestMixin, TestCase):
+    def setUp(self):
+        pantry_index.reset()
+        backend = get_search_backend()
+        if isinstance(backend, PythonSearchBackend):
+            backend.reset()
+        self.client = APIClient()
+        self.user = self.make_user()
+        self.client.force_authenticate(self.user)
+        self.egg = self.make_ingredient("egg")
+        self.milk = self.make_ingredient("milk")
+
+    def recipe(self, title, *ingredients):
+        return {
+            "title": title,
+            "time_minutes": 5,
+            "description": "Quick.",
+            "ingredients": [{"ingredient": i, "amount": "1.00", "unit": "pc"} for i in ingredients],
+        }
+
+    def test_creates_batch_in_fixed_queries(self):
+        batch = [self.recipe(f"Recipe {i}", self.egg.id, self.milk.id) for i in range(30)]
+        # savepoint, ingredient ids, recipes, ingredient rows, release
+        with self.assertNumQueries(5):
+            response = self.client.post("/recipes/bulk/", batch, format="json")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.data), 30)
+        self.assertEqual(Recipe.objects.filter(user=self.user).count(), 30)
+        self.assertEqual(RecipeIngredient.objects.count(), 60)
+
+    def test_reports_errors_per_item(self):
+        batch = [
+            self.recipe("Good", self.egg.id),
+            self.recipe("Unknown ingredient", self.egg.id, 9999),
+            {**self.recipe("No time", self.milk.id), "time_minutes": "soon"},
+            self.recipe("Id out of range", 2 ** 63, str(2 ** 70)),
+        ]
+        response = self.client.post("/recipes/bulk/", batch, format="json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data[0], {})
+        self.assertIn("ingredient", response.data[1]["ingredients"][1])
+        self.assertIn("time_minutes", response.data[2])
+        self.assertIn("ingredient", response.data[3]["ingredients"][0])
+        self.assertIn("ingredient", response.data[3]["ingredients"][1])
+        self.assertFalse(Recipe.objects.exists())
+
+    def test_new_recipes_are_searchable_and_matchable(self):
+        pantry_index.build()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post("/recipes/bulk/", [self.recipe("Boiled egg", self.egg.id)], format="json")
+        recipe = Recipe.objects.get()
+        self.assertEqual([r["id"] for r in self.client.get("/recipes/", {"q": "boiled"}).data["results"]], [recipe.id])
+        response = self.client.get("/recipes/pantry-match/", {"ingredients": self.egg.id})
+        self.assertEqual(response.data["results"][0]["id"], recipe.id)
+
+    def test_requires_authentication(self):
+        self.client.force_authenticate(None)
+        self.assertEqual(self.client.post("/recipes/bulk/", [], format="json").status_code, 401)
+
+
+class ImportRecipesTests(RecipeTestMixin, TestCase):
+    def setUp(self):
+        self.user = self.make_user("alice")
+        self.egg = self.make_ingredient("egg")
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def write(self, name, content):
+        path = os.path.join(self.directory.name, name)
+        with open(path, "w") as stream:
+            stream.write(content)
+        return path
+
+    def run_import(self, path, *args):
+        out = io.StringIO()
+        call_command("import_recipes", path, *args, stdout=out, stderr=io.StringIO())
+        return out.getvalue()
+
+    def test_imports_jsonl_and_upserts_ingredients(self):
+        records = [
+            {"title": "Omelette", "time_minutes": 5, "user": "alice",
+             "ingredients": [{"name": "egg", "amount": 2, "unit": "pc"}, {"name": "chives", "amount": "0.5"}]},
+            {"title": "Broken", "time_minutes": "soon"},
+            {"title": "Chives", "time_minutes": 1, "ingredients": [{"name": "chives", "amount": 1}]},
+        ]
+        path = self.write("recipes.jsonl", "\n".join(json.dumps(r) for r in records))
+        output = self.run_import(path, "--user", "alice", "--batch-size", "2")
+        self.assertIn("Imported 2 recipes and 3 ingredients", output)
+        self.assertEqual(Ingredient.objects.filter(name="chives").count(), 1)
+        omelette = Recipe.objects.get(title="Omelette")
+        self.assertEqual(
+            sorted(omelette.ingredients.values_list("ingredient__name", "amount", "unit")),
+            [("chives", Decimal("0.50"), None), ("egg", Decimal("2.00"), "pc")],
+        )
+
+    def test_values_the_columns_cannot_hold_are_invalid(self):
+        egg = {"name": "egg", "amount": 1}
+        records = [
+            {"title": "NaN", "time_minutes": 1, "ingredients": [{**egg, "amount": "NaN"}]},
+            {"title": "Infinite", "time_minutes": 1, "ingredients": [{**egg, "amount": "Infinity"}]},
+            {"title": "Huge", "time_minutes": 1, "ingredients": [{**egg, "amount": "123456789"}]},
+            {"title": "Precise", "time_minutes": 1, "ingredients": [{**egg, "amount": "0.125"}]},
+            {"title": "Unit", "time_minutes": 1, "ingredients": [{**egg, "unit": "g" * 256}]},
+            {"title": "Custom", "time_minutes": 1, "ingredients": [{**egg, "custom_name": "x" * 256}]},
+            {"title": "t" * 256, "time_minutes": 1},
+            {"title": "Fine", "time_minutes": 1, "ingredients": [{**egg, "amount": "12345678.99"}]},
+        ]
+        path = self.write("recipes.jsonl", "\n".join(json.dumps(r) for r in records))
+        output = self.run_import(path, "--user", "alice")
+        self.assertIn("Imported 1 recipes and 1 ingredients", output)
+        self.assertIn("7 invalid records skipped", output)
+        self.assertEqual(list(Recipe.objects.values_list("title", flat=True)), ["Fine"])
+
+    def test_imports_csv(self):
+        path = self.write("recipes.csv", (
+            "recipe,title,time_minutes,description,user,ingredient,amount,unit,custom_name\n"
+            "1,Boiled egg,8,Boil it.,alice,egg,1,pc,\n"
+            "2,Scrambled eggs,5,,alice,egg,3,pc,free range eggs\n"
+            "2,,,,,butter,10,g,\n"
+        ))
+        self.run_import(path)
+        scrambled = Recipe.objects.get(title="Scrambled eggs")
+        self.assertEqual(scrambled.ingredients.count(), 2)
+        self.assertEqual(scrambled.ingredients.get(ingredient=self.egg).custom_name, "free range eggs")
+
+    def test_resumes_from_saved_progress(self):
+        lines = [json.dumps({"title": f"Recipe {i}", "time_minutes": i, "ingredients": []}) for i in range(5)]
+        path = self.write("recipes.jsonl", "\n".join(lines))
+        ImportProgress.objects.create(key=f"{os.path.abspath(path)}:0/1", position=3)
+        self.run_import(path, "--user", "alice")
+        self.assertEqual(sorted(Recipe.objects.values_list("title", flat=True)), ["Recipe 3", "Recipe 4"])
+        self.run_import(path, "--user", "alice")
+        self.assertEqual(Recipe.objects.count(), 2)
+
+    def test_shards_split_the_input(self):
+        lines = [json.dumps({"title": f"Recipe {i}", "time_minutes": i}) for i in range(5)]
+        # Records of other shards, and those before the saved position, are never parsed
+        lines[0] = lines[4] = "{not json"
+        path = self.write("recipes.jsonl", "\n".join(lines))
+        output = self.run_import(path, "--user", "alice", "--shard", "1/2")
+        self.assertEqual(sorted(Recipe.objects.values_list("title", flat=True)), ["Recipe 1", "Recipe 3"])
+        self.assertIn("0 invalid records skipped", output)
+        ImportProgress.objects.create(key=f"{os.path.abspath(path)}:0/2", position=1)
+        output = self.run_import(path, "--user", "alice", "--shard", "0/2")
+        self.assertIn("Imported 1 recipes", output)
+        self.assertIn("1 invalid records skipped", output)
+
+    def test_progress_of_another_shard_count_is_rejected(self):
+        lines = [json.dumps({"title": f"Recipe {i}", "time_minutes": i}) for i in range(5)]
+        path = self.write("recipes.jsonl", "\n".join(lines))
+        self.run_import(path, "--user", "alice", "--shard", "0/2")
+        with self.assertRaisesMessage(CommandError, "is for 2 shards"):
+            self.run_import(path, "--user", "alice")
+        self.run_import(path, "--user", "alice", "--shard", "1/2")
+        self.run_import(path, "--user", "alice", "--restart")
+        self.assertEqual(Recipe.objects.count(), 10)
+        self.assertEqual(list(ImportProgress.objects.values_list("key", flat=True)), [f"{os.path.abspath(path)}:0/1"])
+
+    def test_copy_keeps_null_apart_from_text(self):
+        class Cursor:
+            def copy_expert(self, sql, stream):
+                self.sql, self.data = sql, stream.read()
+
+        cursor = Cursor()
+        RecipeImporter.copy(cursor, RecipeIngredient, ["unit", "custom_name", "amount"], [("\\N", None, 1)])
+        self.assertIn("NULL '\\N'", cursor.sql)
+        self.assertEqual(cursor.data, '"\\N",\\N,"1"\n')
+
+
+class ExportRecipesTests(RecipeTestMixin, TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = self.make_user("alice")
+        egg = self.make_ingredient("egg")
+        self.recipes = [self.make_recipe(self.user, f"Recipe {i}", ingredients=[egg] * (i % 3)) for i in range(5)]
+
+    def read(self, content):
+        return [json.loads(line) for line in content.decode().splitlines()]
+
+    def test_streams_ndjson_in_chunks(self):
+        admin = get_user_model().objects.create_superuser("admin", "admin@example.com", "secret-pass-123")
+        self.client.force_authenticate(admin)
+        response = self.client.get("/recipes/export/")
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        with self.assertNumQueries(2):
+            lines = self.read(b"".join(response.streaming_content))
+        self.assertEqual([line["id"] for line in lines], [recipe.id for recipe in self.recipes])
+        self.assertEqual(lines[2]["user"], "alice")
+        self.assertEqual([i["name"] for i in lines[2]["ingredients"]], ["egg", "egg"])
+
+    def test_gzip_and_modified_since(self):
+        admin = get_user_model().objects.create_superuser("admin", "admin@example.com", "secret-pass-123")
+        self.client.force_authenticate(admin)
+        since = timezone.now()
+        Recipe.objects.filter(pk=self.recipes[1].pk).update(modified_at=since)
+        response = self.client.get("/recipes/export/", {"gzip": "1", "modified_since": since.isoformat()})
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        lines = self.read(gzip.decompress(b"".join(response.streaming_content)))
+        self.assertEqual([line["id"] for line in lines], [self.recipes[1].id])
+
+    def test_admin_only(self):
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.client.get("/recipes/export/").status_code, 403)
+
+    @override_settings(DB_STATEMENT_TIMEOUT=5000)
+    def test_stream_runs_with_the_view_budget(self):
+        admin = get_user_model().objects.create_superuser("admin", "admin@example.com", "secret-pass-123")
+        self.client.force_authenticate(admin)
+        response = self.client.get("/recipes/export/")
+        self.assertIsNone(_statement_budget.get())
+        budgets = []
+
+        def record(execute, sql, params, many, context):
+            budgets.append(_statement_budget.get())
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(record):
+            b"".join(response.streaming_content)
+        self.assertEqual([budget.label for budget in budgets], ["RecipeViewSet.export"] * 2)
+        self.assertIsNone(_statement_budget.get())
+
+    def test_command_round_trips_through_import(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "recipes.ndjson.gz")
+            call_command("export_recipes", path, "--chunk-size", "2", stderr=io.StringIO())
+            Recipe.objects.all().delete()
+            with gzip.open(path, "rt") as stream, open(path[:-3], "w") as plain:
+                plain.write(stream.read())
+            call_command("import_recipes", path[:-3], "--format", "jsonl", stdout=io.StringIO())
+        self.assertEqual(Recipe.objects.count(), 5)
+        self.assertEqual(RecipeIngredient.objects.count(), 4)
+
+
+def make_image(name="photo.png", size=(1200, 800), mode="RGBA"):
+    buffer = io.BytesIO()
+    Image.new(mode, size, "orange").save(buffer, "PNG")
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type="image/png")
+
+
+class ImageDerivativesTests(RecipeTestMixin, TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        overrides = override_settings(MEDIA_ROOT=media.name, IMAGE_DERIVATIVES_ASYNC=False, FEED_FANOUT_ASYNC=False)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        cache.clear()
+        self.client = APIClient()
+        self.user = self.make_user()
+
+    def test_generated_on_upload(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            ingredient = Ingredient.objects.create(name="carrot", image=make_image())
+        for size, pixels in [("thumbnail", 200), ("small", 480), ("medium", 960)]:
+            for extension in ["webp", "jpg"]:
+                with default_storage.open(derivative_name(ingredient.image.name, size, extension)) as stream:
+                    self.assertEqual(max(Image.open(stream).size), pixels)
+
+    def test_serializers_return_variant_urls(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            ingredient = Ingredient.objects.create(name="carrot", image=make_image())
+            recipe = self.make_recipe(self.user, "Carrot soup", ingredients=[ingredient])
+        data = self.client.get(f"/recipes/{recipe.id}/").data
+        self.assertIsNone(data["image_variants"])
+        variants = data["ingredients"][0]["image_variants"]
+        self.assertEqual(
+            variants["thumbnail"]["webp"],
+            "http://testserver/media/" + derivative_name(ingredient.image.name, "thumbnail", "webp"),
+        )
+        self.assertEqual(self.client.get(f"/ingredients/{ingredient.id}/").data["image_variants"], variants)
+
+    def test_variants_are_returned_once_generated(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            ingredient = Ingredient.objects.create(name="carrot", image=make_image())
+            recipe = self.make_recipe(self.user, "Carrot soup", ingredients=[ingredient])
+        responses = [self.client.get(url) for url in [f"/ingredients/{ingredient.id}/", f"/recipes/{recipe.id}/"]]
+        self.assertIsNone(responses[0].data["image_variants"])
+        self.assertIsNone(responses[1].data["ingredients"][0]["image_variants"])
+        for callback in callbacks:
+            callback()
+        # The cached fragment and the validators of the responses without variants are dropped
+        for response in responses:
+            response = self.client.get(response.wsgi_request.path, HTTP_IF_NONE_MATCH=response["ETag"])
+            self.assertEqual(response.status_code, 200)
+        self.assertIsNotNone(response.data["ingredients"][0]["image_variants"])
+        self.assertIsNotNone(self.client.get("/recipes/").data["results"][0]["ingredients"][0]["image_variants"])
+
+        # A new image has no variants until they are generated again
+        with self.captureOnCommitCallbacks():
+            ingredient.image = make_image(mode="RGB")
+            ingredient.save()
+        self.assertIsNone(self.client.get(f"/ingredients/{ingredient.id}/").data["image_variants"])
+
+    def test_generated_only_when_the_image_changes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            ingredient = Ingredient.objects.create(name="carrot", image=make_image())
+        thumbnail = derivative_name(ingredient.image.name, "thumbnail", "webp")
+        default_storage.delete(thumbnail)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ingredient.name = "carrots"
+            ingredient.save()
+            Ingredient.objects.get(pk=ingredient.pk).save(update_fields=["name"])
+        self.assertFalse(default_storage.exists(thumbnail))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ingredient.image = make_image(mode="RGB")
+            ingredient.save()
+        self.assertTrue(default_storage.exists(derivative_name(ingredient.image.name, "thumbnail", "webp")))
+
+    def test_images_are_read_from_their_storage(self):
+        location = tempfile.TemporaryDirectory()
+        self.addCleanup(location.cleanup)
+        storage = FileSystemStorage(location=location.name, base_url="/elsewhere/")
+        name = storage.save("carrot.png", make_image())
+        self.assertIsNone(derivative_urls(name, storage, False))
+        self.assertEqual(generate_derivatives(name, storage), 6)
+        self.assertEqual(
+            derivative_urls(name, storage, True)["small"]["jpg"], "/elsewhere/derivatives/carrot.png/small.jpg"
+        )
+        self.assertFalse(default_storage.exists(derivative_name(name, "small", "jpg")))
+
+    def test_backfill_command(self):
+        ingredient = Ingredient.objects.create(name="carrot", image=make_image(mode="RGB"))
+        name = derivative_name(ingredient.image.name, "small", "jpg")
+        self.assertFalse(default_storage.exists(name))
+        out = io.StringIO()
+        call_command("generate_image_derivatives", "--sync", stdout=out)
+        self.assertTrue(default_storage.exists(name))
+        self.assertIn("wrote 6 derivatives", out.getvalue())
+
+
+class MediaBlobTests(RecipeTestMixin, TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        overrides = override_settings(MEDIA_ROOT=media.name, IMAGE_DERIVATIVES_ASYNC=False)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def blob_files(self):
+        return [
+            os.path.join(root, name)
+            for root, _, names in os.walk(os.path.join(default_storage.location, "blobs"))
+            for name in names
+        ]
+
+    def test_identical_uploads_share_one_blob(self):
+        carrot = Ingredient.objects.create(name="carrot", image=make_image("carrot.png"))
+        pumpkin = Ingredient.objects.create(name="pumpkin", image=make_image("pumpkin.png"))
+        self.assertEqual(carrot.image.name, pumpkin.image.name)
+        self.assertTrue(carrot.image.name.startswith("blobs/"))
+        self.assertEqual(len(self.blob_files()), 1)
+        self.assertEqual(MediaBlob.objects.get().references, 2)
+
+        pumpkin.image = make_image("pumpkin.png", mode="RGB")
+        pumpkin.save()
+        self.assertNotEqual(carrot.image.name, pumpkin.image.name)
+        self.assertEqual(MediaBlob.objects.get(name=carrot.image.name).references, 1)
+        self.assertEqual(MediaBlob.objects.get(name=pumpkin.image.name).references, 1)
+
+    def test_gc_deletes_unreferenced_blobs(self):
+        carrot = Ingredient.objects.create(name="carrot", image=make_image())
+        pumpkin = Ingredient.objects.create(name="pumpkin", image=make_image())
+        name = carrot.image.name
+
+        carrot.delete()
+        call_command("gc_media_blobs", "--grace-hours", "0", stdout=io.StringIO())
+        self.assertTrue(default_storage.exists(name))
+
+        pumpkin.delete()
+        MediaBlob.objects.update(references=5)  # a drifted count is repaired first
+        out = io.StringIO()
+        call_command("gc_media_blobs", "--grace-hours", "0", stdout=out)
+        self.assertIn("Deleted 1 unreferenced blobs", out.getvalue())
+        self.assertFalse(default_storage.exists(name))
+        self.assertFalse(MediaBlob.objects.exists())
+
+    def test_gc_keeps_recent_blobs(self):
+        Ingredient.objects.create(name="carrot", image=make_image()).delete()
+        call_command("gc_media_blobs", stdout=io.StringIO())
+        self.assertEqual(MediaBlob.objects.count(), 1)
+        # Uploading the file again restarts its grace period
+        MediaBlob.objects.update(modified_at=timezone.now() - timedelta(days=2))
+        name = content_addressed_storage.save("carrot.png", make_image())
+        call_command("gc_media_blobs", stdout=io.StringIO())
+        self.assertEqual(list(MediaBlob.objects.values_list("name", flat=True)), [name])
+
+    def test_migrate_existing_files(self):
+        first = default_storage.save("images/ingredients/a.png", make_image())
+        second = default_storage.save("images/ingredients/b.png", make_image())
+        carrot = Ingredient.objects.create(name="carrot", image="placeholder.png")
+        pumpkin = Ingredient.objects.create(name="pumpkin", image="placeholder.png")
+        Ingredient.objects.filter(pk=carrot.pk).update(image=first)
+        Ingredient.objects.filter(pk=pumpkin.pk).update(image=second)
+
+        out = io.StringIO()
+        call_command("migrate_media_to_blobs", "--delete-originals", stdout=out)
+        self.assertIn("Moved 2 files into 1 blobs, updated 2 rows", out.getvalue())
+        carrot.refresh_from_db()
+        pumpkin.refresh_from_db()
+        self.assertEqual(carrot.image.name, pumpkin.image.name)
+        self.assertEqual(MediaBlob.objects.get().references, 2)
+        self.assertFalse(default_storage.exists(first))
+        self.assertTrue(default_storage.exists(derivative_name(carrot.image.name, "thumbnail", "webp")))
+
+
+class FastSerializerTests(RecipeTestMixin, TestCase):
+    def setUp(self):
+        self.user = self.make_user()
+        carrot = Ingredient.objects.create(name="carrot", image="images/ingredients/crème brûlée.jpg")
+        pumpkin = self.make_ingredient("pumpkin")
+        self.soup = self.make_recipe(self.user, "Soup", "Hot.", [carrot, pumpkin])
+        self.soup.image = "images/recipes/soup (1).png"
+        self.soup.save()
+        RecipeIngredient.objects.create(
+            recipe=self.soup, ingredient=carrot, amount=Decimal("2.5"), unit=None, custom_name="baby carrot",
+            custom_image="images/ingredients/baby.jpg",
+        )
+        # Rows written with COPY by import_recipes have NULL rather than "" images
+        RecipeIngredient.objects.create(recipe=self.soup, ingredient=pumpkin, amount=Decimal("0.333"))
+        RecipeIngredient.objects.filter(custom_image="").update(custom_image=None)
+        self.make_recipe(self.user, "Empty")
+        self.request = APIRequestFactory().get("/recipes/")
+
+    def render(self, data):
+        return JSONRenderer().render(data)
+
+    def test_output_is_byte_identical(self):
+        context = {"request": Request(self.request)}
+        recipes = Recipe.objects.prefetch_related(
+            Prefetch("ingredients", RecipeIngredient.objects.select_related("ingredient").order_by("pk"))
+        )
+        slow = self.render(RecipeSerializer(recipes, many=True, context=context).data)
+        fast = self.render(FastRecipeSerializer(context=context).serialize(list(Recipe.objects.all())))
+        self.assertEqual(fast, slow)
+        self.assertIn(b"cr%C3%A8me%20br%C3%BBl%C3%A9e.jpg", fast)
+
+    def test_values_rows(self):
+        context = {"request": Request(self.request)}
+        serializer = FastRecipeSerializer(context=context)
+        self.assertEqual(
+            self.render(serializer.serialize_queryset(Recipe.objects.all())),
+            self.render(FastRecipeSerializer(context=context).serialize(list(Recipe.objects.all()))),
+        )
+
+    def test_list_endpoint_uses_fast_path(self):
+        client = APIClient()
+        with override_settings(FAST_READ_SERIALIZERS=False):
+            slow = client.get("/recipes/").content
+        cache.clear()
+        # page count, recipes and one query for all their ingredients
+        with self.assertNumQueries(3):
+            fast = client.get("/recipes/").content
+        self.assertEqual(fast, slow)
+
+    def test_benchmark_command(self):
+        out = io.StringIO()
+        call_command("benchmark_serializers", "--page-sizes", "5", "--repeat", "2", stdout=out)
+        self.assertIn("identical", out.getvalue())
+
+
+class RecipeCounterTests(RecipeTestMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = self.make_user()
+        self.egg, self.milk = self.make_ingredient("egg"), self.make_ingredient("milk")
+        self.cake = self.make_recipe(self.user, "Cake", ingredients=[self.egg, self.milk])
+        self.omelette = self.make_recipe(self.user, "Omelette", ingredients=[self.egg])
+
+    def counters(self, recipe):
+        recipe.refresh_from_db()
+        return recipe.ingredient_count, recipe.comment_count, recipe.latest_comment_at
+
+    def test_signals_maintain_counters(self):
+        self.assertEqual(self.counters(self.cake), (2, 0, None))
+        first = Comment.objects.create(recipe=self.cake, user=self.user, comment="Nice")
+        second = Comment.objects.create(recipe=self.cake, user=self.user, comment="Great")
+        self.assertEqual(self.counters(self.cake), (2, 2, second.created_at))
+
+        second.delete()
+        self.assertEqual(self.counters(self.cake), (2, 1, first.created_at))
+        first.delete()
+        self.cake.ingredients.first().delete()
+        self.assertEqual(self.counters(self.cake), (1, 0, None))
+
+    def test_comments_change_the_representation(self):
+        self.assertEqual(self.client.get(f"/recipes/{self.cake.id}/").data["comment_count"], 0)
+        Comment.objects.create(recipe=self.cake, user=self.user, comment="Nice")
+        data = self.client.get(f"/recipes/{self.cake.id}/").data
+        self.assertEqual((data["ingredient_count"], data["comment_count"]), (2, 1))
+        self.assertIsNotNone(data["latest_comment_at"])
+
+    def test_filter_and_order(self):
+        Comment.objects.create(recipe=self.omelette, user=self.user, comment="Nice")
+
+        def ids(params):
+            return [recipe["id"] for recipe in self.client.get("/recipes/", params).data["results"]]
+
+        self.assertEqual(ids({"ingredient_count__gte": 2}), [self.cake.id])
+        self.assertEqual(ids({"comment_count": 1}), [self.omelette.id])
+        self.assertEqual(ids({"latest_comment_at__isnull": "true"}), [self.cake.id])
+        self.assertEqual(ids({"ordering": "-ingredient_count"}), [self.cake.id, self.omelette.id])
+        self.assertEqual(ids({"ordering": "-comment_count", "pagination": "cursor"}), [self.omelette.id, self.cake.id])
+
+    def test_bulk_create_sets_ingredient_count(self):
+        self.client.force_authenticate(self.user)
+        response = self.client.post("/recipes/bulk/", [
+            {"title": "Toast", "time_minutes": 5, "description": "Quick.",
+             "ingredients": [{"ingredient": self.egg.id, "amount": "1"}, {"ingredient": self.milk.id, "amount": "2"}]},
+        ], format="json")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Recipe.objects.get(pk=response.data[0]["id"]).ingredient_count, 2)
+
+    def test_reconcile_command(self):
+        comment = Comment.objects.create(recipe=self.cake, user=self.user, comment="Nice")
+        Recipe.objects.filter(pk=self.cake.pk).update(ingredient_count=7, comment_count=0, latest_comment_at=None)
+
+        out = io.StringIO()
+        call_command("reconcile_recipe_counters", "--dry-run", stdout=out)
+        self.assertIn("Found 1 with drifted counters", out.getvalue())
+        self.assertEqual(self.counters(self.cake)[0], 7)
+
+        out = io.StringIO()
+        call_command("reconcile_recipe_counters", "--batch-size", "1", stdout=out)
+        self.assertIn("Checked 2 recipes. Repaired 1", out.getvalue())
+        self.assertEqual(self.counters(self.cake), (2, 1, comment.created_at))
+
+
+ASYNC_URLCONF = ModuleType("async_urls")
+ASYNC_URLCONF.urlpatterns = async_read_urlpatterns(recipe_urls.api_urlpatterns)
+
+
+class AsyncReadViewTests(RecipeTestMixin, TestCase):
+    def setUp(self):
+        backend = get_search_backend()
+        if isinstance(backend, PythonSearchBackend):
+            backend.reset()
+        self.user = self.make_user()
+        self.egg, self.milk = self.make_ingredient("egg"), self.make_ingredient("milk")
+        self.cake = self.make_recipe(self.user, "Cake", "Sweet.", [self.egg, self.milk], time_minutes=60)
+        self.omelette = self.make_recipe(self.user, "Omelette", "Eggs.", [self.egg], time_minutes=5)
+        Comment.objects.create(recipe=self.cake, user=self.user, comment="Nice")
+        self.token = str(AccessToken.for_user(self.user))
+
+    def async_get(self, path, params=None, headers=None):
+        async def get():
+            with override_settings(ROOT_URLCONF=ASYNC_URLCONF):
+                return await self.async_client.get(path, params, headers=headers)
+        return async_to_sync(get)()
+
+    def assertSameResponse(self, path, params=None, status=200, headers=None):
+        self.assertTrue(asyncio.iscoroutinefunction(resolve(path, urlconf=ASYNC_URLCONF).func))
+        cache.clear()
+        sync = self.client.get(path, params, headers=headers)
+        cache.clear()
+        response = self.async_get(path, params, headers)
+        self.assertEqual(response.status_code, status)
+        self.assertEqual(sync.status_code, status)
+        self.assertEqual(response.content, sync.content)
+        self.assertEqual(response.get("ETag"), sync.get("ETag"))
+        return response
+
+    def test_recipes(self):
+        self.assertSameResponse("/recipes/")
+        self.assertSameResponse("/recipes/", {"time_minutes__lte": 10, "ordering": "-created_at"})
+        self.assertSameResponse("/recipes/", {"q": "eggs"})
+        self.assertSameResponse("/recipes/", {"pagination": "cursor", "page_size": 1})
+        self.assertSameResponse("/recipes/", {"page": 9}, status=404)
+        self.assertSameResponse(f"/recipes/{self.cake.id}/")
+        self.assertSameResponse("/recipes/0/", status=404)
+
+    def test_ingredients_and_comments(self):
+        self.assertSameResponse("/ingredients/", {"page_size": 1})
+        self.assertSameResponse(f"/ingredients/{self.egg.id}/")
+        self.assertSameResponse(f"/recipes/{self.cake.id}/comments/")
+        comment = self.cake.comments.get()
+        self.assertSameResponse(f"/recipes/{self.cake.id}/comments/{comment.id}/")
+
+    def test_authentication_and_conditional_get(self):
+        auth = {"Authorization": f"JWT {self.token}"}
+        response = self.assertSameResponse("/recipes/", headers=auth)
+        self.assertNotEqual(response["ETag"], self.async_get("/recipes/")["ETag"])
+        self.assertSameResponse("/recipes/", headers={"Authorization": "JWT invalid"}, status=401)
+        not_modified = self.async_get("/recipes/", headers={**auth, "If-None-Match": response["ETag"]})
+        self.assertEqual(not_modified.status_code, 304)
+
+    def test_writes_use_the_sync_view(self):
+        async def post():
+            with override_settings(ROOT_URLCONF=ASYNC_URLCONF):
+                return await self.async_client.post(
+                    f"/recipes/{self.cake.id}/comments/", {"comment": "Again"},
+                    headers={"Authorization": f"JWT {self.token}"},
+                )
+        self.assertEqual(async_to_sync(post)().status_code, 201)
+        self.assertEqual(self.cake.comments.count(), 2)
+
+    def test_render_keeps_headers_and_cookies(self):
+        response = Response({"ok": True}, headers={"X-Test": "1"})
+        response.accepted_renderer = JSONRenderer()
+        response.accepted_media_type = "application/json"
+        response.renderer_context = {}
+        response.set_cookie("pinned", "1", max_age=5)
+        rendered = AsyncReadMixin.render(response)
+        self.assertEqual(rendered["X-Test"], "1")
+        self.assertEqual(rendered.cookies["pinned"].value, "1")
+        self.assertEqual(rendered.cookies["pinned"]["max-age"], 5)
+
+
+class RecordingRouter(ReplicaRouter):
+    """
+    ReplicaRouter that records where it sent each read.
+    """
+
+    def __init__(self):
+        self.reads = []
+
+    def db_for_read(self, model, **hints):
+        alias = super().db_for_read(model, **hints)
+        self.reads.append(alias)
+        return alias
+
+
+class FixedLagMonitor(ReplicaLagMonitor):
+    def __init__(self, lags):
+        super().__init__()
+        self.lags = lags
+
+    def measure(self, alias):
+        return self.lags[alias]
+
+
+class ReplicaRoutingTests(RecipeTestMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = self.make_user()
+        self.cake = self.make_recipe(self.user, "Cake", "Sweet.", [self.make_ingredient("egg")])
+        self.auth = {"Authorization": f"JWT {AccessToken.for_user(self.user)}"}
+        # "default" stands in for a replica, so that the reads still find the test data
+        self.router = RecordingRouter()
+        self.settings = override_settings(DATABASE_ROUTERS=[self.router], DATABASE_REPLICAS=["default"])
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+
+    def get_reads(self, path, **kwargs):
+        self.router.reads.clear()
+        response = self.client.get(path, **kwargs)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(self.router.reads)
+        self.assertFalse(_replica_reads.get())
+        return set(self.router.reads)
+
+    def test_safe_requests_read_from_the_replicas(self):
+        self.assertEqual(self.get_reads("/recipes/"), {"default"})
+        # The user is authenticated against the primary, before replica reads are switched on
+        self.assertEqual(self.get_reads(f"/recipes/{self.cake.id}/", headers=self.auth), {None, "default"})
+        self.assertEqual(self.get_reads("/ingredients/"), {"default"})
+        self.assertIsNone(self.router.db_for_read(Recipe))
+
+    def test_async_views_read_from_the_replicas(self):
+        self.router.reads.clear()
+
+        async def get():
+            with override_settings(ROOT_URLCONF=ASYNC_URLCONF):
+                return await self.async_client.get("/recipes/")
+        self.assertEqual(async_to_sync(get)().status_code, 200)
+        self.assertEqual(set(self.router.reads), {"default"})
+
+    def test_writers_read_from_the_primary(self):
+        response = self.client.post(
+            f"/recipes/{self.cake.id}/comments/", {"comment": "Nice"}, headers=self.auth
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(cache.get(pin_key(self.user)))
+        self.assertEqual(self.get_reads(f"/recipes/{self.cake.id}/comments/", headers=self.auth), {None})
+        # Only the writer is pinned
+        self.assertEqual(self.get_reads(f"/recipes/{self.cake.id}/comments/"), {"default"})
+
+    def test_lagging_replicas_are_skipped(self):
+        router = ReplicaRouter()
+        router.monitor = FixedLagMonitor({"replica1": 0.5, "replica2": 30})
+        token = _replica_reads.set(True)
+        try:
+            with override_settings(DATABASE_REPLICAS=["replica1", "replica2"]):
+                self.assertEqual({router.db_for_read(Recipe) for _ in range(20)}, {"replica1"})
+            with override_settings(DATABASE_REPLICAS=["replica2"]):
+                self.assertEqual(router.db_for_read(Recipe), "default")
+        finally:
+            _replica_reads.reset(token)
+        self.assertEqual(router.db_for_write(Recipe), "default")
+
+    def test_unreachable_replicas_are_skipped(self):
+        monitor = ReplicaLagMonitor()
+        self.assertEqual(monitor.lag("missing"), float("inf"))
+        self.assertEqual(monitor.healthy(["missing", "default"]), ["default"])
+
+
+class SlowIngredientViewSet(IngredientViewSet):
+    statement_timeouts = {"list": 50}
+
+    def list(self, request, *args, **kwargs):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 100000000) "
+                "SELECT count(*) FROM n"
+            )
+            return Response(cursor.fetchone())
+
+
+class DatabaseBudgetTests(RecipeTestMixin, TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        db_stats.reset()
+        self.make_ingredient("egg")
+
+    def test_slow_statement_is_a_503(self):
+        view = SlowIngredientViewSet.as_view({"get": "list"})
+        response = view(APIRequestFactory().get("/ingredients/"))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.data["detail"].code, "statement_timeout")
+        self.assertEqual(db_stats.snapshot()["statement_timeouts"], {"SlowIngredientViewSet.list": 1})
+        # The guard is gone once the view is done
+        self.assertEqual(Ingredient.objects.count(), 1)
+
+    @override_settings(DB_STATEMENT_TIMEOUT=4000)
+    def test_timeouts_per_viewset_and_action(self):
+        def timeout(viewset, action):
+            view = viewset()
+            view.action = action
+            return view.get_statement_timeout()
+
+        self.assertEqual(timeout(RecipeViewSet, "list"), 4000)
+        self.assertEqual(timeout(RecipeViewSet, "retrieve"), 1000)
+        self.assertEqual(timeout(IngredientViewSet, "list"), 2000)
+        self.assertEqual(self.client.get("/ingredients/").status_code, 200)
+
+    def test_connection_checkouts(self):
+        self.client.get("/ingredients/")
+        self.client.get("/recipes/")
+        # A request without queries doesn't check a connection out
+        with self.assertNumQueries(0):
+            self.client.get("/stats/database/")
+        stats = db_stats.snapshot()["connections"]["default"]
+        self.assertEqual(stats["checkouts"], 2)
+        self.assertEqual(stats["reused"], 2)
+        self.assertEqual(stats["in_use"], 0)
+
+    def test_stats_are_for_staff(self):
+        self.assertEqual(self.client.get("/stats/database/").status_code, 401)
+        staff = self.make_user("staff")
+        staff.is_staff = True
+        staff.save()
+        self.client.force_authenticate(staff)
+        self.client.get("/ingredients/")
+        response = self.client.get("/stats/database/")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("default", response.json()["connections"])
+
+
+class MetricsTests(RecipeTestMixin, TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        metrics_registry.reset()
+        self.staff = self.make_user("staff")
+        self.staff.is_staff = True
+        self.staff.save()
+        egg = self.make_ingredient("egg")
+        self.recipe = self.make_recipe(self.make_user(), "Omelette", ingredients=[egg])
+
+    def scrape(self):
+        self.client.force_authenticate(self.staff)
+        response = self.client.get("/metrics")
+        self.client.force_authenticate(None)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain; version=0.0.4"))
+        return response.content.decode()
+
+    def test_requests_are_recorded_per_route(self):
+        self.client.get("/recipes/")
+        self.client.get("/recipes/")
+        self.client.get(f"/recipes/{self.recipe.pk}/comments/")
+        self.client.get("/no-such-page/")
+        text = self.scrape()
+        self.assertIn(
+            'dishcovery_http_request_duration_seconds_count{route="recipes-list",method="GET",status="200"} 2', text
+        )
+        self.assertIn(
+            'dishcovery_http_request_duration_seconds_bucket{route="recipes-list",method="GET",status="200",le="+Inf"} 2',
+            text,
+        )
+        self.assertIn('dishcovery_db_queries_per_request_count{route="recipe-comments-list",method="GET"} 1', text)
+        self.assertIn('route="<unmatched>",method="GET",status="404"', text)
+        self.assertIn('dishcovery_db_connection_checkouts_total{alias="default"}', text)
+
+        queries = metrics_registry.values["db_queries_per_request"][("recipes-list", "GET")]
+        self.assertGreater(queries[-1], 0)
+        serialization = metrics_registry.values["serialization_duration_seconds"][("recipes-list", "GET")]
+        self.assertGreater(serialization[-1], 0)
+        size = metrics_registry.values["http_response_size_bytes"][("recipes-list", "GET")]
+        self.assertGreater(size[-1], 0)
+
+    def test_metrics_are_for_staff_or_the_scraper_token(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 401)
+        with override_settings(METRICS_TOKEN="scrape-me"):
+            self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer wrong").status_code, 401)
+            self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer scrape-me").status_code, 200)
+
+    def test_processes_are_added_up(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        # Another worker's metrics, as it would have written them
+        other = MetricsRegistry()
+        other.observe("http_request_duration_seconds", ("recipes-list", "GET", "200"), 0.02)
+        with open(os.path.join(directory.name, "metrics-1.json"), "w") as stream:
+            json.dump(other.snapshot(), stream)
+
+        with override_settings(METRICS_DIR=directory.name):
+            self.client.get("/recipes/")
+            self.assertIn(f"metrics-{os.getpid()}.json", os.listdir(directory.name))
+            text = self.scrape()
+        self.assertIn(
+            'dishcovery_http_request_duration_seconds_count{route="recipes-list",method="GET",status="200"} 2', text
+        )
+
+
+class RequestProfilingTests(RecipeTestMixin, TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.staff = self.make_user("staff")
+        self.staff.is_staff = True
+        self.staff.save()
+        egg = self.make_ingredient("egg")
+        self.make_recipe(self.make_user(), "Omelette", ingredients=[egg])
+
+    def authorization(self, user):
+        return {"HTTP_AUTHORIZATION": f"JWT {AccessToken.for_user(user)}"}
+
+    def test_staff_request_is_profiled(self):
+        response = self.client.get("/recipes/", HTTP_X_PROFILE="1", **self.authorization(self.staff))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["count"], 1)
+        profile = RequestProfile.objects.get(pk=response["X-Profile-Id"])
+        self.assertEqual((profile.user, profile.method, profile.route), (self.staff, "GET", "recipes-list"))
+        self.assertEqual(profile.query_count, len(profile.queries))
+        self.assertTrue(any("recipes_recipe" in query["sql"] for query in profile.queries))
+        self.assertIn("cumulative", profile.stats)
+        self.assertTrue(bytes(profile.data))
+
+    def test_text_report(self):
+        response = self.client.get("/ingredients/?profile=text", **self.authorization(self.staff))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+        text = response.content.decode()
+        self.assertTrue(text.startswith("GET /ingredients/?profile=text -> 200"))
+        self.assertIn("recipes_ingredient", text)
+
+    def test_others_are_not_profiled(self):
+        cook = self.make_user("other-cook")
+        for kwargs in ({}, self.authorization(cook), {"HTTP_AUTHORIZATION": "JWT not-a-token"}):
+            response = self.client.get("/recipes/", HTTP_X_PROFILE="1", **kwargs)
+            self.assertNotIn("X-Profile-Id", response)
+        self.assertFalse(RequestProfile.objects.exists())
+
+    def test_admin_lists_and_downloads_profiles(self):
+        response = self.client.get("/recipes/", HTTP_X_PROFILE="1", **self.authorization(self.staff))
+        profile_id = response["X-Profile-Id"]
+        self.staff.is_superuser = True
+        self.staff.save()
+        self.client.force_login(self.staff)
+        self.assertContains(self.client.get("/admin/recipes/requestprofile/"), "/recipes/")
+        self.assertContains(self.client.get(f"/admin/recipes/requestprofile/{profile_id}/change/"), "Download .prof")
+        download = self.client.get(f"/admin/recipes/requestprofile/{profile_id}/download/")
+        self.assertEqual(download.status_code, 200)
+        self.assertEqual(download.content, bytes(RequestProfile.objects.get(pk=profile_id).data))
+
+
+class BenchmarkTests(TestCase):
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        overrides = override_settings(MEDIA_ROOT=media.name, IMAGE_DERIVATIVES_ASYNC=False)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def test_generated_data_is_reproducible(self):
+        records = list(DataGenerator(50, seed=1).records())
+        self.assertEqual(records, list(DataGenerator(50, seed=1).records()))
+        self.assertNotEqual(records, list(DataGenerator(50, seed=2).records()))
+        self.assertTrue(all(1 <= len(record["ingredients"]) <= 40 for record in records))
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual([percentile(values, p) for p in (50, 95, 99, 100)], [50, 95, 99, 100])
+        self.assertEqual(percentile([7], 99), 7)
+
+    def test_scenarios_run_in_process(self):
+        counts = DataGenerator(40, seed=3, batch_size=25, stdout=io.StringIO()).run()
+        self.assertEqual(counts["recipes"], 40)
+        self.assertEqual(Recipe.objects.filter(comment_count__gt=0).count(), Comment.objects.values("recipe").distinct().count())
+        # A second run resumes after the recipes already written
+        self.assertEqual(DataGenerator(40, seed=3, stdout=io.StringIO()).run()["recipes"], 0)
+
+        runner = BenchmarkRunner(InProcessClient, BenchmarkContext(seed=3), requests=2, warmup=0)
+        results = runner.run(get_scenarios())
+        self.assertEqual(set(results["scenarios"]), {scenario.name for scenario in SCENARIOS if not scenario.heavy})
+        errors = {name: result["status_codes"] for name, result in results["scenarios"].items() if result["errors"]}
+        self.assertEqual(errors, {})
+        self.assertEqual(results["scenarios"]["recipes-retrieve"]["requests"], 2)
+        self.assertGreater(results["scenarios"]["recipes-list"]["queries_per_request"]["mean"], 0)
@@ -1,12 +1,27 @@
+from django.conf import settings
+from django.urls import path
 from rest_framework_nested import routers
 from . import views
+from .async_views import async_read_urlpatterns
 
 router = routers.DefaultRouter()
 router.register('recipes', views.RecipeViewSet, basename='recipes')
 router.register('ingredients', views.IngredientViewSet, basename='ingredients')
 router.register('profiles', views.ProfileViewSet, basename='profiles')
+router.register('shopping-list', views.ShoppingListViewSet, basename='shopping-list')
+router.register('following', views.FollowViewSet, basename='following')
+router.register('feed', views.FeedViewSet, basename='feed')
 
 recipe_router = routers.NestedDefaultRouter(router, 'recipes', lookup='recipe')
 recipe_router.register('comments', views.CommentViewSet, basename='recipe-comments')
 
-urlpatterns = router.urls + recipe_router.urls
\ No newline at end of file
+api_urlpatterns = router.urls + recipe_router.urls + [
+    path('stats/database/', views.DatabaseStatsView.as_view(), name='database-stats'),
+    path('metrics', views.MetricsView.as_view(), name='metrics'),
+]
+
+# Under ASGI the list and retrieve actions run as native async views
+if settings.ASYNC_READ_VIEWS:
+    urlpatterns = async_read_urlpatterns(api_urlpatterns)
+else:
+    urlpatterns = api_urlpatterns
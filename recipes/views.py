@@ -1,27 +1,90 @@
+from collections import defaultdict
+from decimal import Decimal
+
+from asgiref.sync import sync_to_async
+from django.db import IntegrityError, transaction
+from django.db.models import Prefetch, prefetch_related_objects
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import render
+from django.utils.dateparse import parse_datetime
+from rest_framework import mixins, status
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
-from rest_framework.viewsets import ModelViewSet
+from rest_framework.views import APIView
+from rest_framework.viewsets import GenericViewSet, ModelViewSet, ViewSet
 from rest_framework.permissions import IsAuthenticated, IsAdminUser
-from rest_framework.filters import SearchFilter, OrderingFilter
+from rest_framework.filters import OrderingFilter
 from rest_framework.decorators import action
 from django_filters.rest_framework import DjangoFilterBackend
 
-from .models import Profile, Recipe, Ingredient, Comment
-from .serializers import CommentSerializer, ProfileSerializer, RecipeCreateSerializer, RecipeSerializer, IngredientSerializer
-from .permissions import IsAuthenticatedOrReadOnly, IsOwner
-from .filters import RecipeFilter
-from .pagination import DefaultPagination
+from .async_views import AsyncReadMixin
+from .autocomplete import autocomplete_index
+from .cache import recipe_cache
+from .conditional import ConditionalGetMixin
+from .db import StatementBudgetMixin, db_stats
+from .export import iter_gzip, iter_in_context, iter_ndjson
+from .fast_serializers import FastRecipeSerializer, fast_serializers_enabled
+from .metrics import MetricsMixin, registry, serialization_timer
+from .feed import home_timeline
+from .models import Follow, Profile, Recipe, Ingredient, RecipeIngredient, Comment
+from .serializers import AutocompleteQuerySerializer, CommentSerializer, FollowSerializer, PantryMatchSerializer, RecipeBulkCreateSerializer, ProfileSerializer, RecipeCreateSerializer, RecipeSerializer, IngredientSerializer, ShoppingListQuerySerializer, SimilarRecipesQuerySerializer
+from .permissions import IsAdminOrMetricsScraper, IsAuthenticatedOrReadOnly, IsOwner
+from .filters import RecipeFilter, RecipeSearchFilter
+from .pagination import DefaultPagination, OptInKeysetPagination, TimelinePagination
+from .pantry import pantry_index
+from .replicas import ReplicaReadMixin
+from .shopping import shopping_list
+from .similar import similar_index
+
+
+class RecipeFragmentsMixin:
+    """
+    Serializes the recipes of a viewset; the viewset's ingredient_prefetch is applied to the
+    recipes that miss the fragment cache.
+    """
+
+    def serialize_recipes(self, recipes):
+        """
+        Serializes recipes with RecipeSerializer (or its fast read-only equivalent), reusing cached
+        fragments where possible.
+        """
+        with serialization_timer():
+            return recipe_cache.get_or_build(recipes, self.build_recipes, self.request.build_absolute_uri("/"))
+
+    def build_recipes(self, recipes):
+        if fast_serializers_enabled():
+            return FastRecipeSerializer(context=self.get_serializer_context()).serialize(recipes)
+        prefetch_related_objects(recipes, self.ingredient_prefetch)
+        return RecipeSerializer(recipes, many=True, context=self.get_serializer_context()).data
+
+    async def aserialize(self, recipes):
+        with serialization_timer():
+            return await recipe_cache.aget_or_build(recipes, self.abuild_recipes, self.request.build_absolute_uri("/"))
+
+    async def abuild_recipes(self, recipes):
+        if fast_serializers_enabled():
+            return await FastRecipeSerializer(context=self.get_serializer_context()).aserialize(recipes)
+        return await sync_to_async(self.build_recipes)(recipes)
 
 
-class RecipeViewSet(ModelViewSet):
+class RecipeViewSet(RecipeFragmentsMixin, MetricsMixin, StatementBudgetMixin, ReplicaReadMixin, AsyncReadMixin, ConditionalGetMixin, ModelViewSet):
     # prefetch_related() is used to reduce the number of queries made to the database.
-    queryset = Recipe.objects.prefetch_related('ingredients').all()
+    # The ingredient rows are fetched together with their Ingredient in a single joined query,
+    # because RecipeIngredientSimpleSerializer reads the ingredient's name and image.
+    ingredient_prefetch = Prefetch(
+        'ingredients', queryset=RecipeIngredient.objects.select_related('ingredient').order_by('pk')
+    )
+    # The search vector is only used inside the database, so it is never loaded.
+    queryset = Recipe.objects.defer('search_vector').prefetch_related(ingredient_prefetch).all()
     serializer_class = RecipeSerializer
-    filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
+    # RecipeSearchFilter ranks ?q= matches; OrderingFilter only reorders when ?ordering= is given.
+    filter_backends = [DjangoFilterBackend, RecipeSearchFilter, OrderingFilter]
     filterset_class = RecipeFilter
-    search_fields = ["title", "description"]
-    ordering_fields = ["created_at", "time_minutes"]
+    ordering_fields = ["created_at", "time_minutes", "ingredient_count", "comment_count", "latest_comment_at"]
     pagination_class = DefaultPagination
+    bulk_max_length = 1000
+    # Milliseconds per statement; the other actions get DB_STATEMENT_TIMEOUT
+    statement_timeouts = {"retrieve": 1000, "bulk": 30 * 1000}
 
     def get_permissions(self):
         # The permissions are determined by the action being performed.
@@ -32,7 +95,10 @@ class RecipeViewSet(ModelViewSet):
             case "update" | "partial_update" | "destroy":
                 # Only the recipe's owner or an admin can update or delete a recipe.
                 permission_classes = [IsOwner]
-            case "retrieve" | "list":
+            case "export":
+                # Only admins can export the whole catalog.
+                permission_classes = [IsAdminUser]
+            case "retrieve" | "list" | "pantry_match" | "similar":
                 # Anyone can view a recipe.
                 permission_classes = []
             case _:
@@ -50,25 +116,159 @@ class RecipeViewSet(ModelViewSet):
         
         return serializer_class
 
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action in ("list", "retrieve", "pantry_match", "similar"):
+            # These actions read from the fragment cache; ingredients are only prefetched for misses.
+            queryset = queryset.prefetch_related(None)
+        return queryset
+
+    def serialize(self, recipes):
+        return self.serialize_recipes(recipes)
+
+    @action(detail=False, methods=["GET", "POST"], url_path="pantry-match")
+    def pantry_match(self, request):
+        """
+        Ranks recipes by how well the given ingredients cover them: fully cookable recipes first,
+        then by the fewest missing ingredients. Each recipe gets an extra "missing_count" field.
+
+        Accepts ?ingredients=1,2,3&max_missing=2 or the same fields as a JSON body.
+        """
+        if request.method == "GET":
+            data = {
+                "ingredients": [
+                    value
+                    for param in request.query_params.getlist("ingredients")
+                    for value in param.split(",")
+                    if value
+                ],
+            }
+            if "max_missing" in request.query_params:
+                data["max_missing"] = request.query_params["max_missing"]
+        else:
+            data = request.data
+        query = PantryMatchSerializer(data=data)
+        query.is_valid(raise_exception=True)
+
+        matches = pantry_index.match(
+            query.validated_data["ingredients"],
+            max_missing=query.validated_data.get("max_missing"),
+        )
+        page = self.paginate_queryset(matches)
+        recipes = self.get_queryset().in_bulk([recipe_id for recipe_id, _ in page])
+        found = [(recipes[recipe_id], missing) for recipe_id, missing in page if recipe_id in recipes]
+        fragments = self.serialize_recipes([recipe for recipe, _ in found])
+        results = [
+            {**fragment, "missing_count": missing}
+            for fragment, (_, missing) in zip(fragments, found)
+        ]
+        return self.get_paginated_response(results)
+
+    @action(detail=True, methods=["GET"])
+    def similar(self, request, pk=None):
+        """
+        Lists the recipes with the most ingredients in common with this one, from the MinHash
+        index of recipes.similar. Each recipe gets an extra "similarity" field: an estimate of
+        the Jaccard similarity of the two ingredient sets.
+
+        Accepts ?limit=10.
+        """
+        query = SimilarRecipesQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        recipe = self.get_object()
+        matches = similar_index.similar(recipe.pk, limit=query.validated_data["limit"])
+        recipes = self.get_queryset().in_bulk([recipe_id for recipe_id, _ in matches])
+        # Recipes deleted in another process may still be in this one's index
+        found = [(recipes[recipe_id], similarity) for recipe_id, similarity in matches if recipe_id in recipes]
+        fragments = self.serialize_recipes([recipe for recipe, _ in found])
+        return Response([
+            {**fragment, "similarity": round(similarity, 3)}
+            for fragment, (_, similarity) in zip(fragments, found)
+        ])
+
+    @action(detail=False, methods=["POST"])
+    def bulk(self, request):
+        """
+        Creates a batch of recipes in one transaction.
+
+        Accepts a JSON list of recipes with their ingredients. Errors are reported per item, in
+        order, and nothing is created unless every item is valid.
+        """
+        serializer = RecipeBulkCreateSerializer(
+            data=request.data,
+            many=True,
+            max_length=self.bulk_max_length,
+            context=self.get_serializer_context(),
+        )
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    @action(detail=False, methods=["GET"])
+    def export(self, request):
+        """
+        Streams the whole catalog as NDJSON, one recipe with its ingredients per line.
+
+        Accepts ?modified_since=<ISO 8601 datetime> to export only recent changes. The stream is
+        gzip-compressed when the client accepts it or asks for ?gzip=1.
+        """
+        modified_since = request.query_params.get("modified_since")
+        if modified_since:
+            modified_since = parse_datetime(modified_since)
+            if modified_since is None:
+                raise ValidationError({"modified_since": "Enter a valid ISO 8601 date and time."})
+
+        # The stream is read after dispatch() has reset the statement budget and replica routing
+        stream = iter_in_context(iter_ndjson(modified_since or None))
+        response = StreamingHttpResponse(content_type="application/x-ndjson")
+        if request.query_params.get("gzip") == "1" or "gzip" in request.headers.get("Accept-Encoding", ""):
+            stream = iter_gzip(stream)
+            response["Content-Encoding"] = "gzip"
+        response.streaming_content = stream
+        response["Vary"] = "Accept-Encoding"
+        response["Content-Disposition"] = 'attachment; filename="recipes.ndjson"'
+        return response
+
     def get_context_data(self, **kwargs):
         ontext = {"request": self.request}
         return context
 
 
-class IngredientViewSet(ModelViewSet):
+class IngredientViewSet(MetricsMixin, StatementBudgetMixin, ReplicaReadMixin, AsyncReadMixin, ConditionalGetMixin, ModelViewSet):
     queryset = Ingredient.objects.all()
     serializer_class = IngredientSerializer
     permission_classes = [IsAuthenticatedOrReadOnly]
     pagination_class = DefaultPagination
+    filter_backends = [OrderingFilter]
+    ordering_fields = ["name"]
+    statement_timeout = 2000
 
     def get_context_data(self, **kwargs):
         context = {"request": self.request}
         return context
 
+    @action(detail=False, methods=["GET"])
+    def autocomplete(self, request):
+        """
+        Suggests ingredients for a partially typed name, from the in-memory index of
+        recipes.autocomplete: prefix matches first, then close spellings, the most used first.
+
+        Accepts ?q=tom&limit=10.
+        """
+        query = AutocompleteQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        matches = autocomplete_index.complete(query.validated_data["q"], limit=query.validated_data["limit"])
+        return Response([
+            {"id": ingredient_id, "name": name, "recipe_count": recipe_count}
+            for ingredient_id, name, recipe_count in matches
+        ])
 
-class CommentViewSet(ModelViewSet):
+
+class CommentViewSet(MetricsMixin, StatementBudgetMixin, ReplicaReadMixin, AsyncReadMixin, ConditionalGetMixin, ModelViewSet):
     serializer_class = CommentSerializer
     permission_classes = [IsAuthenticatedOrReadOnly]
+    # Comment lists are returned whole unless the client asks for keyset pages
+    pagination_class = OptInKeysetPagination
     
     def get_serializer_context(self):
         return {"request": self.request,
@@ -93,7 +293,7 @@ class CommentViewSet(ModelViewSet):
         return [permission() for permission in permission_classes]
     
     
-class ProfileViewSet(ModelViewSet):
+class ProfileViewSet(MetricsMixin, StatementBudgetMixin, ReplicaReadMixin, ConditionalGetMixin, ModelViewSet):
     queryset = Profile.objects.all()
     serializer_class = ProfileSerializer
     
@@ -110,12 +310,111 @@ class ProfileViewSet(ModelViewSet):
     
     @action(detail=False, methods=["GET", "PUT"], permission_classes=[IsAuthenticated])
     def me(self, request):
-        profile = Profile.objects.get(user_id=request.user.id)
         if request.method == "GET":
-            serializer = ProfileSerializer(profile)
-            return Response(serializer.data)
+            profile = Profile.objects.get(user_id=request.user.id)
+            return self.conditional([profile], lambda: Response(ProfileSerializer(profile).data))
         else:
+            profile = Profile.objects.get(user_id=request.user.id)
             serializer = ProfileSerializer(profile, data=request.data)
             serializer.is_valid(raise_exception=True)
             serializer.save()
-            return Response(serializer.data)
\ No newline at end of file
+            return Response(serializer.data)
+
+
+class FollowViewSet(MetricsMixin, StatementBudgetMixin, mixins.ListModelMixin, mixins.CreateModelMixin, mixins.DestroyModelMixin, GenericViewSet):
+    """
+    The users the current user follows. POST {"followee": <user id>} follows a user, DELETE
+    /following/<user id>/ unfollows them.
+    """
+    serializer_class = FollowSerializer
+    permission_classes = [IsAuthenticated]
+    pagination_class = DefaultPagination
+    lookup_field = "followee"
+
+    def get_queryset(self):
+        return Follow.objects.filter(follower=self.request.user)
+
+    def perform_create(self, serializer):
+        try:
+            with transaction.atomic():
+                serializer.save(follower=self.request.user)
+        except IntegrityError:
+            # A concurrent request created the same follow after validation
+            raise ValidationError({"followee": ["You already follow this user."]})
+
+
+class FeedViewSet(RecipeFragmentsMixin, MetricsMixin, StatementBudgetMixin, ReplicaReadMixin, GenericViewSet):
+    """
+    The recipes of the users the current user follows, newest first, from their precomputed
+    timeline (see recipes.feed). Pages are followed with the ``next`` link's ?cursor=.
+    """
+    ingredient_prefetch = RecipeViewSet.ingredient_prefetch
+    queryset = Recipe.objects.defer('search_vector')
+    serializer_class = RecipeSerializer
+    permission_classes = [IsAuthenticated]
+    pagination_class = TimelinePagination
+
+    def list(self, request):
+        rows = self.paginator.paginate_timeline(
+            lambda cursor, limit: home_timeline(request.user, cursor, limit), request
+        )
+        recipes = self.get_queryset().in_bulk([recipe_id for _, recipe_id in rows])
+        # A recipe deleted since the page was read is skipped
+        found = [recipes[recipe_id] for _, recipe_id in rows if recipe_id in recipes]
+        return self.get_paginated_response(self.serialize_recipes(found))
+
+
+class ShoppingListViewSet(MetricsMixin, StatementBudgetMixin, ReplicaReadMixin, ViewSet):
+    """
+    Adds up the ingredients of several recipes into one shopping list, converting units where
+    they can be (see recipes.shopping).
+
+    Accepts ?recipes=12,15:2,40:0.5 (a recipe id, and optionally how many times it is made) or
+    a JSON body like {"recipes": [{"id": 12}, {"id": 15, "multiplier": 2}]}.
+    """
+    permission_classes = []
+
+    def list(self, request):
+        recipes = []
+        for param in request.query_params.getlist("recipes"):
+            for value in param.split(","):
+                if value:
+                    recipe_id, _, multiplier = value.partition(":")
+                    recipes.append({"id": recipe_id, **({"multiplier": multiplier} if multiplier else {})})
+        return self.shopping_list({"recipes": recipes})
+
+    def create(self, request):
+        return self.shopping_list(request.data)
+
+    def shopping_list(self, data):
+        query = ShoppingListQuerySerializer(data=data)
+        query.is_valid(raise_exception=True)
+        multipliers = defaultdict(Decimal)
+        for recipe in query.validated_data["recipes"]:
+            multipliers[recipe["id"]] += recipe["multiplier"]
+        found = set(Recipe.objects.filter(pk__in=multipliers).values_list("pk", flat=True))
+        return Response({
+            "recipes": len(found),
+            "missing_recipes": sorted(set(multipliers) - found),
+            "items": shopping_list({recipe_id: multipliers[recipe_id] for recipe_id in found}),
+        })
+
+
+class DatabaseStatsView(APIView):
+    """
+    Connection checkout and statement timeout counters of this process (see recipes/db.py).
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(db_stats.snapshot())
+
+
+class MetricsView(APIView):
+    """
+    Request metrics of all processes in the Prometheus text format (see recipes/metrics.py).
+    """
+    permission_classes = [IsAdminOrMetricsScraper]
+
+    def get(self, request):
+        return HttpResponse(registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")